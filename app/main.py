@@ -1,10 +1,244 @@
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import time
+from typing import Optional
 from fastapi import APIRouter
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic_settings import BaseSettings
 
+from utils.batch_writer import BatchInsertWriter
+from utils.conversations import record_conversation_messages
+from utils.database import PoolMonitor, check_transaction_support, close_db_client, create_indexes, get_db_client
+from utils.cache import SharedTTLCache
+from utils.digests import DigestWorker
+from utils.email_outbox import EmailOutboxWorker
+from utils.email_templates import email_templates
+from utils.notifications import NotificationService
+from utils.payment_processor import create_processor
+from utils.payment_webhooks import PaymentWebhookWorker
+from utils.pubsub import create_pubsub
+from utils.security import get_current_admin
+from utils.smtp import close_smtp_pools, configure_smtp_pools
 
-app = FastAPI()
+
+class Settings(BaseSettings):
+    MONGODB_URL: str = "mongodb://localhost:27017"
+    MONGODB_NAME: str = "artisan_booking"
+    MONGODB_MAX_POOL_SIZE: int = 100
+    MONGODB_MIN_POOL_SIZE: int = 0
+    MONGODB_MAX_IDLE_TIME_MS: Optional[int] = 300000
+    MONGODB_CONNECT_TIMEOUT_MS: int = 5000
+    MONGODB_SERVER_SELECTION_TIMEOUT_MS: int = 5000
+    MONGODB_SOCKET_TIMEOUT_MS: Optional[int] = None
+    MONGODB_WAIT_QUEUE_TIMEOUT_MS: Optional[int] = 10000
+    MONGODB_COMPRESSORS: str = "zlib"
+    MONGODB_ZLIB_COMPRESSION_LEVEL: int = 1
+    MONGODB_SKIP_INDEX_SYNC: bool = False
+    SECRET_KEY: str = "your-secret-key"
+    # Comma-separated client/artisan ids allowed to read the operational endpoints
+    ADMIN_USER_IDS: str = ""
+    ALGORITHM: str = "HS256"
+    ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
+    SMTP_SERVER: str = "smtp.example.com"
+    SMTP_PORT: int = 587
+    SMTP_USERNAME: str = "your-email@example.com"
+    SMTP_PASSWORD: str = "your-email-password"
+    SMTP_POOL_SIZE: int = 4
+    SMTP_MAX_MESSAGES_PER_CONNECTION: int = 100
+    SMTP_MAX_IDLE_SECONDS: float = 60.0
+    SMTP_TIMEOUT_SECONDS: float = 30.0
+    EMAIL_TEMPLATES_AUTO_RELOAD: bool = False
+    EMAIL_TEMPLATE_CACHE_DIR: Optional[str] = None
+    EMAIL_RENDER_THREAD_THRESHOLD_BYTES: int = 16384
+    EMAIL_RENDER_THREADS: int = 2
+    EMAIL_OUTBOX_BATCH_SIZE: int = 100
+    EMAIL_OUTBOX_POLL_INTERVAL_SECONDS: float = 1.0
+    EMAIL_MAX_ATTEMPTS: int = 8
+    EMAIL_RETRY_BASE_SECONDS: float = 30.0
+    EMAIL_RETRY_MAX_SECONDS: float = 3600.0
+    REVIEW_FEED_CACHE_TTL_SECONDS: float = 60.0
+    FRONTEND_URL: str = "http://localhost:3000"
+    PAYMENT_PROCESSOR: str = "stripe"
+    PAYMENT_TIMEOUT_SECONDS: float = 30.0
+    PAYMENT_MAX_CONNECTIONS: int = 20
+    # How long a booking stays claimed by a payment request before another may take it over
+    PAYMENT_CLAIM_LEASE_SECONDS: float = 300.0
+    STRIPE_API_KEY: str = "your-stripe-secret-key"
+    STRIPE_API_BASE: Optional[str] = None
+    PAYPAL_CLIENT_ID: str = "your-paypal-client-id"
+    PAYPAL_CLIENT_SECRET: str = "your-paypal-client-secret"
+    PAYPAL_ENVIRONMENT: str = "sandbox"
+    PAYPAL_API_BASE: Optional[str] = None
+    PLATFORM_FEE_BPS: int = 0
+    FAKE_PROCESSOR_LATENCY_MS: float = 50.0
+    FAKE_PROCESSOR_LATENCY_JITTER_MS: float = 0.0
+    FAKE_PROCESSOR_FAILURE_RATE: float = 0.0
+    FAKE_PROCESSOR_API_BASE: Optional[str] = None
+    STRIPE_WEBHOOK_SECRET: str = "your-stripe-webhook-secret"
+    PAYPAL_WEBHOOK_ID: str = "your-paypal-webhook-id"
+    WEBHOOK_BATCH_SIZE: int = 500
+    WEBHOOK_POLL_INTERVAL_SECONDS: float = 1.0
+    WEBHOOK_MAX_ATTEMPTS: int = 10
+    WEBSOCKET_PUBSUB_BACKEND: str = "memory"
+    WEBSOCKET_SEND_TIMEOUT_SECONDS: float = 5.0
+    WEBSOCKET_MAX_QUEUE: int = 256
+    WEBSOCKET_MAX_QUEUE_DELAY_SECONDS: float = 10.0
+    WEBSOCKET_HEARTBEAT_INTERVAL_SECONDS: float = 25.0
+    WEBSOCKET_IDLE_TIMEOUT_SECONDS: float = 75.0
+    WEBSOCKET_REAP_BATCH_SIZE: int = 500
+    WEBSOCKET_MAX_CONNECTIONS_PER_USER: int = 5
+    WEBSOCKET_REPLAY_BATCH_SIZE: int = 100
+    WEBSOCKET_REPLAY_LIMIT: int = 1000
+    WEBSOCKET_REPLAY_CONCURRENCY: int = 32
+    PRESENCE_OFFLINE_GRACE_SECONDS: float = 5.0
+    PRESENCE_FLUSH_INTERVAL_MS: float = 500.0
+    PRESENCE_SNAPSHOT_INTERVAL_SECONDS: float = 30.0
+    TYPING_INTERVAL_SECONDS: float = 2.0
+    NOTIFICATION_BATCH_INTERVAL_MS: float = 50.0
+    NOTIFICATION_BATCH_SIZE: int = 500
+    DIGEST_EMAIL_WINDOW_MINUTES: float = 60.0
+    DIGEST_POLL_INTERVAL_SECONDS: float = 60.0
+    MESSAGE_BATCH_INTERVAL_MS: float = 20.0
+    MESSAGE_BATCH_SIZE: int = 200
+    PUBSUB_FLUSH_INTERVAL_MS: float = 2.0
+    PUBSUB_MAX_BATCH: int = 500
+    REDIS_URL: str = "redis://localhost:6379/0"
+
+    class Config:
+        env_file = ".env"
+        env_file_encoding = 'utf-8'
+        extra = "ignore"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    # One client, and so one connection pool, for the whole process
+    app.mongodb_pool = PoolMonitor()
+    app.mongodb_client = await get_db_client(
+        app.settings.MONGODB_URL,
+        max_pool_size=app.settings.MONGODB_MAX_POOL_SIZE,
+        min_pool_size=app.settings.MONGODB_MIN_POOL_SIZE,
+        max_idle_time_ms=app.settings.MONGODB_MAX_IDLE_TIME_MS,
+        connect_timeout_ms=app.settings.MONGODB_CONNECT_TIMEOUT_MS,
+        server_selection_timeout_ms=app.settings.MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        socket_timeout_ms=app.settings.MONGODB_SOCKET_TIMEOUT_MS,
+        wait_queue_timeout_ms=app.settings.MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+        compressors=app.settings.MONGODB_COMPRESSORS,
+        zlib_compression_level=app.settings.MONGODB_ZLIB_COMPRESSION_LEVEL,
+        app_name="artisan-booking",
+        pool_monitor=app.mongodb_pool
+    )
+    await check_transaction_support(app.mongodb_client)
+    app.mongodb = app.mongodb_client[app.settings.MONGODB_NAME]
+    app.index_sync_seconds = None
+    if not app.settings.MONGODB_SKIP_INDEX_SYNC:
+        index_started = time.perf_counter()
+        await create_indexes(app.mongodb)
+        app.index_sync_seconds = time.perf_counter() - index_started
+    # Processors own pooled HTTP clients, so build them once and share them
+    app.payment_processor = create_processor(app.settings)
+    app.payment_webhook_worker = PaymentWebhookWorker(
+        app,
+        batch_size=app.settings.WEBHOOK_BATCH_SIZE,
+        poll_interval=app.settings.WEBHOOK_POLL_INTERVAL_SECONDS,
+        max_attempts=app.settings.WEBHOOK_MAX_ATTEMPTS
+    )
+    app.payment_webhook_worker.start()
+    # Emails share a few persistent SMTP sessions instead of one per message
+    configure_smtp_pools(
+        size=app.settings.SMTP_POOL_SIZE,
+        max_messages=app.settings.SMTP_MAX_MESSAGES_PER_CONNECTION,
+        max_idle=app.settings.SMTP_MAX_IDLE_SECONDS,
+        timeout=app.settings.SMTP_TIMEOUT_SECONDS
+    )
+    # Compile every email template now so sending never reads from disk
+    email_templates.load(
+        auto_reload=app.settings.EMAIL_TEMPLATES_AUTO_RELOAD,
+        bytecode_cache_dir=app.settings.EMAIL_TEMPLATE_CACHE_DIR,
+        thread_threshold=app.settings.EMAIL_RENDER_THREAD_THRESHOLD_BYTES,
+        render_threads=app.settings.EMAIL_RENDER_THREADS
+    )
+    app.email_outbox = EmailOutboxWorker(
+        app,
+        batch_size=app.settings.EMAIL_OUTBOX_BATCH_SIZE,
+        poll_interval=app.settings.EMAIL_OUTBOX_POLL_INTERVAL_SECONDS,
+        max_attempts=app.settings.EMAIL_MAX_ATTEMPTS,
+        retry_base=app.settings.EMAIL_RETRY_BASE_SECONDS,
+        retry_max=app.settings.EMAIL_RETRY_MAX_SECONDS,
+        send_concurrency=app.settings.SMTP_POOL_SIZE
+    )
+    app.email_outbox.start()
+    messages_manager.send_timeout = app.settings.WEBSOCKET_SEND_TIMEOUT_SECONDS
+    messages_manager.max_queue = app.settings.WEBSOCKET_MAX_QUEUE
+    messages_manager.max_queue_delay = app.settings.WEBSOCKET_MAX_QUEUE_DELAY_SECONDS
+    messages_manager.heartbeat_interval = app.settings.WEBSOCKET_HEARTBEAT_INTERVAL_SECONDS
+    messages_manager.idle_timeout = app.settings.WEBSOCKET_IDLE_TIMEOUT_SECONDS
+    messages_manager.reap_batch_size = app.settings.WEBSOCKET_REAP_BATCH_SIZE
+    messages_manager.max_connections_per_user = app.settings.WEBSOCKET_MAX_CONNECTIONS_PER_USER
+    app.websocket_replay_slots = asyncio.Semaphore(app.settings.WEBSOCKET_REPLAY_CONCURRENCY)
+    # Lets chat reach users connected to other worker processes
+    await messages_manager.start(create_pubsub(app.settings, app))
+    app.review_feed_cache.attach(messages_manager)
+    messages_presence.offline_grace = app.settings.PRESENCE_OFFLINE_GRACE_SECONDS
+    messages_presence.flush_interval = app.settings.PRESENCE_FLUSH_INTERVAL_MS / 1000
+    messages_presence.snapshot_interval = app.settings.PRESENCE_SNAPSHOT_INTERVAL_SECONDS
+    messages_presence.typing_interval = app.settings.TYPING_INTERVAL_SECONDS
+    await messages_presence.start()
+    app.digest_worker = DigestWorker(
+        app,
+        windows={"email": app.settings.DIGEST_EMAIL_WINDOW_MINUTES * 60},
+        poll_interval=app.settings.DIGEST_POLL_INTERVAL_SECONDS
+    )
+    # Notifications are only queued for channels the digest worker can send
+    app.notifications = NotificationService(
+        app,
+        messages_manager,
+        flush_interval=app.settings.NOTIFICATION_BATCH_INTERVAL_MS / 1000,
+        max_batch=app.settings.NOTIFICATION_BATCH_SIZE,
+        digest_channels=app.digest_worker.channels
+    )
+    app.notifications.start()
+    app.digest_worker.start()
+    # Chat messages sent over WebSockets are persisted in micro-batches
+    app.message_writer = BatchInsertWriter(
+        app,
+        "messages",
+        flush_interval=app.settings.MESSAGE_BATCH_INTERVAL_MS / 1000,
+        max_batch=app.settings.MESSAGE_BATCH_SIZE,
+        on_batch=lambda documents: record_conversation_messages(app.mongodb, documents)
+    )
+    app.message_writer.start()
+    app.startup_seconds = time.perf_counter() - started
+    startup_message = f"Startup finished in {app.startup_seconds * 1000:.0f} ms"
+    if app.index_sync_seconds is not None:
+        startup_message += f", {app.index_sync_seconds * 1000:.0f} ms of it syncing indexes"
+    logging.info(startup_message)
+    try:
+        yield
+    finally:
+        await app.message_writer.stop()
+        await app.digest_worker.stop()
+        await app.notifications.stop()
+        await messages_presence.stop()
+        await messages_manager.close()
+        await app.email_outbox.stop()
+        await close_smtp_pools()
+        email_templates.close()
+        await app.payment_webhook_worker.stop()
+        await app.payment_processor.close()
+        await close_db_client(app.mongodb_client)
+
+
+app = FastAPI(lifespan=lifespan)
+app.settings = Settings()
+
+# First page of each artisan's review feed, invalidated on every worker by review writes
+app.review_feed_cache = SharedTTLCache(
+    "__review_feed__", maxsize=2048, ttl=app.settings.REVIEW_FEED_CACHE_TTL_SECONDS
+)
 
 
 from routers.artisans import artisans_router
@@ -12,7 +246,8 @@ from routers.bookings import bookings_router
 from routers.clients import clients_router
 from routers.reviews import reviews_router
 from routers.payments import payments_router
-from routers.messages import messages_router
+from routers.messages import messages_router, manager as messages_manager, presence as messages_presence
+from routers.notifications import notifications_router
 
 
 
@@ -22,27 +257,7 @@ app.include_router(bookings_router, prefix="/api/bookings")
 app.include_router(reviews_router, prefix="/api/reviews")
 app.include_router(payments_router, prefix="/api/payments")
 app.include_router(messages_router, prefix="/api/messages")
-
-
-
-
-
-
-class Settings(BaseSettings): 
-    MONGODB_URL: str = "mongodb://localhost:27017"
-    MONGODB_NAME: str = "artisan_booking"
-    SECRET_KEY: str = "your-secret-key"
-    ALGORITHM: str = "HS256"
-    ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
-    SMTP_SERVER: str = "smtp.example.com"
-    SMTP_PORT: int = 587
-    SMTP_USERNAME: str = "your-email@example.com"
-    SMTP_PASSWORD: str = "your-email-password"
-    FRONTEND_URL: str = "http://localhost:3000"
-    
-    class Config:
-        env_file = ".env"
-        env_file_encoding = 'utf-8'
+app.include_router(notifications_router, prefix="/api/notifications")
 
 
 
@@ -57,4 +272,15 @@ app.add_middleware(
 
 @app.get("/")
 async def root():
-    return {"message": "Welcome to Artisan Booking System"}
\ No newline at end of file
+    return {"message": "Welcome to Artisan Booking System"}
+
+
+@app.get("/metrics/database")
+async def get_database_metrics(current_admin: dict = Depends(get_current_admin)):
+    """Startup timing and MongoDB connection pool gauges for this worker"""
+    return {
+        "startup_seconds": app.startup_seconds,
+        "index_sync_seconds": app.index_sync_seconds,
+        "max_pool_size": app.settings.MONGODB_MAX_POOL_SIZE,
+        "pool": app.mongodb_pool.snapshot()
+    }
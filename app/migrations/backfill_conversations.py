@@ -0,0 +1,42 @@
+"""Backfill conversation data for messages stored before it existed
+
+Sets conversation_key on every message, then rebuilds the conversations
+collection from the messages. Both steps are idempotent, so the script can
+be rerun after an interruption. Run from the repository root:
+
+    python app/migrations/backfill_conversations.py --mongodb-url mongodb://localhost:27017
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from pathlib import Path
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.conversations import backfill_conversation_keys, rebuild_conversations
+
+
+async def main(args):
+    client = AsyncIOMotorClient(args.mongodb_url)
+    db = client[args.mongodb_name]
+    try:
+        await backfill_conversation_keys(db, batch_size=args.batch_size)
+        if not args.skip_conversations:
+            await rebuild_conversations(db)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongodb-url", default=os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--mongodb-name", default=os.getenv("MONGODB_NAME", "artisan_booking"))
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--skip-conversations", action="store_true",
+                        help="only set conversation_key; leave the conversations collection alone")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parser.parse_args()))
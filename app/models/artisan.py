@@ -16,6 +16,7 @@ class ArtisanBase(BaseModel):
     profile_picture: Optional[str] = None
     rating: float = 0.0
     review_count: int = 0
+    rating_histogram: dict = {str(star): 0 for star in range(1, 6)}
 
 class ArtisanInDB(ArtisanBase):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import Optional
 from pydantic import BaseModel, Field
 from bson import ObjectId
 from .client import PyObjectId
@@ -14,6 +15,7 @@ class MessageCreate(MessageBase):
 
 class MessageInDB(MessageBase):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
+    conversation_key: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.now)
     updated_at: datetime = Field(default_factory=datetime.now)
 
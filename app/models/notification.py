@@ -8,6 +8,7 @@ class NotificationType(str, Enum):
     BOOKING_REQUEST = "booking_request"
     BOOKING_ACCEPTED = "booking_accepted"
     BOOKING_DECLINED = "booking_declined"
+    BOOKING_CANCELLED = "booking_cancelled"
     BOOKING_REMINDER = "booking_reminder"
     PAYMENT_RECEIVED = "payment_received"
     NEW_MESSAGE = "new_message"
@@ -21,6 +22,7 @@ class NotificationBase(BaseModel):
 
 class NotificationInDB(NotificationBase):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
+    read: bool = False
     created_at: datetime = Field(default_factory=datetime.now)
 
     class Config:
@@ -1,15 +1,23 @@
 from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from typing import Optional, List
+from bson import ObjectId
 from datetime import datetime
 import logging
 
 from models.artisan import ArtisanInDB
+from models.client import PyObjectId
 from schemas.artisan import ArtisanOut
+from schemas.review import ReviewFeed, ReviewOut
 from utils.database import get_db
-from utils.security import get_current_client
+from utils.ledger import get_artisan_balances
+from utils.pagination import InvalidCursor, encode_cursor, keyset_filter
+from utils.security import get_current_artisan, get_current_client
 
 artisans_router = APIRouter()
 
+# The first page is cached at this size and sliced down for smaller limits
+REVIEW_FEED_MAX_LIMIT = 50
+
 @artisans_router.get("/search", response_model=List[ArtisanOut])
 async def search_artisans(
     request: Request,
@@ -18,7 +26,7 @@ async def search_artisans(
     min_rating: Optional[float] = Query(None, ge=0, le=5),
     available_from: Optional[datetime] = None,
     available_to: Optional[datetime] = None,
-    sort_by: Optional[str] = Query("relevance", regex="^(relevance|distance|rating)$"),
+    sort_by: Optional[str] = Query("relevance", pattern="^(relevance|distance|rating)$"),
     limit: int = Query(10, le=50),
     skip: int = 0
 ):
@@ -57,3 +65,79 @@ async def search_artisans(
     ).sort(sort_criteria).skip(skip).limit(limit).to_list(limit)
     
     return [ArtisanOut(**artisan) for artisan in artisans]
+
+
+@artisans_router.get("/me/balance")
+async def get_my_balance(
+    request: Request,
+    current_artisan: dict = Depends(get_current_artisan)
+):
+    """What the platform currently owes the signed-in artisan, per currency"""
+    balances = await get_artisan_balances(request.app.mongodb, current_artisan["_id"])
+    return {"balances": balances}
+
+@artisans_router.get("/{artisan_id}/reviews", response_model=ReviewFeed)
+async def get_artisan_reviews(
+    artisan_id: str,
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=REVIEW_FEED_MAX_LIMIT)
+):
+    """List an artisan's reviews newest first, paginated by cursor"""
+    if not ObjectId.is_valid(artisan_id):
+        raise HTTPException(status_code=404, detail="Artisan not found")
+
+    if cursor is None:
+        first_page = request.app.review_feed_cache.get(artisan_id)
+        if first_page is None:
+            first_page = await _fetch_review_page(
+                request.app.mongodb, artisan_id, None, REVIEW_FEED_MAX_LIMIT
+            )
+            request.app.review_feed_cache.set(artisan_id, first_page)
+        return _slice_review_page(first_page, limit)
+
+    page = await _fetch_review_page(request.app.mongodb, artisan_id, cursor, limit)
+    return _slice_review_page(page, limit)
+
+async def _fetch_review_page(db, artisan_id: str, cursor: Optional[str], limit: int) -> dict:
+    artisan = await db["artisans"].find_one(
+        {"_id": PyObjectId(artisan_id)},
+        {"rating": 1, "review_count": 1, "rating_histogram": 1}
+    )
+    if not artisan:
+        raise HTTPException(status_code=404, detail="Artisan not found")
+
+    query = {"artisan_id": artisan["_id"]}
+    if cursor:
+        try:
+            query.update(keyset_filter(cursor))
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    # Served by the (artisan_id, created_at, _id) index; one extra row tells us if there is more
+    reviews = await db["reviews"].find(query) \
+        .sort([("created_at", -1), ("_id", -1)]) \
+        .limit(limit + 1) \
+        .to_list(limit + 1)
+
+    return {
+        "reviews": reviews,
+        "rating": artisan.get("rating", 0.0),
+        "review_count": artisan.get("review_count", 0),
+        "rating_histogram": artisan.get("rating_histogram", {})
+    }
+
+def _slice_review_page(page: dict, limit: int) -> ReviewFeed:
+    reviews = page["reviews"][:limit]
+    next_cursor = None
+    if len(page["reviews"]) > limit:
+        last = reviews[-1]
+        next_cursor = encode_cursor(last["created_at"], last["_id"])
+
+    return ReviewFeed(
+        reviews=[ReviewOut(**review) for review in reviews],
+        rating=page["rating"],
+        review_count=page["review_count"],
+        rating_histogram=page["rating_histogram"],
+        next_cursor=next_cursor
+    )
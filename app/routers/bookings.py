@@ -1,15 +1,22 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, status, Request
 from datetime import datetime,timedelta
 from typing import List, Optional
 
 
 
 from ..models.booking import BookingInDB, BookingStatus
+from ..models.notification import NotificationType
 from ..schemas.booking import BookingOut, BookingCreate
 from ..utils.database import get_db
 from ..utils.security import get_current_client
 from ..utils.email import send_booking_confirmation_email
 from ..models.client import PyObjectId
+from ..utils.export import created_at_range, export_response
+
+BOOKING_EXPORT_FIELDS = [
+    "_id", "artisan_id", "service_name", "date", "duration", "location",
+    "status", "agreed_price", "payment_status", "created_at"
+]
 
 bookings_router = APIRouter()
 
@@ -52,8 +59,16 @@ async def create_booking(
     inserted_booking = await db["bookings"].insert_one(booking_db.dict(by_alias=True))
     created_booking = await db["bookings"].find_one({"_id": inserted_booking.inserted_id})
     
+    request.app.notifications.notify(
+        booking.artisan_id,
+        NotificationType.BOOKING_REQUEST.value,
+        f"{current_client['name']} requested {booking.service_name}",
+        related_entity_id=created_booking["_id"]
+    )
+    
     # Send confirmation email
     await send_booking_confirmation_email(
+        db,
         current_client["email"],
         current_client["name"],
         {
@@ -61,8 +76,7 @@ async def create_booking(
             "artisan_name": artisan["name"],
             "date": booking.date,
             "status": "pending"
-        },
-        request.app.settings
+        }
     )
     
     return BookingOut(**created_booking)
@@ -97,6 +111,25 @@ async def get_client_bookings(
     bookings = await db["bookings"].find(query).sort("date", 1).to_list(100)
     return [BookingOut(**booking) for booking in bookings]
 
+@bookings_router.get("/export")
+async def export_client_bookings(
+    request: Request,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    current_client: dict = Depends(get_current_client)
+):
+    """Stream the client's full booking history as CSV or NDJSON"""
+    query = {"client_id": current_client["_id"], **created_at_range(start, end)}
+    
+    return export_response(
+        request.app.mongodb["bookings"],
+        query,
+        BOOKING_EXPORT_FIELDS,
+        format,
+        filename="bookings"
+    )
+
 @bookings_router.get("/{booking_id}", response_model=BookingOut)
 async def get_booking(
     booking_id: str,
@@ -126,19 +159,27 @@ async def cancel_booking(
 ):
     db = request.app.mongodb
     
-    result = await db["bookings"].update_one(
+    booking = await db["bookings"].find_one_and_update(
         {
             "_id": PyObjectId(booking_id),
             "client_id": current_client["_id"],
             "status": {"$in": ["pending", "accepted"]}
         },
-        {"$set": {"status": "cancelled"}}
+        {"$set": {"status": "cancelled"}},
+        projection={"artisan_id": 1, "service_name": 1}
     )
     
-    if result.modified_count == 0:
+    if booking is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Booking could not be cancelled"
         )
     
+    request.app.notifications.notify(
+        booking["artisan_id"],
+        NotificationType.BOOKING_CANCELLED.value,
+        f"{current_client['name']} cancelled {booking['service_name']}",
+        related_entity_id=booking["_id"]
+    )
+    
     return {"message": "Booking cancelled successfully"}
\ No newline at end of file
@@ -6,7 +6,9 @@ from typing import Optional
 
 from ..models.client import ClientInDB
 from ..schemas.client import ClientCreate, ClientOut, ClientUpdate, ClientDashboard
+from ..utils.conversations import refresh_participant_summary
 from ..utils.database import get_db
+from ..utils.notifications import NOTIFICATION_PUBLIC_PROJECTION
 from ..utils.security import (
     get_password_hash,
     verify_password,
@@ -45,10 +47,10 @@ async def register_client(client: ClientCreate, request: Request):
     
     
     await send_registration_email(
+        db,
         client.email,
         client.name,
-        request.app.settings.FRONTEND_URL,
-        request.app.settings
+        request.app.settings.FRONTEND_URL
     )
     
     return ClientOut(**created_client)
@@ -103,9 +105,27 @@ async def get_client_dashboard(
         "date": {"$lt": datetime.utcnow()}
     }).sort("date", -1).to_list(5)
     
+    pending_payments = await db["bookings"].find({
+        "client_id": client_id,
+        "status": "accepted",
+        "payment_status": {"$ne": "paid"}
+    }).sort("date", 1).to_list(5)
+    
+    recent_messages = await db["conversations"].find(
+        {"participants": client_id},
+        {"last_message": 1, "participant_summaries": 1, f"unread.{client_id}": 1}
+    ).sort([("last_message_at", -1), ("_id", -1)]).to_list(5)
+    
+    notifications = await db["notifications"].find({"user_id": client_id}, NOTIFICATION_PUBLIC_PROJECTION) \
+        .sort([("created_at", -1), ("_id", -1)]) \
+        .to_list(10)
+    
     return ClientDashboard(
         upcoming_bookings=upcoming_bookings,
-        past_bookings=past_bookings
+        past_bookings=past_bookings,
+        pending_payments=pending_payments,
+        recent_messages=recent_messages,
+        notifications=notifications
     )
 
 @clients_router.get("/profile", response_model=ClientOut)
@@ -137,4 +157,6 @@ async def update_client_profile(
     )
     
     updated_client = await db["clients"].find_one({"_id": client_id})
+    if {"name", "profile_picture"} & update_data.keys():
+        await refresh_participant_summary(db, updated_client, "client")
     return ClientOut(**updated_client)
\ No newline at end of file
@@ -1,50 +1,303 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, Depends, HTTPException, status, Request, WebSocket, WebSocketDisconnect, Query
 from datetime import datetime
 from typing import List, Optional
+import asyncio
 import logging
 from bson import ObjectId
 
 from ..models.messages import MessageInDB, PyObjectId
-from ..schemas.messages import MessageOut, MessageCreate, Conversation
+from ..models.notification import NotificationType
+from ..schemas.messages import MessageOut, MessageCreate, Conversation, ConversationPage
 from ..utils.database import get_db
-from ..utils.security import get_current_client, get_current_artisan
-from ..utils.websocket import ConnectionManager
+from ..utils.cache import TTLCache
+from ..utils.conversations import conversation_key, mark_conversations_read, record_conversation_messages
+from ..utils.notifications import NOTIFICATION_PUBLIC_PROJECTION
+from ..utils.pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_filter, keyset_range
+from ..utils.presence import PresenceService
+from ..utils.security import get_current_client, get_current_artisan, get_current_admin, get_websocket_user
+from ..utils.websocket import FRAME_ENCODINGS, ConnectionManager
 
 messages_router = APIRouter()
 
 
 manager = ConnectionManager()
+presence = PresenceService(manager)
+
+# Recipients seen recently, so socket sends skip the existence lookup
+recipient_cache = TTLCache(maxsize=10000, ttl=300)
 
 @messages_router.websocket("/ws/{client_id}")
 async def websocket_endpoint(
     websocket: WebSocket,
     client_id: str,
-    token: str
+    token: str,
+    since: Optional[str] = None,
+    encoding: str = "text"
 ):
-    """WebSocket endpoint for real-time messaging"""
-    try:
-        
-        if not token:
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-            return
+    """WebSocket endpoint for real-time messaging
 
-        
-        connection_id = f"{client_id}_{datetime.now().timestamp()}"
+    The token is checked once here; after that the socket carries "send",
+    "read", "typing" and "presence_subscribe" frames without per-message
+    HTTP or auth overhead.
+    A reconnecting client passes the cursor of the last event it received
+    as since, and is sent only what it missed. encoding picks the frame
+    format: "text" JSON, "binary" JSON, or zlib "deflate"d JSON.
+    """
+    user = await get_websocket_user(websocket, token) if token else None
+    if user is None or str(user["_id"]) != client_id or encoding not in FRAME_ENCODINGS:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
 
-        await manager.connect(websocket, client_id, connection_id)
-        
-        try:
-            while True:
-                data = await websocket.receive_json()
-                await manager.send_personal_message(
-                    {"message": "Received your message", "your_data": data},
-                    client_id
-                )
-        except WebSocketDisconnect:
-            manager.disconnect(connection_id)
+    connection_id = f"{client_id}_{datetime.now().timestamp()}"
+    await manager.connect(websocket, client_id, connection_id, encoding=encoding)
+    
+    try:
+        if since:
+            # Subscribed first, so nothing published from here on can fall in a gap
+            await replay_missed_events(websocket.app, user, connection_id, since)
+        while True:
+            frame = await websocket.receive_json()
+            manager.touch(connection_id)
+            await handle_chat_frame(websocket.app, user, connection_id, frame)
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
         logging.error(f"WebSocket error: {e}")
         await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+    finally:
+        manager.disconnect(connection_id)
+
+def notify_if_offline(app, sender: dict, document: dict):
+    """Leave a notification for a recipient with no live socket to see the message on"""
+    if not presence.is_online(str(document["recipient_id"])):
+        app.notifications.notify(
+            document["recipient_id"],
+            NotificationType.NEW_MESSAGE.value,
+            f"New message from {sender.get('name', 'someone')}",
+            related_entity_id=document["_id"]
+        )
+
+def message_event(document: dict) -> dict:
+    """The new_message event for a stored message, carrying its resume cursor"""
+    return {
+        "type": "new_message",
+        "message_id": str(document["_id"]),
+        "sender_id": str(document["sender_id"]),
+        "content": document["content"],
+        "timestamp": document["created_at"].isoformat(),
+        "cursor": encode_cursor(document["created_at"], document["_id"])
+    }
+
+async def replay_missed_events(app, user: dict, connection_id: str, since: str):
+    """Send a reconnecting socket the messages and notifications newer than its cursor
+
+    Reads ascend the (recipient_id, created_at, _id) and (user_id,
+    created_at, _id) indexes and go out in frames of up to
+    WEBSOCKET_REPLAY_BATCH_SIZE items. Past WEBSOCKET_REPLAY_LIMIT items the
+    replay stops with truncated set, and the client catches up through
+    GET /messages/?after=. Notifications at exactly the cursor's timestamp
+    may be sent again; clients drop ids they already have.
+    """
+    try:
+        since_at, _ = decode_cursor(since)
+        after_cursor = keyset_filter(since, direction=1)
+    except InvalidCursor as e:
+        manager.send_to_connection(connection_id, {"type": "error", "detail": str(e)})
+        return
+
+    db = app.mongodb
+    batch_size = app.settings.WEBSOCKET_REPLAY_BATCH_SIZE
+    limit = app.settings.WEBSOCKET_REPLAY_LIMIT
+    latest = since
+    truncated = False
+
+    def send_batch(kind: str, items: List[dict]):
+        manager.send_to_connection(connection_id, {"type": "replay", "kind": kind, "items": items})
+
+    # Bounds how many replay queries a reconnect storm can run at once
+    async with app.websocket_replay_slots:
+        items, replayed = [], 0
+        messages = db["messages"].find({"recipient_id": user["_id"], **after_cursor}) \
+            .sort([("created_at", 1), ("_id", 1)]) \
+            .limit(limit + 1) \
+            .batch_size(batch_size)
+        async for document in messages:
+            if replayed == limit:
+                truncated = True
+                break
+            replayed += 1
+            event = message_event(document)
+            latest = event["cursor"]
+            items.append(event)
+            if len(items) == batch_size:
+                send_batch("messages", items)
+                items = []
+        if items:
+            send_batch("messages", items)
+
+        items = []
+        notifications = db["notifications"].find(
+            {"user_id": user["_id"], "created_at": {"$gte": since_at}},
+            NOTIFICATION_PUBLIC_PROJECTION
+        ).sort([("created_at", 1), ("_id", 1)]) \
+            .limit(limit) \
+            .batch_size(batch_size)
+        async for document in notifications:
+            items.append(document)
+            if len(items) == batch_size:
+                send_batch("notifications", items)
+                items = []
+        if items:
+            send_batch("notifications", items)
+
+    manager.send_to_connection(connection_id, {
+        "type": "replay_done",
+        "cursor": latest,
+        "truncated": truncated
+    })
+
+async def recipient_exists(db, recipient_id: ObjectId) -> bool:
+    """Check a chat recipient exists, remembering positive answers for a few minutes"""
+    if recipient_cache.get(recipient_id):
+        return True
+    exists = await db["clients"].count_documents({"_id": recipient_id}, limit=1) or \
+        await db["artisans"].count_documents({"_id": recipient_id}, limit=1)
+    if exists:
+        recipient_cache.set(recipient_id, True)
+    return bool(exists)
+
+async def handle_chat_frame(app, user: dict, connection_id: str, frame: dict):
+    """Dispatch one inbound frame from an authenticated socket"""
+    frame_type = frame.get("type")
+    
+    if frame_type == "send":
+        await handle_send_frame(app, user, connection_id, frame)
+    elif frame_type == "read":
+        await handle_read_frame(app, user, connection_id, frame)
+    elif frame_type == "pong":
+        pass
+    elif frame_type == "typing":
+        recipient_id = frame.get("recipient_id")
+        if recipient_id and ObjectId.is_valid(recipient_id):
+            presence.typing(str(user["_id"]), recipient_id)
+    elif frame_type == "presence_subscribe":
+        user_ids = [user_id for user_id in frame.get("user_ids", []) if ObjectId.is_valid(user_id)]
+        manager.send_to_connection(connection_id, {
+            "type": "presence",
+            "users": presence.watch(connection_id, user_ids)
+        })
+    else:
+        manager.send_to_connection(connection_id, {
+            "type": "error",
+            "detail": f"Unknown frame type: {frame_type}"
+        })
+
+async def handle_send_frame(app, user: dict, connection_id: str, frame: dict):
+    client_msg_id = frame.get("client_msg_id")
+    recipient_id = frame.get("recipient_id")
+    content = frame.get("content")
+    
+    if not recipient_id or not ObjectId.is_valid(recipient_id) or not content:
+        manager.send_to_connection(connection_id, {
+            "type": "error",
+            "client_msg_id": client_msg_id,
+            "detail": "A send frame needs a valid recipient_id and content"
+        })
+        return
+    
+    if not await recipient_exists(app.mongodb, PyObjectId(recipient_id)):
+        manager.send_to_connection(connection_id, {
+            "type": "error",
+            "client_msg_id": client_msg_id,
+            "detail": "Recipient not found"
+        })
+        return
+    
+    message_db = MessageInDB(
+        recipient_id=recipient_id,
+        content=content,
+        sender_id=user["_id"],
+        conversation_key=conversation_key(user["_id"], recipient_id),
+        read=False
+    )
+    
+    async def on_persisted(document: dict, saved: bool):
+        if not saved:
+            manager.send_to_connection(connection_id, {
+                "type": "error",
+                "client_msg_id": client_msg_id,
+                "detail": "Message could not be saved"
+            })
+            return
+        
+        manager.send_to_connection(connection_id, {
+            "type": "ack",
+            "client_msg_id": client_msg_id,
+            "message_id": str(document["_id"]),
+            "created_at": document["created_at"].isoformat()
+        })
+        await manager.send_personal_message(message_event(document), recipient_id)
+        notify_if_offline(app, user, document)
+    
+    # Acked only once the batch containing this message is durably written
+    app.message_writer.submit(message_db.dict(by_alias=True), on_persisted)
+
+async def handle_read_frame(app, user: dict, connection_id: str, frame: dict):
+    message_ids = [
+        PyObjectId(message_id)
+        for message_id in frame.get("message_ids", [])
+        if ObjectId.is_valid(message_id)
+    ]
+    if not message_ids:
+        return
+    
+    db = app.mongodb
+    unread = await db["messages"].find(
+        {"_id": {"$in": message_ids}, "recipient_id": user["_id"], "read": False},
+        {"sender_id": 1}
+    ).to_list(None)
+    if not unread:
+        manager.send_to_connection(connection_id, {"type": "read_ack", "count": 0})
+        return
+    
+    ids_by_partner = {}
+    for message in unread:
+        ids_by_partner.setdefault(message["sender_id"], []).append(message["_id"])
+    
+    # One update per partner, so each counter drops by what this frame actually flipped;
+    # messages another request marked read in the meantime are not counted twice
+    now = datetime.now()
+    results = await asyncio.gather(*(
+        db["messages"].update_many(
+            {"_id": {"$in": ids}, "sender_id": partner_id, "read": False},
+            {"$set": {"read": True, "updated_at": now}}
+        )
+        for partner_id, ids in ids_by_partner.items()
+    ))
+    counts_by_partner = {
+        partner_id: result.modified_count
+        for partner_id, result in zip(ids_by_partner, results)
+    }
+    await mark_conversations_read(db, user["_id"], counts_by_partner)
+    
+    manager.send_to_connection(connection_id, {
+        "type": "read_ack",
+        "count": sum(counts_by_partner.values())
+    })
+
+@messages_router.get("/presence")
+async def get_presence(
+    user_ids: str = Query(..., description="Comma-separated user ids, at most 200"),
+    current_client: dict = Depends(get_current_client)
+):
+    """Which of the given users are online right now"""
+    ids = [user_id for user_id in user_ids.split(",") if user_id][:200]
+    return {"online": presence.online_among(ids)}
+
+@messages_router.get("/ws/metrics")
+async def get_websocket_metrics(current_admin: dict = Depends(get_current_admin)):
+    """Send-queue gauges for the WebSocket connections held by this worker"""
+    return manager.metrics()
 
 @messages_router.post("/", response_model=MessageOut)
 async def create_message(
@@ -69,21 +322,18 @@ async def create_message(
     message_db = MessageInDB(
         **message.dict(),
         sender_id=current_client["_id"],
+        conversation_key=conversation_key(current_client["_id"], message.recipient_id),
         read=False
     )
 
     # Save to database
     inserted_message = await db["messages"].insert_one(message_db.dict(by_alias=True))
     created_message = await db["messages"].find_one({"_id": inserted_message.inserted_id})
+    await record_conversation_messages(db, [created_message])
 
     
-    await manager.send_personal_message({
-        "type": "new_message",
-        "message_id": str(created_message["_id"]),
-        "sender_id": str(created_message["sender_id"]),
-        "content": created_message["content"],
-        "timestamp": created_message["created_at"].isoformat()
-    }, str(message.recipient_id))
+    await manager.send_personal_message(message_event(created_message), str(message.recipient_id))
+    notify_if_offline(request.app, current_client, created_message)
 
     return MessageOut(**created_message)
 
@@ -92,129 +342,156 @@ async def get_messages(
     request: Request,
     recipient_id: Optional[str] = None,
     limit: int = 100,
-    skip: int = 0,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
     current_client: dict = Depends(get_current_client)
 ):
-    """Get messages for current user, optionally filtered by recipient"""
+    """Get messages for current user, newest first, optionally filtered by recipient
+
+    Page back through history with before=<oldest message id received>, or
+    fetch what arrived since with after=<newest message id received>.
+    """
     db = request.app.mongodb
+    limit = max(1, min(limit, 100))
     
-    query = {
-        "$or": [
-            {"sender_id": current_client["_id"]},
-            {"recipient_id": current_client["_id"]}
-        ]
-    }
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
     
     if recipient_id:
-        query["$or"] = [
-            {
-                "sender_id": current_client["_id"],
-                "recipient_id": PyObjectId(recipient_id)
-            },
-            {
-                "sender_id": PyObjectId(recipient_id),
-                "recipient_id": current_client["_id"]
-            }
-        ]
+        query = {"conversation_key": conversation_key(current_client["_id"], recipient_id)}
+    else:
+        query = {
+            "$or": [
+                {"sender_id": current_client["_id"]},
+                {"recipient_id": current_client["_id"]}
+            ]
+        }
+
+    direction = 1 if after else -1
+    anchor_id = before or after
+    if anchor_id:
+        anchor = None
+        if ObjectId.is_valid(anchor_id):
+            anchor = await db["messages"].find_one(
+                {**query, "_id": PyObjectId(anchor_id)},
+                {"created_at": 1}
+            )
+        if anchor is None:
+            raise HTTPException(status_code=400, detail=f"Invalid cursor: {anchor_id}")
+        query = {"$and": [query, keyset_range(anchor["created_at"], anchor["_id"], direction=direction)]}
 
     messages = await db["messages"].find(query) \
-        .sort("created_at", -1) \
-        .skip(skip) \
+        .sort([("created_at", direction), ("_id", direction)]) \
         .limit(limit) \
         .to_list(limit)
+    if direction > 0:
+        messages.reverse()
     
     return [MessageOut(**msg) for msg in messages]
 
-@messages_router.get("/conversations", response_model=List[Conversation])
+@messages_router.get("/conversations", response_model=ConversationPage)
 async def get_conversations(
     request: Request,
+    limit: int = 20,
+    cursor: Optional[str] = None,
     current_client: dict = Depends(get_current_client)
 ):
-    """Get all conversations for current user"""
+    """Get conversations for current user, most recently active first"""
     db = request.app.mongodb
+    limit = max(1, min(limit, 100))
     
-    # Get distinct participants
-    pipeline = [
-        {
-            "$match": {
-                "$or": [
-                    {"sender_id": current_client["_id"]},
-                    {"recipient_id": current_client["_id"]}
-                ]
-            }
-        },
-        {
-            "$project": {
-                "participant": {
-                    "$cond": {
-                        "if": {"$eq": ["$sender_id", current_client["_id"]]},
-                        "then": "$recipient_id",
-                        "else": "$sender_id"
-                    }
-                },
-                "last_message": "$$ROOT",
-                "read": "$read"
-            }
-        },
-        {
-            "$sort": {"last_message.created_at": -1}
-        },
-        {
-            "$group": {
-                "_id": "$participant",
-                "last_message": {"$first": "$last_message"},
-                "unread_count": {
-                    "$sum": {
-                        "$cond": [
-                            {"$and": [
-                                {"$eq": ["$last_message.recipient_id", current_client["_id"]]},
-                                {"$eq": ["$read", False]}
-                            ]},
-                            1,
-                            0
-                        ]
-                    }
-                }
-            }
-        },
-        {
-            "$lookup": {
-                "from": "clients",
-                "localField": "_id",
-                "foreignField": "_id",
-                "as": "client"
-            }
-        },
+    query = {"participants": current_client["_id"]}
+    if cursor:
+        try:
+            query.update(keyset_filter(cursor, field="last_message_at"))
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    # Served by the (participants, last_message_at, _id) index; no scan of messages
+    conversations = await db["conversations"].find(query) \
+        .sort([("last_message_at", -1), ("_id", -1)]) \
+        .limit(limit + 1) \
+        .to_list(limit + 1)
+
+    next_cursor = None
+    if len(conversations) > limit:
+        conversations = conversations[:limit]
+        last = conversations[-1]
+        next_cursor = encode_cursor(last["last_message_at"], last["_id"])
+    
+    me = str(current_client["_id"])
+    return ConversationPage(
+        conversations=[Conversation(
+            participant=conversation_partner(conv, me),
+            last_message=conv["last_message"],
+            unread_count=conv.get("unread", {}).get(me, 0)
+        ) for conv in conversations],
+        next_cursor=next_cursor
+    )
+
+def conversation_partner(conversation: dict, user_id: str) -> dict:
+    """The other participant's denormalized summary, or just their id if not filled in yet"""
+    partner_id = next(
+        (participant for participant in conversation["participants"] if str(participant) != user_id),
+        conversation["participants"][0]
+    )
+    return conversation.get("participant_summaries", {}).get(str(partner_id), {"_id": partner_id})
+
+@messages_router.put("/conversations/{partner_id}/read")
+async def mark_conversation_as_read(
+    partner_id: str,
+    request: Request,
+    up_to: Optional[str] = None,
+    current_client: dict = Depends(get_current_client)
+):
+    """Mark everything a partner sent up to a message id or ISO timestamp as read
+
+    Without up_to, every message received in the conversation so far is marked.
+    """
+    db = request.app.mongodb
+    if not ObjectId.is_valid(partner_id):
+        raise HTTPException(status_code=400, detail="Invalid partner id")
+
+    key = conversation_key(current_client["_id"], partner_id)
+    watermark = {"created_at": {"$lte": datetime.now()}}
+    if up_to and ObjectId.is_valid(up_to):
+        message = await db["messages"].find_one(
+            {"conversation_key": key, "_id": PyObjectId(up_to)},
+            {"created_at": 1}
+        )
+        if message is None:
+            raise HTTPException(status_code=404, detail="Message not found in this conversation")
+        watermark = {"$or": [
+            {"created_at": {"$lt": message["created_at"]}},
+            {"created_at": message["created_at"], "_id": {"$lte": message["_id"]}}
+        ]}
+    elif up_to:
+        try:
+            watermark = {"created_at": {"$lte": datetime.fromisoformat(up_to)}}
+        except ValueError:
+            raise HTTPException(status_code=400, detail="up_to must be a message id or ISO timestamp")
+
+    # One range scan on the (conversation_key, created_at, _id) index
+    result = await db["messages"].update_many(
         {
-            "$lookup": {
-                "from": "artisans",
-                "localField": "_id",
-                "foreignField": "_id",
-                "as": "artisan"
-            }
+            "conversation_key": key,
+            "recipient_id": current_client["_id"],
+            "read": False,
+            **watermark
         },
-        {
-            "$project": {
-                "participant": {
-                    "$cond": {
-                        "if": {"$gt": [{"$size": "$client"}, 0]},
-                        "then": {"$arrayElemAt": ["$client", 0]},
-                        "else": {"$arrayElemAt": ["$artisan", 0]}
-                    }
-                },
-                "last_message": 1,
-                "unread_count": 1
-            }
-        }
-    ]
+        {"$set": {"read": True, "updated_at": datetime.now()}}
+    )
 
-    conversations = await db["messages"].aggregate(pipeline).to_list(1000)
-    
-    return [Conversation(
-        participant=conv["participant"],
-        last_message=conv["last_message"],
-        unread_count=conv["unread_count"]
-    ) for conv in conversations]
+    if result.modified_count:
+        await mark_conversations_read(db, current_client["_id"], {PyObjectId(partner_id): result.modified_count})
+        await manager.send_personal_message({
+            "type": "read_receipt",
+            "reader_id": str(current_client["_id"]),
+            "up_to": up_to,
+            "count": result.modified_count
+        }, partner_id, coalesce_key=f"read_receipt:{current_client['_id']}")
+
+    return {"message": "Conversation marked as read", "count": result.modified_count}
 
 @messages_router.put("/{message_id}/read")
 async def mark_as_read(
@@ -225,20 +502,24 @@ async def mark_as_read(
     """Mark a message as read"""
     db = request.app.mongodb
     
-    result = await db["messages"].update_one(
+    message = await db["messages"].find_one_and_update(
         {
             "_id": PyObjectId(message_id),
             "recipient_id": current_client["_id"]
         },
-        {"$set": {"read": True, "updated_at": datetime.now()}}
+        {"$set": {"read": True, "updated_at": datetime.now()}},
+        projection={"sender_id": 1, "read": 1}
     )
     
-    if result.modified_count == 0:
+    if message is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Message not found or not yours to mark as read"
         )
     
+    if not message["read"]:
+        await mark_conversations_read(db, current_client["_id"], {message["sender_id"]: 1})
+    
     return {"message": "Message marked as read"}
 
 @messages_router.post("/{message_id}/report")
@@ -277,6 +558,11 @@ async def report_message(
         "status": "pending"
     }
     
-    await db["reports"].insert_one(report)
+    # One report per reporter and message; reporting it again keeps the first
+    await db["reports"].update_one(
+        {"message_id": report["message_id"], "reporter_id": report["reporter_id"]},
+        {"$setOnInsert": report},
+        upsert=True
+    )
     
     return {"message": "Message reported successfully"}
\ No newline at end of file
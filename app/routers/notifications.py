@@ -0,0 +1,78 @@
+from fastapi import APIRouter, Depends, HTTPException, Request
+from typing import Optional
+from bson import ObjectId
+
+from ..schemas.notification import NotificationOut, NotificationPage
+from ..utils.notifications import NOTIFICATION_PUBLIC_PROJECTION, get_unread_count, mark_notifications_read
+from ..utils.pagination import InvalidCursor, encode_cursor, keyset_filter
+from ..utils.security import get_current_user
+
+notifications_router = APIRouter()
+
+@notifications_router.get("/", response_model=NotificationPage)
+async def get_notifications(
+    request: Request,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    unread_only: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get notifications for the current client or artisan, newest first"""
+    db = request.app.mongodb
+    limit = max(1, min(limit, 100))
+
+    query = {"user_id": current_user["_id"]}
+    if unread_only:
+        query["read"] = False
+    if cursor:
+        try:
+            query.update(keyset_filter(cursor))
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    # Served by the (user_id, created_at, _id) index
+    notifications = await db["notifications"].find(query, NOTIFICATION_PUBLIC_PROJECTION) \
+        .sort([("created_at", -1), ("_id", -1)]) \
+        .limit(limit + 1) \
+        .to_list(limit + 1)
+
+    next_cursor = None
+    if len(notifications) > limit:
+        notifications = notifications[:limit]
+        last = notifications[-1]
+        next_cursor = encode_cursor(last["created_at"], last["_id"])
+
+    return NotificationPage(
+        notifications=[NotificationOut(**notification) for notification in notifications],
+        unread_count=await get_unread_count(db, current_user["_id"]),
+        next_cursor=next_cursor
+    )
+
+@notifications_router.get("/unread-count")
+async def get_notification_unread_count(
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    return {"unread_count": await get_unread_count(request.app.mongodb, current_user["_id"])}
+
+@notifications_router.put("/read")
+async def mark_notifications_as_read(
+    request: Request,
+    up_to: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Mark all notifications read, or only those up to and including a notification id"""
+    db = request.app.mongodb
+
+    anchor = None
+    if up_to:
+        if ObjectId.is_valid(up_to):
+            anchor = await db["notifications"].find_one(
+                {"_id": ObjectId(up_to), "user_id": current_user["_id"]},
+                {"created_at": 1}
+            )
+        if anchor is None:
+            raise HTTPException(status_code=404, detail="Notification not found")
+
+    count = await mark_notifications_read(db, current_user["_id"], up_to=anchor)
+    return {"message": "Notifications marked as read", "count": count}
@@ -1,30 +1,112 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, status, Request
 from datetime import datetime
 from typing import List,Optional
 import logging
 
+from pymongo.errors import DuplicateKeyError
+
+from ..models.notification import NotificationType
 from ..models.payment import PaymentInDB, PaymentStatus
 from ..schemas.payment import PaymentOut, PaymentCreate
 from ..utils.database import get_db
-from ..utils.security import get_current_client
+from ..utils.security import get_current_admin, get_current_client
 from ..utils.payment_processor import process_payment
+from ..utils.booking_claims import (
+    BookingClaimConflict,
+    claim_booking_payment,
+    complete_booking_payment,
+    mark_booking_charged,
+    processor_idempotency_key,
+    release_booking_claim
+)
+from ..utils.idempotency import (
+    IdempotencyConflict,
+    claim_idempotency_key,
+    complete_idempotency_key,
+    release_idempotency_key,
+    request_fingerprint
+)
+from ..utils.export import created_at_range, export_response
+from ..utils.ledger import record_ledger_entries, run_payouts, to_minor_units
+from ..utils.payment_webhooks import (
+    WebhookVerificationError,
+    enqueue_webhook_event,
+    verify_webhook
+)
 
 payments_router = APIRouter()
 
+PAYMENT_EXPORT_FIELDS = [
+    "_id", "booking_id", "artisan_id", "amount", "currency", "method",
+    "status", "transaction_id", "created_at"
+]
+
 @payments_router.post("/", response_model=PaymentOut)
 async def create_payment(
     payment: PaymentCreate,
     request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=200),
     current_client: dict = Depends(get_current_client)
 ):
     db = request.app.mongodb
     
+    if not idempotency_key:
+        created_payment = await charge_booking(payment, request, current_client)
+        return PaymentOut(**created_payment)
+    
+    # Retries with the same key replay the first result instead of charging again
+    scope = f"payments:{current_client['_id']}"
+    fingerprint = request_fingerprint(payment.model_dump(exclude={"token"}))
+    try:
+        replay = await claim_idempotency_key(db, scope, idempotency_key, fingerprint)
+    except IdempotencyConflict as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
+    
+    if replay is not None:
+        existing_payment = await db["payments"].find_one({"_id": replay["payment_id"]})
+        if existing_payment is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="The payment made with this Idempotency-Key no longer exists"
+            )
+        return PaymentOut(**existing_payment)
     
-    booking = await db["bookings"].find_one({
+    try:
+        created_payment = await charge_booking(payment, request, current_client)
+    except Exception:
+        await release_idempotency_key(db, scope, idempotency_key)
+        raise
+    
+    await complete_idempotency_key(
+        db, scope, idempotency_key, {"payment_id": created_payment["_id"]}
+    )
+    return PaymentOut(**created_payment)
+
+async def charge_booking(
+    payment: PaymentCreate,
+    request: Request,
+    current_client: dict
+) -> dict:
+    db = request.app.mongodb
+    
+    # Claim the booking before charging, so two concurrent requests can never both charge it
+    booking_query = {
         "_id": payment.booking_id,
         "client_id": current_client["_id"],
         "status": "accepted"
-    })
+    }
+    try:
+        booking = await claim_booking_payment(
+            db, booking_query, request.app.settings.PAYMENT_CLAIM_LEASE_SECONDS
+        )
+    except BookingClaimConflict as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
     
     if not booking:
         raise HTTPException(
@@ -32,40 +114,112 @@ async def create_payment(
             detail="Booking not found or not eligible for payment"
         )
     
-    # Process payment
-    payment_result = await process_payment(
-        payment.method,
-        payment.amount,
-        payment.token,
-        request.app.settings
-    )
+    # An earlier request was charged but could not record it; finish that instead of charging again
+    transaction_id = booking.get("charged_transaction_id")
+    if transaction_id is None:
+        try:
+            payment_result = await process_payment(
+                request.app.payment_processor,
+                payment.method,
+                payment.amount,
+                payment.token,
+                currency=payment.currency,
+                idempotency_key=processor_idempotency_key(booking)
+            )
+        except Exception:
+            await release_booking_claim(db, booking)
+            raise
+        
+        if not payment_result.success:
+            await release_booking_claim(db, booking)
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=payment_result.message
+            )
+        transaction_id = payment_result.transaction_id
+    else:
+        logging.info(f"Recording earlier charge {transaction_id} for booking {booking['_id']}")
     
-    if not payment_result.success:
+    try:
+        created_payment = await record_booking_payment(
+            db, payment, current_client, booking, transaction_id, request.app.settings.PLATFORM_FEE_BPS
+        )
+    except Exception as e:
+        logging.error(f"Charge {transaction_id} for booking {booking['_id']} could not be recorded: {e}")
+        await mark_booking_charged(db, booking, transaction_id)
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=payment_result.message
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Payment was taken but could not be recorded; retry the request to finish it"
         )
     
+    try:
+        request.app.notifications.notify(
+            booking["artisan_id"],
+            NotificationType.PAYMENT_RECEIVED.value,
+            f"Payment of {payment.amount:.2f} {payment.currency} received for {booking['service_name']}",
+            related_entity_id=created_payment["_id"]
+        )
+    except Exception as e:
+        logging.error(f"Failed to notify artisan of payment {created_payment['_id']}: {e}")
     
+    return created_payment
+
+async def record_booking_payment(
+    db,
+    payment: PaymentCreate,
+    current_client: dict,
+    booking: dict,
+    transaction_id: str,
+    fee_bps: int
+) -> dict:
+    """Store the payment for a successful charge, credit the artisan and mark the booking paid
+
+    Safe to repeat for the same charge: the payment, its ledger entries and
+    the booking update are each written once however often this runs.
+    """
     payment_db = PaymentInDB(
-        **payment.model_dump()(exclude={"token"}),
+        **payment.model_dump(exclude={"token"}),
         client_id=current_client["_id"],
         artisan_id=booking["artisan_id"],
-        status=PaymentStatus.COMPLETED if payment_result.success else PaymentStatus.FAILED,
-        transaction_id=payment_result.transaction_id
+        status=PaymentStatus.COMPLETED,
+        transaction_id=transaction_id
     )
     
-    inserted_payment = await db["payments"].insert_one(payment_db.dict(by_alias=True))
-    created_payment = await db["payments"].find_one({"_id": inserted_payment.inserted_id})
-    
-    
-    if payment_result.success:
-        await db["bookings"].update_one(
-            {"_id": payment.booking_id},
-            {"$set": {"payment_status": "paid"}}
+    try:
+        inserted_payment = await db["payments"].insert_one(payment_db.dict(by_alias=True))
+        created_payment = await db["payments"].find_one({"_id": inserted_payment.inserted_id})
+    except DuplicateKeyError:
+        # Stored by an earlier attempt that failed further on
+        created_payment = await db["payments"].find_one(
+            {"booking_id": payment.booking_id, "status": PaymentStatus.COMPLETED.value}
         )
     
-    return PaymentOut(**created_payment)
+    await record_payment_in_ledger(db, created_payment, fee_bps)
+    await complete_booking_payment(db, booking)
+    return created_payment
+
+async def record_payment_in_ledger(db, payment: dict, fee_bps: int):
+    """Credit the artisan for a completed payment, less the platform fee"""
+    amount_minor = to_minor_units(payment["amount"], payment["currency"])
+    entries = [{
+        "artisan_id": payment["artisan_id"],
+        "entry_type": "charge",
+        "amount_minor": amount_minor,
+        "currency": payment["currency"],
+        "reference_id": str(payment["_id"])
+    }]
+    fee_minor = amount_minor * fee_bps // 10000
+    if fee_minor:
+        entries.append({
+            "artisan_id": payment["artisan_id"],
+            "entry_type": "fee",
+            "amount_minor": fee_minor,
+            "currency": payment["currency"],
+            "reference_id": str(payment["_id"])
+        })
+    
+    # Failures propagate, so charge_booking keeps the charge for a retry to finish recording
+    await record_ledger_entries(db, entries)
 
 @payments_router.get("/", response_model=List[PaymentOut])
 async def get_client_payments(
@@ -80,4 +234,52 @@ async def get_client_payments(
         query["status"] = status
     
     payments = await db["payments"].find(query).sort("created_at", -1).to_list(100)
-    return [PaymentOut(**payment) for payment in payments]
\ No newline at end of file
+    return [PaymentOut(**payment) for payment in payments]
+
+@payments_router.get("/export")
+async def export_client_payments(
+    request: Request,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    current_client: dict = Depends(get_current_client)
+):
+    """Stream the client's full payment history as CSV or NDJSON"""
+    query = {"client_id": current_client["_id"], **created_at_range(start, end)}
+    
+    return export_response(
+        request.app.mongodb["payments"],
+        query,
+        PAYMENT_EXPORT_FIELDS,
+        format,
+        filename="payments"
+    )
+
+@payments_router.post("/payouts")
+async def run_artisan_payouts(
+    request: Request,
+    min_payout_minor: int = Query(1, ge=1),
+    current_admin: dict = Depends(get_current_admin)
+):
+    """Pay out every artisan balance of at least min_payout_minor; called by an admin or a scheduled job"""
+    return await run_payouts(request.app.mongodb, min_payout_minor=min_payout_minor)
+
+@payments_router.post("/webhooks/{provider}")
+async def receive_payment_webhook(provider: str, request: Request):
+    """Verify and enqueue a processor webhook; the worker applies it asynchronously"""
+    payload = await request.body()
+    
+    try:
+        event = await verify_webhook(provider, payload, request.headers, request.app.settings)
+    except WebhookVerificationError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    
+    # Redelivered events are acknowledged without being queued twice
+    queued = await enqueue_webhook_event(request.app.mongodb, provider, event)
+    if queued:
+        request.app.payment_webhook_worker.notify()
+    
+    return {"received": True}
@@ -3,6 +3,7 @@ from datetime import datetime, timedelta
 from typing import List
 import logging
 
+from ..models.notification import NotificationType
 from ..models.review import ReviewInDB
 from ..schemas.review import ReviewOut, ReviewCreate, ReviewUpdate
 from ..utils.database import get_db
@@ -52,6 +53,13 @@ async def create_review(
     
     
     await update_artisan_rating(booking["artisan_id"], db)
+    await request.app.review_feed_cache.invalidate_everywhere(str(booking["artisan_id"]))
+    request.app.notifications.notify(
+        booking["artisan_id"],
+        NotificationType.REVIEW_RECEIVED.value,
+        f"{current_client['name']} left you a review",
+        related_entity_id=created_review["_id"]
+    )
     
     return ReviewOut(**created_review)
 
@@ -59,21 +67,33 @@ async def update_artisan_rating(artisan_id, db):
     pipeline = [
         {"$match": {"artisan_id": artisan_id}},
         {"$group": {
-            "_id": None,
-            "average_rating": {"$avg": "$rating"},
+            "_id": "$rating",
             "count": {"$sum": 1}
         }}
     ]
     
-    result = await db["reviews"].aggregate(pipeline).to_list(1)
-    if result:
-        await db["artisans"].update_one(
-            {"_id": artisan_id},
-            {"$set": {
-                "rating": result[0]["average_rating"],
-                "review_count": result[0]["count"]
-            }}
-        )
+    buckets = await db["reviews"].aggregate(pipeline).to_list(None)
+    
+    # Star histogram is stored on the artisan so review feeds never aggregate
+    histogram = {str(star): 0 for star in range(1, 6)}
+    for bucket in buckets:
+        if bucket["_id"] is not None:
+            histogram[str(bucket["_id"])] = bucket["count"]
+    
+    rated_count = sum(histogram.values())
+    average_rating = (
+        sum(int(star) * count for star, count in histogram.items()) / rated_count
+        if rated_count else 0.0
+    )
+    
+    await db["artisans"].update_one(
+        {"_id": artisan_id},
+        {"$set": {
+            "rating": average_rating,
+            "review_count": sum(bucket["count"] for bucket in buckets),
+            "rating_histogram": histogram
+        }}
+    )
 
 @reviews_router.put("/{review_id}", response_model=ReviewOut)
 async def update_review(
@@ -117,6 +137,7 @@ async def update_review(
     
     
     await update_artisan_rating(updated_review["artisan_id"], db)
+    await request.app.review_feed_cache.invalidate_everywhere(str(updated_review["artisan_id"]))
     
     return ReviewOut(**updated_review)
 
@@ -145,5 +166,6 @@ async def delete_review(
     
    
     await update_artisan_rating(review["artisan_id"], db)
+    await request.app.review_feed_cache.invalidate_everywhere(str(review["artisan_id"]))
     
     return {"message": "Review deleted successfully"}
\ No newline at end of file
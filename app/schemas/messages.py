@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 from bson import ObjectId
 
 class PyObjectId(ObjectId):
@@ -39,4 +39,11 @@ class MessageOut(MessageBase):
 class Conversation(BaseModel):
     participant: dict  
     last_message: dict
-    unread_count: int
\ No newline at end of file
+    unread_count: int
+
+    class Config:
+        json_encoders = {ObjectId: str}
+
+class ConversationPage(BaseModel):
+    conversations: List[Conversation]
+    next_cursor: Optional[str] = None
\ No newline at end of file
@@ -0,0 +1,39 @@
+from pydantic import BaseModel, Field
+from datetime import datetime
+from typing import List, Optional
+from bson import ObjectId
+
+from ..models.notification import NotificationType
+
+class PyObjectId(ObjectId):
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, v):
+        if not ObjectId.is_valid(v):
+            raise ValueError("Invalid objectid")
+        return ObjectId(v)
+
+    @classmethod
+    def __modify_schema__(cls, field_schema):
+        field_schema.update(type="string")
+
+class NotificationOut(BaseModel):
+    id: PyObjectId = Field(..., alias="_id")
+    user_id: PyObjectId
+    type: NotificationType
+    message: str
+    related_entity_id: Optional[PyObjectId] = None
+    read: bool = False
+    created_at: datetime
+
+    class Config:
+        allow_population_by_field_name = True
+        json_encoders = {ObjectId: str}
+
+class NotificationPage(BaseModel):
+    notifications: List[NotificationOut]
+    unread_count: int = 0
+    next_cursor: Optional[str] = None
@@ -1,6 +1,6 @@
 
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Optional, List
 from bson import ObjectId
 from datetime import datetime
 
@@ -37,4 +37,22 @@ class ReviewInDB(ReviewBase):
     class Config:
         allow_population_by_field_name = True
         arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
\ No newline at end of file
+        json_encoders = {ObjectId: str}
+
+class ReviewOut(ReviewBase):
+    id: PyObjectId = Field(..., alias="_id")
+    client_id: PyObjectId
+    artisan_id: PyObjectId
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        allow_population_by_field_name = True
+        json_encoders = {ObjectId: str}
+
+class ReviewFeed(BaseModel):
+    reviews: List[ReviewOut]
+    rating: float = 0.0
+    review_count: int = 0
+    rating_histogram: dict = {}
+    next_cursor: Optional[str] = None
@@ -0,0 +1,98 @@
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+import asyncio
+import logging
+
+from pymongo.errors import BulkWriteError
+
+# on_persisted(document, saved) runs once the document's batch has been written
+PersistedCallback = Callable[[dict, bool], Awaitable[None]]
+# on_batch(documents) runs once per flush with the documents that were saved
+BatchCallback = Callable[[List[dict]], Awaitable[None]]
+
+
+class BatchInsertWriter:
+    """Micro-batch inserts into one collection
+
+    Documents are buffered and written with a single insert_many every
+    flush_interval seconds, or as soon as max_batch are waiting. Documents
+    must carry their own _id so callers know it before the write lands.
+    on_batch lets derived data be maintained per batch rather than per
+    document, and finishes before any per-document callback runs.
+    """
+
+    def __init__(self, app, collection: str, flush_interval: float = 0.02, max_batch: int = 200,
+                 on_batch: Optional[BatchCallback] = None):
+        self.app = app
+        self.collection = collection
+        self.on_batch = on_batch
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending: List[Tuple[dict, Optional[PersistedCallback]]] = []
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._flushes: Set[asyncio.Task] = set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the timer and write whatever is still buffered"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+        await self.flush()
+
+    def submit(self, document: dict, on_persisted: Optional[PersistedCallback] = None):
+        """Buffer a document for the next batch"""
+        self._pending.append((document, on_persisted))
+        if len(self._pending) >= self.max_batch:
+            task = asyncio.create_task(self.flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+        else:
+            self._ready.set()
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        batch, self._pending = self._pending, []
+        self._ready.clear()
+        if not batch:
+            return
+
+        documents = [document for document, _ in batch]
+        failed = set()
+        try:
+            await self.app.mongodb[self.collection].insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"] for error in e.details.get("writeErrors", [])}
+            logging.error(f"{len(failed)} of {len(documents)} inserts into {self.collection} failed")
+        except Exception as e:
+            failed = set(range(len(documents)))
+            logging.error(f"Batch insert into {self.collection} failed: {e}")
+
+        if self.on_batch is not None and len(failed) < len(documents):
+            try:
+                await self.on_batch([
+                    document for index, document in enumerate(documents) if index not in failed
+                ])
+            except Exception as e:
+                logging.error(f"Error in {self.collection} batch hook: {e}")
+
+        callbacks = [
+            callback(document, index not in failed)
+            for index, (document, callback) in enumerate(batch)
+            if callback is not None
+        ]
+        results = await asyncio.gather(*callbacks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error(f"Error in {self.collection} batch callback: {result}")
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+from typing import Optional
+import uuid
+
+BOOKINGS_COLLECTION = "bookings"
+
+
+class BookingClaimConflict(Exception):
+    """Raised when another request is still paying for the booking"""
+
+
+async def claim_booking_payment(db, booking_query: dict, lease_seconds: float) -> Optional[dict]:
+    """Mark a booking as being paid for, so two requests can never both charge it
+
+    Returns the booking as it was before the claim, with processing_claim_id
+    set to this claim's id, or None when no booking matches or it is already
+    paid. Raises BookingClaimConflict while another claim is live. A claim
+    older than lease_seconds belongs to a request that died part way and is
+    taken over; it keeps the same payment attempt, so the processor replays
+    a charge that went through instead of making a second one.
+    """
+    now = datetime.now()
+    claim_id = uuid.uuid4().hex
+    booking = await db[BOOKINGS_COLLECTION].find_one_and_update(
+        {**booking_query, "$or": [
+            {"payment_status": {"$nin": ["paid", "processing"]}},
+            {"payment_status": "processing",
+             "processing_claimed_at": {"$not": {"$gte": now - timedelta(seconds=lease_seconds)}}}
+        ]},
+        {"$set": {
+            "payment_status": "processing",
+            "processing_claimed_at": now,
+            "processing_claim_id": claim_id
+        }}
+    )
+
+    if booking is None:
+        if await db[BOOKINGS_COLLECTION].find_one({**booking_query, "payment_status": "processing"}, {"_id": 1}):
+            raise BookingClaimConflict("A payment for this booking is already in progress")
+        return None
+
+    booking["processing_claim_id"] = claim_id
+    return booking
+
+
+def processor_idempotency_key(booking: dict) -> str:
+    """Idempotency key sent to the processor for the booking's current payment attempt"""
+    return f"booking:{booking['_id']}:{booking.get('payment_attempts', 0)}"
+
+
+async def release_booking_claim(db, booking: dict):
+    """Hand a booking back after a charge that did not go through
+
+    The payment attempt moves on, so the next claim charges under a fresh
+    processor idempotency key rather than replaying this failure.
+    """
+    previous_status = booking.get("payment_status", "pending")
+    await db[BOOKINGS_COLLECTION].update_one(
+        {"_id": booking["_id"], "processing_claim_id": booking["processing_claim_id"]},
+        {
+            "$set": {
+                "payment_status": "pending" if previous_status == "processing" else previous_status,
+                "processing_claimed_at": None
+            },
+            "$inc": {"payment_attempts": 1}
+        }
+    )
+
+
+async def mark_booking_charged(db, booking: dict, transaction_id: str):
+    """Remember a charge that went through but could not be recorded
+
+    The claim is given up so a retry can take the booking straight away; it
+    finds charged_transaction_id and finishes recording that charge instead
+    of charging again.
+    """
+    await db[BOOKINGS_COLLECTION].update_one(
+        {"_id": booking["_id"], "processing_claim_id": booking["processing_claim_id"]},
+        {"$set": {"charged_transaction_id": transaction_id, "processing_claimed_at": None}}
+    )
+
+
+async def complete_booking_payment(db, booking: dict):
+    """Mark the booking paid and clear the claim"""
+    await db[BOOKINGS_COLLECTION].update_one(
+        {"_id": booking["_id"]},
+        {
+            "$set": {"payment_status": "paid"},
+            "$unset": {"processing_claimed_at": "", "processing_claim_id": "", "charged_transaction_id": ""}
+        }
+    )
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+import time
+
+
+class TTLCache:
+    """Small in-process LRU cache whose entries expire after a fixed TTL"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value for key, or None if missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """Store a value, evicting the least recently used entry when full"""
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        """Drop a single entry"""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop every entry"""
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SharedTTLCache(TTLCache):
+    """TTLCache whose invalidations reach every worker process
+
+    Each worker keeps its own copy of the entries. invalidate_everywhere()
+    drops the key here straight away, for read-your-writes, and publishes
+    it on an internal pub/sub channel so the other workers drop theirs.
+    Delivery is best effort, so the TTL still bounds how stale a worker that
+    missed an invalidation can be.
+    """
+
+    def __init__(self, channel: str, maxsize: int = 1024, ttl: float = 60.0):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.channel = channel
+        self._manager = None
+
+    def attach(self, manager):
+        """Listen for invalidations on the manager's pub/sub backend"""
+        self._manager = manager
+        manager.add_channel_handler(self.channel, self._on_invalidate)
+
+    async def invalidate_everywhere(self, key: str):
+        self.invalidate(key)
+        if self._manager is not None:
+            await self._manager.pubsub.publish(self.channel, {"key": key})
+
+    async def _on_invalidate(self, message: dict):
+        self.invalidate(message["key"])
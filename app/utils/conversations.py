@@ -0,0 +1,238 @@
+from datetime import datetime
+from typing import Dict, Iterable, List
+import logging
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+CONVERSATIONS_COLLECTION = "conversations"
+
+# Enough of the last message for a conversation list; the thread has the rest
+LAST_MESSAGE_PREVIEW_LENGTH = 200
+
+
+def conversation_key(first_id, second_id) -> str:
+    """Canonical key for a pair of participants, independent of who sent what"""
+    first, second = sorted((str(first_id), str(second_id)))
+    return f"{first}:{second}"
+
+
+async def backfill_conversation_keys(db, batch_size: int = 1000) -> int:
+    """Set conversation_key on messages stored before it existed
+
+    Works through the messages in _id order, one batch per server-side
+    pipeline update, so it can run against a live collection and be
+    resumed at any point. Returns the number of messages updated.
+    """
+    sender, recipient = {"$toString": "$sender_id"}, {"$toString": "$recipient_id"}
+    key = {"$cond": [
+        {"$lt": [sender, recipient]},
+        {"$concat": [sender, ":", recipient]},
+        {"$concat": [recipient, ":", sender]}
+    ]}
+
+    updated = 0
+    last_id = None
+    while True:
+        query = {"conversation_key": None}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = await db["messages"].find(query, {"_id": 1}) \
+            .sort("_id", 1) \
+            .limit(batch_size) \
+            .to_list(batch_size)
+        if not batch:
+            break
+
+        last_id = batch[-1]["_id"]
+        result = await db["messages"].update_many(
+            {"_id": {"$in": [message["_id"] for message in batch]}, "conversation_key": None},
+            [{"$set": {"conversation_key": key}}]
+        )
+        updated += result.modified_count
+
+    logging.info(f"Backfilled conversation_key on {updated} messages")
+    return updated
+
+
+def _conversation_update(message: dict) -> UpdateOne:
+    """Upsert a conversation so it reflects one newly stored message
+
+    Written as a pipeline update so an older message arriving late never
+    replaces a newer last_message, and the recipient's unread counter is
+    incremented in the same atomic write.
+    """
+    sender_id, recipient_id = message["sender_id"], message["recipient_id"]
+    unread_field = f"unread.{recipient_id}"
+    last_message = {
+        "message_id": message["_id"],
+        "sender_id": sender_id,
+        "content": message["content"][:LAST_MESSAGE_PREVIEW_LENGTH],
+        "created_at": message["created_at"]
+    }
+    is_newer = {"$gt": [message["created_at"], {"$ifNull": ["$last_message_at", datetime.min]}]}
+
+    return UpdateOne(
+        {"conversation_key": conversation_key(sender_id, recipient_id)},
+        [{"$set": {
+            "participants": sorted([sender_id, recipient_id], key=str),
+            "last_message": {"$cond": [is_newer, {"$literal": last_message}, "$last_message"]},
+            "last_message_at": {"$cond": [is_newer, message["created_at"], "$last_message_at"]},
+            unread_field: {"$add": [{"$ifNull": [f"${unread_field}", 0]}, 1]}
+        }}],
+        upsert=True
+    )
+
+
+async def record_conversation_messages(db, messages: List[dict]):
+    """Fold stored messages into their conversations with one bulk write"""
+    if not messages:
+        return
+
+    ordered = sorted(messages, key=lambda message: message["created_at"])
+    result = await db[CONVERSATIONS_COLLECTION].bulk_write(
+        [_conversation_update(message) for message in ordered],
+        ordered=True
+    )
+    if result.upserted_ids:
+        await fill_participant_summaries(db, list(result.upserted_ids.values()))
+
+
+async def _participant_summaries(db, user_ids: Iterable[ObjectId]) -> Dict[str, dict]:
+    user_ids = list(set(user_ids))
+    projection = {"name": 1, "profile_picture": 1}
+    summaries = {}
+    for collection, role in (("clients", "client"), ("artisans", "artisan")):
+        async for user in db[collection].find({"_id": {"$in": user_ids}}, projection):
+            summaries[str(user["_id"])] = {
+                "_id": user["_id"],
+                "name": user.get("name"),
+                "profile_picture": user.get("profile_picture"),
+                "role": role
+            }
+    return summaries
+
+
+async def fill_participant_summaries(db, conversation_ids: List[ObjectId]):
+    """Denormalize participant names and pictures onto new conversations"""
+    conversations = await db[CONVERSATIONS_COLLECTION].find(
+        {"_id": {"$in": conversation_ids}},
+        {"participants": 1}
+    ).to_list(None)
+    summaries = await _participant_summaries(
+        db, (participant for conversation in conversations for participant in conversation["participants"])
+    )
+
+    updates = []
+    for conversation in conversations:
+        found = {
+            f"participant_summaries.{participant}": summaries[str(participant)]
+            for participant in conversation["participants"]
+            if str(participant) in summaries
+        }
+        if found:
+            updates.append(UpdateOne({"_id": conversation["_id"]}, {"$set": found}))
+    if updates:
+        await db[CONVERSATIONS_COLLECTION].bulk_write(updates, ordered=False)
+
+
+async def refresh_participant_summary(db, user: dict, role: str):
+    """Push a profile change into every conversation the user takes part in"""
+    await db[CONVERSATIONS_COLLECTION].update_many(
+        {"participants": user["_id"]},
+        {"$set": {f"participant_summaries.{user['_id']}": {
+            "_id": user["_id"],
+            "name": user.get("name"),
+            "profile_picture": user.get("profile_picture"),
+            "role": role
+        }}}
+    )
+
+
+async def mark_conversations_read(db, reader_id, counts_by_partner: Dict[ObjectId, int]):
+    """Decrement the reader's unread counters after messages were marked read"""
+    unread_field = f"unread.{reader_id}"
+    updates = [
+        UpdateOne(
+            {"conversation_key": conversation_key(reader_id, partner_id)},
+            [{"$set": {unread_field: {"$max": [
+                0, {"$subtract": [{"$ifNull": [f"${unread_field}", 0]}, count]}
+            ]}}}]
+        )
+        for partner_id, count in counts_by_partner.items()
+        if count
+    ]
+    if updates:
+        await db[CONVERSATIONS_COLLECTION].bulk_write(updates, ordered=False)
+
+
+async def rebuild_conversations(db):
+    """Rebuild the conversations collection from messages on the server side
+
+    Used to backfill conversations for messages written before the
+    collection existed. Safe to rerun: documents are merged on
+    conversation_key.
+    """
+    pair = {"$cond": [
+        {"$lt": ["$sender_id", "$recipient_id"]},
+        ["$sender_id", "$recipient_id"],
+        ["$recipient_id", "$sender_id"]
+    ]}
+    pipeline = [
+        {"$sort": {"created_at": 1}},
+        {"$project": {
+            "pair": pair,
+            "recipient_id": 1,
+            "read": 1,
+            "created_at": 1,
+            "last_message": {
+                "message_id": "$_id",
+                "sender_id": "$sender_id",
+                "content": {"$substrCP": ["$content", 0, LAST_MESSAGE_PREVIEW_LENGTH]},
+                "created_at": "$created_at"
+            }
+        }},
+        {"$group": {
+            "_id": "$pair",
+            "last_message": {"$last": "$last_message"},
+            "last_message_at": {"$max": "$created_at"},
+            "unread_first": {"$sum": {"$cond": [{"$and": [
+                {"$eq": ["$recipient_id", {"$arrayElemAt": ["$pair", 0]}]},
+                {"$eq": ["$read", False]}
+            ]}, 1, 0]}},
+            "unread_second": {"$sum": {"$cond": [{"$and": [
+                {"$eq": ["$recipient_id", {"$arrayElemAt": ["$pair", 1]}]},
+                {"$eq": ["$read", False]}
+            ]}, 1, 0]}}
+        }},
+        {"$project": {
+            "_id": 0,
+            "conversation_key": {"$concat": [
+                {"$toString": {"$arrayElemAt": ["$_id", 0]}},
+                ":",
+                {"$toString": {"$arrayElemAt": ["$_id", 1]}}
+            ]},
+            "participants": "$_id",
+            "last_message": 1,
+            "last_message_at": 1,
+            "unread": {"$arrayToObject": [[
+                [{"$toString": {"$arrayElemAt": ["$_id", 0]}}, "$unread_first"],
+                [{"$toString": {"$arrayElemAt": ["$_id", 1]}}, "$unread_second"]
+            ]]}
+        }},
+        {"$merge": {
+            "into": CONVERSATIONS_COLLECTION,
+            "on": "conversation_key",
+            "whenMatched": "merge",
+            "whenNotMatched": "insert"
+        }}
+    ]
+    await db["messages"].aggregate(pipeline, allowDiskUse=True).to_list(None)
+
+    missing = await db[CONVERSATIONS_COLLECTION].find(
+        {"participant_summaries": {"$exists": False}},
+        {"_id": 1}
+    ).to_list(None)
+    if missing:
+        await fill_participant_summaries(db, [conversation["_id"] for conversation in missing])
+    logging.info("Conversations rebuilt from messages")
@@ -1,12 +1,110 @@
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo.errors import ConnectionFailure
+from pymongo import IndexModel
+from pymongo.errors import ConnectionFailure, OperationFailure
+from pymongo.monitoring import ConnectionPoolListener
+from collections import Counter
+import asyncio
 import logging
-from typing import Optional
+import threading
+from typing import Dict, List, Optional
 
-async def get_db_client(mongodb_url: str) -> AsyncIOMotorClient:
-    """Create and return a MongoDB client connection"""
+
+class PoolMonitor(ConnectionPoolListener):
+    """Connection pool gauges built from the driver's pool events
+
+    The driver calls these from its own threads, hence the lock. Gauges are
+    summed over every server the client talks to.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.gauges = Counter()
+
+    def _add(self, **deltas):
+        with self._lock:
+            self.gauges.update(deltas)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add(pools_cleared_total=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add(open=1, created_total=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(open=-1, closed_total=1)
+
+    def connection_check_out_started(self, event):
+        self._add(waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._add(waiting=-1, check_out_failures_total=1)
+
+    def connection_checked_out(self, event):
+        self._add(waiting=-1, in_use=1, checked_out_total=1)
+
+    def connection_checked_in(self, event):
+        self._add(in_use=-1)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            snapshot = dict(self.gauges)
+        for gauge in ("open", "in_use", "waiting"):
+            snapshot.setdefault(gauge, 0)
+        return snapshot
+
+
+async def get_db_client(
+    mongodb_url: str,
+    max_pool_size: int = 100,
+    min_pool_size: int = 0,
+    max_idle_time_ms: Optional[int] = None,
+    connect_timeout_ms: int = 20000,
+    server_selection_timeout_ms: int = 30000,
+    socket_timeout_ms: Optional[int] = None,
+    wait_queue_timeout_ms: Optional[int] = None,
+    compressors: Optional[str] = None,
+    zlib_compression_level: int = -1,
+    app_name: Optional[str] = None,
+    pool_monitor: Optional[PoolMonitor] = None
+) -> AsyncIOMotorClient:
+    """Create a MongoDB client and check that the server answers
+
+    The client holds the connection pool, so one is meant to be shared by
+    the whole process. None leaves an option at the driver's default.
+    """
+    options = {
+        "maxPoolSize": max_pool_size,
+        "minPoolSize": min_pool_size,
+        "maxIdleTimeMS": max_idle_time_ms,
+        "connectTimeoutMS": connect_timeout_ms,
+        "serverSelectionTimeoutMS": server_selection_timeout_ms,
+        "socketTimeoutMS": socket_timeout_ms,
+        "waitQueueTimeoutMS": wait_queue_timeout_ms,
+        "appname": app_name
+    }
+    if compressors:
+        # Negotiated with the server; unsupported ones are skipped
+        options["compressors"] = compressors
+        options["zlibCompressionLevel"] = zlib_compression_level
+    if pool_monitor is not None:
+        options["event_listeners"] = [pool_monitor]
     try:
-        client = AsyncIOMotorClient(mongodb_url)
+        client = AsyncIOMotorClient(
+            mongodb_url,
+            **{name: value for name, value in options.items() if value is not None}
+        )
         await client.admin.command('ping')
         logging.info("Successfully connected to MongoDB")
         return client
@@ -14,6 +112,19 @@ async def get_db_client(mongodb_url: str) -> AsyncIOMotorClient:
         logging.error(f"Failed to connect to MongoDB: {e}")
         raise
 
+async def check_transaction_support(client: AsyncIOMotorClient):
+    """Fail fast when the server cannot run multi-document transactions
+
+    Ledger writes and payout runs are transactional, and MongoDB only
+    supports transactions on replica sets and sharded clusters.
+    """
+    hello = await client.admin.command('hello')
+    if not hello.get("setName") and hello.get("msg") != "isdbgrid":
+        raise RuntimeError(
+            "MongoDB is running standalone; the ledger needs transactions, "
+            "so use a replica set (a single-node one is enough)"
+        )
+
 async def close_db_client(client: AsyncIOMotorClient):
     """Close the MongoDB client connection"""
     try:
@@ -27,30 +138,131 @@ async def get_db(client: AsyncIOMotorClient, db_name: str):
     """Get a database instance from the client"""
     return client[db_name]
 
+# Every index the app relies on, by collection
+INDEXES: Dict[str, List[IndexModel]] = {
+    "clients": [
+        IndexModel("email", unique=True),
+    ],
+    "artisans": [
+        IndexModel("email", unique=True),
+        IndexModel([("location", "text"), ("profession", "text"), ("skills", "text")]),
+        # Search sorted by rating
+        IndexModel([("rating", -1)]),
+    ],
+    "bookings": [
+        IndexModel([("client_id", 1), ("created_at", 1)]),
+        # Booking list and dashboard, ordered by date
+        IndexModel([("client_id", 1), ("date", 1)]),
+        # Status-filtered lists and dashboard panels: equality on status, then the date order
+        IndexModel([("client_id", 1), ("status", 1), ("date", 1)]),
+        IndexModel("artisan_id"),
+        IndexModel([("status", 1), ("date", 1)]),
+    ],
+    "reviews": [
+        IndexModel([("artisan_id", 1), ("created_at", -1), ("_id", -1)]),
+        IndexModel("booking_id", unique=True),
+    ],
+    "payments": [
+        IndexModel([("client_id", 1), ("created_at", 1)]),
+        IndexModel("artisan_id"),
+        IndexModel("booking_id"),
+        # At most one completed payment per booking. Keyed on (booking_id, status)
+        # rather than booking_id alone so it never clashes with the plain index above.
+        IndexModel(
+            [("booking_id", 1), ("status", 1)],
+            unique=True,
+            partialFilterExpression={"status": "completed"},
+            name="booking_id_status_completed_unique"
+        ),
+        IndexModel("transaction_id"),
+    ],
+    # Payout ledger: one entry per (reference, type), streamed unsettled by artisan
+    "ledger_entries": [
+        IndexModel(
+            [("reference_id", 1), ("entry_type", 1)],
+            unique=True,
+            partialFilterExpression={"reference_id": {"$type": "string"}}
+        ),
+        IndexModel([("payout_id", 1), ("artisan_id", 1), ("currency", 1), ("_id", 1)]),
+        IndexModel([("artisan_id", 1), ("created_at", -1)]),
+    ],
+    "artisan_balances": [
+        IndexModel([("artisan_id", 1), ("currency", 1)], unique=True),
+    ],
+    # Payment webhook queue; delivery records are kept a month for dedup
+    "payment_webhook_events": [
+        IndexModel([("status", 1), ("received_at", 1)]),
+        IndexModel("received_at", expireAfterSeconds=30 * 86400),
+    ],
+    # Email outbox; sent emails are kept a week, dead letters until someone deals with them
+    "email_outbox": [
+        IndexModel([("status", 1), ("next_attempt_at", 1)]),
+        IndexModel("sent_at", expireAfterSeconds=7 * 86400),
+    ],
+    # Idempotency keys for payment creation, expired after a day
+    "idempotency_keys": [
+        IndexModel("created_at", expireAfterSeconds=86400),
+    ],
+    "messages": [
+        IndexModel([("sender_id", 1), ("recipient_id", 1)]),
+        # With the recipient index below, lets the inbox $or merge both sides in date order
+        IndexModel([("sender_id", 1), ("created_at", 1), ("_id", 1)]),
+        # Reconnect replay reads each user's inbox past a cursor
+        IndexModel([("recipient_id", 1), ("created_at", 1), ("_id", 1)]),
+        # Thread history is one range scan on the canonical participant pair
+        IndexModel([("conversation_key", 1), ("created_at", -1), ("_id", -1)]),
+    ],
+    # Materialized conversation list, one document per participant pair
+    "conversations": [
+        IndexModel("conversation_key", unique=True),
+        IndexModel([("participants", 1), ("last_message_at", -1), ("_id", -1)]),
+    ],
+    "notifications": [
+        IndexModel([("user_id", 1), ("created_at", 1), ("_id", 1)]),
+        IndexModel("created_at", expireAfterSeconds=90 * 86400),
+        # Digest passes walk one channel's pending notifications user by user
+        IndexModel([("pending_channels", 1), ("user_id", 1), ("created_at", 1)]),
+    ],
+    # Moderation reports, one per reporter and message
+    "reports": [
+        IndexModel([("message_id", 1), ("reporter_id", 1)], unique=True),
+    ],
+    # Cross-worker WebSocket fan-out events only need to live long enough to be tailed
+    "ws_events": [
+        IndexModel("created_at", expireAfterSeconds=60),
+    ],
+}
+
 async def create_indexes(db):
-    """Create necessary indexes for optimal query performance"""
-    # Client indexes
-    await db.clients.create_index("email", unique=True)
-    
-    # Artisan indexes
-    await db.artisans.create_index("email", unique=True)
-    await db.artisans.create_index([("location", "text"), ("profession", "text"), ("skills", "text")])
-    
-    # Booking indexes
-    await db.bookings.create_index("client_id")
-    await db.bookings.create_index("artisan_id")
-    await db.bookings.create_index([("status", 1), ("date", 1)])
-    
-    # Review indexes
-    await db.reviews.create_index("artisan_id")
-    await db.reviews.create_index("booking_id", unique=True)
-    
-    # Payment indexes
-    await db.payments.create_index("client_id")
-    await db.payments.create_index("artisan_id")
-    await db.payments.create_index("booking_id")
-    
-    # Message indexes
-    await db.messages.create_index([("sender_id", 1), ("recipient_id", 1)])
-    
-    logging.info("Database indexes created successfully")
\ No newline at end of file
+    """Create necessary indexes for optimal query performance
+
+    Safe to run on every startup: indexes that already exist are left
+    alone by the server. Each collection's indexes go in one createIndexes
+    command and collections are done concurrently. If that command fails,
+    for instance because an index's options changed or existing documents
+    violate a new unique index, the collection's indexes are retried one
+    at a time, so only the failing index is skipped and logged.
+    """
+    async def create_one(collection: str, model: IndexModel) -> bool:
+        try:
+            await db[collection].create_indexes([model])
+            return True
+        except OperationFailure as e:
+            logging.error(f"Could not create index {model.document['name']} on {collection}: {e}")
+            return False
+
+    async def sync(collection: str, models: List[IndexModel]) -> int:
+        try:
+            await db[collection].create_indexes(models)
+            return 0
+        except OperationFailure as e:
+            logging.warning(f"Index sync on {collection} failed ({e}); retrying index by index")
+        results = [await create_one(collection, model) for model in models]
+        return results.count(False)
+
+    failures = await asyncio.gather(*(sync(collection, models) for collection, models in INDEXES.items()))
+    failed = sum(failures)
+    if failed:
+        logging.warning(f"Database indexes synced with {failed} index(es) failing")
+    else:
+        logging.info("Database indexes created successfully")
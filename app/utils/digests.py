@@ -0,0 +1,211 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import logging
+import os
+import socket
+
+from pymongo.errors import DuplicateKeyError
+
+from .email import send_notification_digest_email
+from .notifications import NOTIFICATIONS_COLLECTION
+
+DIGEST_LOCKS_COLLECTION = "digest_locks"
+
+# Mirrors the ClientBase default; artisans have no preferences stored
+DEFAULT_NOTIFICATION_PREFERENCES = {"email": True, "sms": False, "push": True}
+
+
+class DigestWorker:
+    """Turn pending notifications into one message per user, channel and window
+
+    Notifications are stamped with the digest channels they are pending
+    for. Every poll_interval each channel is processed in one cursor pass
+    over its pending notifications, ordered by user, so each user's batch
+    is complete as soon as the cursor moves past them. A user gets a
+    digest once their oldest pending notification is a full window old;
+    notifications they have already read are dropped from it, and users
+    who switched the channel off in notification_preferences are skipped.
+    A lease per channel keeps several app workers from sending the same
+    digests; it is renewed before each chunk of users is sent, and a pass
+    that has lost it stops. Only channels with a sender can be given a
+    window, and NotificationService should queue notifications for exactly
+    those channels.
+    """
+
+    def __init__(
+        self,
+        app,
+        windows: Dict[str, float],
+        poll_interval: float = 60.0,
+        batch_size: int = 1000,
+        user_chunk: int = 200,
+        lease_seconds: float = 300.0
+    ):
+        self.app = app
+        # channel -> window length in seconds
+        self.windows = windows
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.user_chunk = user_chunk
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._task: Optional[asyncio.Task] = None
+        self.senders = {"email": self._send_email}
+        missing = sorted(set(windows) - set(self.senders))
+        if missing:
+            raise ValueError(f"No digest sender for channels: {', '.join(missing)}")
+
+    @property
+    def channels(self) -> List[str]:
+        """The channels this worker sends digests on"""
+        return list(self.windows)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            for channel in self.windows:
+                try:
+                    await self.run_channel(channel)
+                except Exception as e:
+                    logging.error(f"Notification digest error on {channel}: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _acquire(self, db, channel: str) -> bool:
+        now = datetime.now()
+        try:
+            await db[DIGEST_LOCKS_COLLECTION].find_one_and_update(
+                {"_id": channel, "$or": [{"locked_until": None}, {"locked_until": {"$lt": now}}]},
+                {"$set": {
+                    "locked_until": now + timedelta(seconds=self.lease_seconds),
+                    "locked_by": self.worker_id
+                }},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Someone else holds an unexpired lease
+            return False
+        return True
+
+    async def _renew(self, db, channel: str) -> bool:
+        """Extend this worker's lease; False once another worker has taken it over"""
+        result = await db[DIGEST_LOCKS_COLLECTION].update_one(
+            {"_id": channel, "locked_by": self.worker_id},
+            {"$set": {"locked_until": datetime.now() + timedelta(seconds=self.lease_seconds)}}
+        )
+        if not result.matched_count:
+            logging.warning(f"Lost the {channel} digest lease; stopping this pass")
+            return False
+        return True
+
+    async def _release(self, db, channel: str):
+        await db[DIGEST_LOCKS_COLLECTION].update_one(
+            {"_id": channel, "locked_by": self.worker_id},
+            {"$set": {"locked_until": None}}
+        )
+
+    async def run_channel(self, channel: str) -> int:
+        """Send every digest that is due on a channel; returns how many were sent"""
+        db = self.app.mongodb
+        if not await self._acquire(db, channel):
+            return 0
+
+        sent = 0
+        try:
+            now = datetime.now()
+            due_before = now - timedelta(seconds=self.windows[channel])
+            ready: List[Tuple[object, List[dict]]] = []
+            current_user = None
+            items: List[dict] = []
+            lease_held = True
+
+            cursor = db[NOTIFICATIONS_COLLECTION].find(
+                {"pending_channels": channel, "created_at": {"$lt": now}},
+                {"user_id": 1, "type": 1, "message": 1, "read": 1, "created_at": 1}
+            ).sort([("user_id", 1), ("created_at", 1)]).batch_size(self.batch_size)
+
+            async for notification in cursor:
+                if notification["user_id"] != current_user:
+                    if items and items[0]["created_at"] <= due_before:
+                        ready.append((current_user, items))
+                    current_user, items = notification["user_id"], []
+                    if len(ready) >= self.user_chunk:
+                        lease_held = await self._renew(db, channel)
+                        if not lease_held:
+                            break
+                        sent += await self._deliver(db, channel, ready)
+                        ready = []
+                items.append(notification)
+
+            if lease_held:
+                if items and items[0]["created_at"] <= due_before:
+                    ready.append((current_user, items))
+                if ready and await self._renew(db, channel):
+                    sent += await self._deliver(db, channel, ready)
+        finally:
+            await self._release(db, channel)
+
+        if sent:
+            logging.info(f"Sent {sent} {channel} notification digests")
+        return sent
+
+    async def _load_recipients(self, db, user_ids: list) -> Dict[object, dict]:
+        projection = {"name": 1, "email": 1, "notification_preferences": 1}
+        recipients = {}
+        for collection in ("clients", "artisans"):
+            async for user in db[collection].find({"_id": {"$in": user_ids}}, projection):
+                recipients[user["_id"]] = user
+        return recipients
+
+    async def _deliver(self, db, channel: str, ready: List[Tuple[object, List[dict]]]) -> int:
+        """Send one chunk of users' digests and clear what was handled from the pending set"""
+        recipients = await self._load_recipients(db, [user_id for user_id, _ in ready])
+
+        handled: List[object] = []
+        sends = []
+        for user_id, items in ready:
+            user = recipients.get(user_id)
+            preferences = {**DEFAULT_NOTIFICATION_PREFERENCES, **((user or {}).get("notification_preferences") or {})}
+            unread = [item for item in items if not item.get("read")]
+            if user is None or not preferences.get(channel) or not unread:
+                # Nothing to send, ever: stop considering these notifications
+                handled.extend(item["_id"] for item in items)
+                continue
+            sends.append((items, self.senders[channel](user, unread)))
+
+        results = await asyncio.gather(*(send for _, send in sends), return_exceptions=True)
+        sent = 0
+        for (items, _), result in zip(sends, results):
+            if isinstance(result, Exception):
+                # Left pending, so the next pass retries them
+                logging.error(f"Failed to send {channel} digest: {result}")
+                continue
+            sent += 1
+            handled.extend(item["_id"] for item in items)
+
+        if handled:
+            await db[NOTIFICATIONS_COLLECTION].update_many(
+                {"_id": {"$in": handled}},
+                {"$pull": {"pending_channels": channel}}
+            )
+        return sent
+
+    async def _send_email(self, user: dict, notifications: List[dict]):
+        # Queued in the email outbox, which owns delivery retries from here
+        await send_notification_digest_email(
+            self.app.mongodb,
+            user["email"],
+            user.get("name", ""),
+            notifications,
+            self.app.settings.FRONTEND_URL
+        )
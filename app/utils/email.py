@@ -1,10 +1,10 @@
-import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from pathlib import Path
-from jinja2 import Template
 import logging
-from fastapi import BackgroundTasks
+
+from .email_outbox import enqueue_email
+from .email_templates import email_templates
+from .smtp import get_smtp_pool
 
 async def send_email(
     recipient_email: str, 
@@ -15,7 +15,7 @@ async def send_email(
     smtp_username: str,
     smtp_password: str
 ):
-    """Send an email using SMTP"""
+    """Send an email over a pooled, already-authenticated SMTP connection"""
     message = MIMEMultipart()
     message["From"] = smtp_username
     message["To"] = recipient_email
@@ -23,98 +23,66 @@ async def send_email(
     message.attach(MIMEText(body, "html"))
     
     try:
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_username, smtp_password)
-            server.send_message(message)
+        pool = get_smtp_pool(smtp_server, smtp_port, smtp_username, smtp_password)
+        await pool.send(message)
         logging.info(f"Email sent to {recipient_email}")
     except Exception as e:
         logging.error(f"Failed to send email to {recipient_email}: {e}")
         raise
 
 async def send_registration_email(
+    db,
     email: str, 
     name: str, 
-    frontend_url: str,
-    background_tasks: BackgroundTasks,
-    smtp_server: str,
-    smtp_port: int,
-    smtp_username: str,
-    smtp_password: str
+    frontend_url: str
 ):
-    """Send a registration confirmation email"""
-    template_path = Path(__file__).parent.parent / "templates/email/registration.html"
-    with open(template_path) as file:
-        template = Template(file.read())
-    
+    """Queue a registration confirmation email"""
     subject = "Welcome to Artisan Booking System"
-    body = template.render(name=name, frontend_url=frontend_url)
+    body = await email_templates.render("registration.html", name=name, frontend_url=frontend_url)
     
-    background_tasks.add_task(
-        send_email,
-        recipient_email=email,
-        subject=subject,
-        body=body,
-        smtp_server=smtp_server,
-        smtp_port=smtp_port,
-        smtp_username=smtp_username,
-        smtp_password=smtp_password
-    )
+    await enqueue_email(db, email, subject, body, kind="registration")
 
 async def send_password_reset_email(
+    db,
     email: str, 
     name: str, 
-    reset_url: str,
-    background_tasks: BackgroundTasks,
-    smtp_server: str,
-    smtp_port: int,
-    smtp_username: str,
-    smtp_password: str
+    reset_url: str
 ):
-    """Send a password reset email"""
-    template_path = Path(__file__).parent.parent / "templates/email/password_reset.html"
-    with open(template_path) as file:
-        template = Template(file.read())
-    
+    """Queue a password reset email"""
     subject = "Password Reset Request"
-    body = template.render(name=name, reset_url=reset_url)
+    body = await email_templates.render("password_reset.html", name=name, reset_url=reset_url)
     
-    background_tasks.add_task(
-        send_email,
-        recipient_email=email,
-        subject=subject,
-        body=body,
-        smtp_server=smtp_server,
-        smtp_port=smtp_port,
-        smtp_username=smtp_username,
-        smtp_password=smtp_password
-    )
+    await enqueue_email(db, email, subject, body, kind="password_reset")
 
 async def send_booking_confirmation_email(
+    db,
     email: str, 
     name: str, 
-    booking_details: dict,
-    background_tasks: BackgroundTasks,
-    smtp_server: str,
-    smtp_port: int,
-    smtp_username: str,
-    smtp_password: str
+    booking_details: dict
 ):
-    """Send a booking confirmation email"""
-    template_path = Path(__file__).parent.parent / "templates/email/booking_confirmation.html"
-    with open(template_path) as file:
-        template = Template(file.read())
-    
+    """Queue a booking confirmation email"""
     subject = "Your Booking Confirmation"
-    body = template.render(name=name, booking_details=booking_details)
+    body = await email_templates.render("booking_confirmation.html", name=name, booking_details=booking_details)
+    
+    await enqueue_email(db, email, subject, body, kind="booking_confirmation")
+
+async def send_notification_digest_email(
+    db,
+    email: str,
+    name: str,
+    notifications: list,
+    frontend_url: str,
+    max_items: int = 20
+):
+    """Queue one email summarising a user's pending notifications"""
+    count = len(notifications)
+    subject = f"You have {count} new notification{'s' if count != 1 else ''}"
+    body = await email_templates.render(
+        "notification_digest.html",
+        name=name,
+        notifications=notifications[:max_items],
+        remaining=max(0, count - max_items),
+        frontend_url=frontend_url
+    )
     
-    background_tasks.add_task(
-        send_email,
-        recipient_email=email,
-        subject=subject,
-        body=body,
-        smtp_server=smtp_server,
-        smtp_port=smtp_port,
-        smtp_username=smtp_username,
-        smtp_password=smtp_password
-    )
\ No newline at end of file
+    await enqueue_email(db, email, subject, body, kind="notification_digest")
@@ -0,0 +1,229 @@
+from datetime import datetime, timedelta
+from typing import List, Optional, Set
+import asyncio
+import logging
+import os
+import random
+import socket
+
+import aiosmtplib
+from pymongo import UpdateOne
+
+EMAIL_OUTBOX_COLLECTION = "email_outbox"
+
+# Running workers in this process, woken as soon as an email is queued
+_workers: Set["EmailOutboxWorker"] = set()
+
+
+async def enqueue_email(db, recipient_email: str, subject: str, body: str, kind: Optional[str] = None):
+    """Durably queue an email for the outbox worker; the only write a request makes"""
+    now = datetime.now()
+    result = await db[EMAIL_OUTBOX_COLLECTION].insert_one({
+        "recipient_email": recipient_email,
+        "subject": subject,
+        "body": body,
+        "kind": kind,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "locked_until": None,
+        "created_at": now
+    })
+    # Send now rather than at the next poll; other processes still find it by polling
+    for worker in _workers:
+        worker.notify()
+    return result.inserted_id
+
+
+class LeaseLost(Exception):
+    """Raised when another worker has taken over an email this one claimed"""
+
+
+def is_permanent_failure(error: Exception) -> bool:
+    """5xx replies mean the server will never accept this message; retrying is pointless"""
+    if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return all(500 <= refused.code < 600 for refused in error.recipients)
+    return isinstance(error, aiosmtplib.SMTPResponseException) and 500 <= error.code < 600
+
+
+class EmailOutboxWorker:
+    """Send queued emails in batches over the pooled SMTP connections
+
+    Emails are claimed with a lease so several workers (or a restarted one)
+    can share the outbox; an email whose lease expires is picked up again.
+    At most send_concurrency emails are sent at once, and each one's lease
+    is renewed just before it is sent, so an email queued behind slow SMTP
+    sends is skipped rather than sent twice if another worker took it over.
+    A failed send is retried with exponential backoff and jitter. After
+    max_attempts, or straight away on a permanent (5xx) rejection, the
+    email is dead-lettered: left in the outbox with status "dead" and the
+    last error, for someone to look at.
+    """
+
+    def __init__(
+        self,
+        app,
+        batch_size: int = 100,
+        poll_interval: float = 1.0,
+        lease_seconds: float = 300.0,
+        max_attempts: int = 8,
+        retry_base: float = 30.0,
+        retry_max: float = 3600.0,
+        send_concurrency: int = 4
+    ):
+        self.app = app
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._send_slots = asyncio.Semaphore(send_concurrency)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        _workers.add(self)
+
+    async def stop(self):
+        _workers.discard(self)
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def notify(self):
+        """Wake the worker early after an email is enqueued"""
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                drained = await self.drain_once()
+            except Exception as e:
+                logging.error(f"Email outbox worker error: {e}")
+                drained = 0
+
+            if drained < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def _claim_batch(self, db) -> List[dict]:
+        now = datetime.now()
+        claimable = {
+            "status": "pending",
+            "next_attempt_at": {"$lte": now},
+            "$or": [{"locked_until": None}, {"locked_until": {"$lt": now}}]
+        }
+
+        candidates = await db[EMAIL_OUTBOX_COLLECTION].find(claimable, {"_id": 1}) \
+            .sort("next_attempt_at", 1) \
+            .limit(self.batch_size) \
+            .to_list(self.batch_size)
+        if not candidates:
+            return []
+
+        lease = now + timedelta(seconds=self.lease_seconds)
+        ids = [candidate["_id"] for candidate in candidates]
+        await db[EMAIL_OUTBOX_COLLECTION].update_many(
+            {"_id": {"$in": ids}, **claimable},
+            {"$set": {"locked_until": lease, "locked_by": self.worker_id}, "$inc": {"attempts": 1}}
+        )
+
+        # Only the emails this worker actually won
+        return await db[EMAIL_OUTBOX_COLLECTION].find(
+            {"_id": {"$in": ids}, "locked_by": self.worker_id, "locked_until": lease}
+        ).to_list(None)
+
+    def retry_delay(self, attempts: int) -> float:
+        delay = min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+        # Jitter keeps a relay outage from turning into synchronized retry waves
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _send(self, email: dict):
+        # Imported here; the email helpers import this module to enqueue
+        from .email import send_email
+
+        settings = self.app.settings
+        await send_email(
+            recipient_email=email["recipient_email"],
+            subject=email["subject"],
+            body=email["body"],
+            smtp_server=settings.SMTP_SERVER,
+            smtp_port=settings.SMTP_PORT,
+            smtp_username=settings.SMTP_USERNAME,
+            smtp_password=settings.SMTP_PASSWORD
+        )
+
+    async def _send_leased(self, db, email: dict):
+        async with self._send_slots:
+            renewed = await db[EMAIL_OUTBOX_COLLECTION].update_one(
+                {"_id": email["_id"], "status": "pending", "locked_by": self.worker_id},
+                {"$set": {"locked_until": datetime.now() + timedelta(seconds=self.lease_seconds)}}
+            )
+            if not renewed.matched_count:
+                raise LeaseLost(f"Email {email['_id']} was claimed by another worker")
+            await self._send(email)
+
+    async def drain_once(self) -> int:
+        """Claim, send and settle one batch; returns the number of emails claimed"""
+        db = self.app.mongodb
+        emails = await self._claim_batch(db)
+        if not emails:
+            return 0
+
+        results = await asyncio.gather(
+            *(self._send_leased(db, email) for email in emails), return_exceptions=True
+        )
+
+        now = datetime.now()
+        sent_ids = []
+        updates = []
+        dead = 0
+        skipped = 0
+        for email, result in zip(emails, results):
+            if not isinstance(result, Exception):
+                sent_ids.append(email["_id"])
+                continue
+            if isinstance(result, LeaseLost):
+                # The worker that took it over settles it
+                skipped += 1
+                continue
+            error = f"{type(result).__name__}: {result}"
+            if email["attempts"] >= self.max_attempts or is_permanent_failure(result):
+                dead += 1
+                updates.append(UpdateOne(
+                    {"_id": email["_id"], "locked_by": self.worker_id},
+                    {"$set": {"status": "dead", "last_error": error, "dead_at": now, "locked_until": None}}
+                ))
+            else:
+                updates.append(UpdateOne(
+                    {"_id": email["_id"], "locked_by": self.worker_id},
+                    {"$set": {
+                        "last_error": error,
+                        "next_attempt_at": now + timedelta(seconds=self.retry_delay(email["attempts"])),
+                        "locked_until": None
+                    }}
+                ))
+
+        if sent_ids:
+            await db[EMAIL_OUTBOX_COLLECTION].update_many(
+                {"_id": {"$in": sent_ids}},
+                {"$set": {"status": "sent", "sent_at": now, "locked_until": None}}
+            )
+        if updates:
+            await db[EMAIL_OUTBOX_COLLECTION].bulk_write(updates, ordered=False)
+
+        failed = len(emails) - len(sent_ids) - skipped
+        logging.info(
+            f"Sent {len(sent_ids)} queued emails ({failed} failed, {dead} dead-lettered, "
+            f"{skipped} taken over by another worker)"
+        )
+        return len(emails)
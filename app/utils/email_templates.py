@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+import asyncio
+import logging
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template, select_autoescape
+
+EMAIL_TEMPLATE_DIR = Path(__file__).parent.parent / "templates/email"
+
+
+class EmailTemplateRegistry:
+    """Every email template compiled once and kept in memory
+
+    load() compiles all templates/email/*.html up front, so rendering never
+    touches the disk. The compiled bytecode is also cached on disk, which
+    lets later workers and restarts skip parsing. With auto_reload a
+    template is recompiled when its file changes; that costs a stat per
+    render and is meant for development. Templates whose source is at least
+    thread_threshold bytes are rendered on a small thread pool instead of
+    the event loop.
+    """
+
+    def __init__(self, directory: Path = EMAIL_TEMPLATE_DIR):
+        self.directory = directory
+        self.environment: Optional[Environment] = None
+        self._templates: Dict[str, Template] = {}
+        self._large: set = set()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def load(
+        self,
+        auto_reload: bool = False,
+        bytecode_cache_dir: Optional[str] = None,
+        thread_threshold: int = 16384,
+        render_threads: int = 2
+    ):
+        cache_kwargs = {"directory": bytecode_cache_dir} if bytecode_cache_dir else {}
+        if bytecode_cache_dir:
+            Path(bytecode_cache_dir).mkdir(parents=True, exist_ok=True)
+        self.environment = Environment(
+            loader=FileSystemLoader(str(self.directory)),
+            autoescape=select_autoescape(["html"]),
+            auto_reload=auto_reload,
+            bytecode_cache=FileSystemBytecodeCache(**cache_kwargs),
+            cache_size=-1
+        )
+        self._templates = {}
+        self._large = set()
+        for name in self.environment.list_templates(extensions=["html"]):
+            self._templates[name] = self.environment.get_template(name)
+            if (self.directory / name).stat().st_size >= thread_threshold:
+                self._large.add(name)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=render_threads, thread_name_prefix="email-render")
+        logging.info(f"Compiled {len(self._templates)} email templates")
+
+    def get(self, name: str) -> Template:
+        if self.environment is None:
+            # Scripts and workers that never ran the app lifespan
+            self.load()
+        if self.environment.auto_reload:
+            # get_template recompiles when the file has changed
+            return self.environment.get_template(name)
+        template = self._templates.get(name)
+        if template is None:
+            template = self._templates[name] = self.environment.get_template(name)
+        return template
+
+    async def render(self, template_name: str, **context) -> str:
+        template = self.get(template_name)
+        if template_name in self._large:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, lambda: template.render(**context))
+        return template.render(**context)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+email_templates = EmailTemplateRegistry()
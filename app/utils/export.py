@@ -0,0 +1,78 @@
+from datetime import datetime
+from typing import AsyncIterator, List, Optional
+import csv
+import io
+import json
+
+from bson import ObjectId
+from fastapi.responses import StreamingResponse
+
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+# Rows buffered before each chunk is yielded to the client
+EXPORT_CHUNK_ROWS = 200
+
+
+def _export_value(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    elif isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+async def _stream_rows(cursor, fields: List[str], fmt: str) -> AsyncIterator[str]:
+    """Serialize documents from a cursor incrementally, holding one chunk in memory at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == "csv" else None
+    if writer:
+        writer.writerow(fields)
+
+    rows = 0
+    async for document in cursor:
+        values = [_export_value(document.get(field)) for field in fields]
+        if writer:
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip(fields, values))))
+            buffer.write("\n")
+
+        rows += 1
+        if rows % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def created_at_range(start: Optional[datetime], end: Optional[datetime]) -> dict:
+    """Build a created_at filter for an optional [start, end) range"""
+    date_range = {}
+    if start:
+        date_range["$gte"] = start
+    if end:
+        date_range["$lt"] = end
+    return {"created_at": date_range} if date_range else {}
+
+
+def export_response(collection, query: dict, fields: List[str], fmt: str,
+                    filename: str, batch_size: int = 500) -> StreamingResponse:
+    """Stream the documents matching query as CSV or NDJSON, oldest first"""
+    projection = {field: 1 for field in fields}
+    if "_id" not in fields:
+        projection["_id"] = 0
+
+    cursor = collection.find(query, projection) \
+        .sort("created_at", 1) \
+        .batch_size(batch_size)
+
+    return StreamingResponse(
+        _stream_rows(cursor, fields, fmt),
+        media_type=EXPORT_MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'}
+    )
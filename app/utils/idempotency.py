@@ -0,0 +1,79 @@
+from datetime import datetime
+from typing import Optional
+import asyncio
+import hashlib
+import json
+import logging
+import time
+
+from pymongo.errors import DuplicateKeyError
+
+IDEMPOTENCY_COLLECTION = "idempotency_keys"
+
+
+class IdempotencyConflict(Exception):
+    """Raised when an idempotency key cannot be honoured for this request"""
+
+
+def request_fingerprint(payload: dict) -> str:
+    """Stable hash of a request body, used to reject a key reused for a different request"""
+    encoded = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+async def claim_idempotency_key(
+    db,
+    scope: str,
+    key: str,
+    fingerprint: str,
+    wait_timeout: float = 10.0
+) -> Optional[dict]:
+    """Claim a key for this request, or return the response stored by the request that owns it
+
+    Returns None when the caller now owns the key and must do the work. When a
+    concurrent duplicate is still in flight this waits for it to finish and
+    replays its result instead of repeating the work.
+    """
+    record_id = f"{scope}:{key}"
+    deadline = time.monotonic() + wait_timeout
+    delay = 0.05
+
+    while True:
+        try:
+            await db[IDEMPOTENCY_COLLECTION].insert_one({
+                "_id": record_id,
+                "fingerprint": fingerprint,
+                "status": "in_progress",
+                "created_at": datetime.now()
+            })
+            return None
+        except DuplicateKeyError:
+            pass
+
+        record = await db[IDEMPOTENCY_COLLECTION].find_one({"_id": record_id})
+        if record is None:
+            # The first attempt failed and released the key; try to claim it again
+            continue
+        if record["fingerprint"] != fingerprint:
+            raise IdempotencyConflict("Idempotency-Key was already used for a different request")
+        if record["status"] == "completed":
+            logging.info(f"Replaying idempotent response for {record_id}")
+            return record["response"]
+        if time.monotonic() >= deadline:
+            raise IdempotencyConflict("A request with this Idempotency-Key is still in progress")
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+async def complete_idempotency_key(db, scope: str, key: str, response: dict):
+    """Store the response so later duplicates replay it"""
+    await db[IDEMPOTENCY_COLLECTION].update_one(
+        {"_id": f"{scope}:{key}"},
+        {"$set": {"status": "completed", "response": response, "completed_at": datetime.now()}}
+    )
+
+
+async def release_idempotency_key(db, scope: str, key: str):
+    """Forget an in-flight key after a failure so the client can retry with it"""
+    await db[IDEMPOTENCY_COLLECTION].delete_one({"_id": f"{scope}:{key}", "status": "in_progress"})
@@ -0,0 +1,212 @@
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, List, Optional
+import logging
+import uuid
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+LEDGER_COLLECTION = "ledger_entries"
+BALANCES_COLLECTION = "artisan_balances"
+
+
+class PayoutConflict(Exception):
+    """Raised when entries picked for a payout were settled by another run"""
+
+# Currencies whose smallest unit is the major unit
+ZERO_DECIMAL_CURRENCIES = {"BIF", "CLP", "DJF", "GNF", "JPY", "KMF", "KRW", "MGA",
+                           "PYG", "RWF", "UGX", "VND", "VUV", "XAF", "XOF", "XPF"}
+
+# Signs applied to entry amounts so a balance is always the plain sum
+ENTRY_SIGNS = {"charge": 1, "refund": -1, "fee": -1, "payout": -1}
+
+
+def to_minor_units(amount: float, currency: str = "USD") -> int:
+    """Convert a major-unit amount to integer minor units (e.g. dollars to cents)"""
+    exponent = 0 if currency.upper() in ZERO_DECIMAL_CURRENCIES else 2
+    return int((Decimal(str(amount)) * (10 ** exponent)).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def _ledger_entry(artisan_id, entry_type: str, amount_minor: int, currency: str,
+                  reference_id: Optional[str], payout_id: Optional[str] = None) -> dict:
+    return {
+        "artisan_id": artisan_id,
+        "entry_type": entry_type,
+        "amount_minor": ENTRY_SIGNS[entry_type] * abs(amount_minor),
+        "currency": currency.upper(),
+        "reference_id": reference_id,
+        "payout_id": payout_id,
+        "created_at": datetime.now()
+    }
+
+
+async def record_ledger_entries(db, entries: List[dict]) -> bool:
+    """Append entries and apply them to the artisans' running balances in one transaction
+
+    Each entry is a dict with artisan_id, entry_type, amount_minor, currency
+    and reference_id. Returns False without changing anything when an entry
+    with the same (reference_id, entry_type) was already recorded, so callers
+    can safely retry.
+    """
+    documents = [
+        _ledger_entry(
+            entry["artisan_id"],
+            entry["entry_type"],
+            entry["amount_minor"],
+            entry.get("currency", "USD"),
+            entry.get("reference_id")
+        )
+        for entry in entries
+    ]
+
+    deltas: Dict[tuple, int] = {}
+    for document in documents:
+        key = (document["artisan_id"], document["currency"])
+        deltas[key] = deltas.get(key, 0) + document["amount_minor"]
+
+    inserted = False
+    async with await db.client.start_session() as session:
+        try:
+            async with session.start_transaction():
+                await db[LEDGER_COLLECTION].insert_many(documents, session=session)
+                inserted = True
+                await _apply_balance_deltas(db, deltas, session)
+        except BulkWriteError as e:
+            # insert_many reports duplicate keys as a BulkWriteError; anything else is a real failure
+            if inserted or not _only_duplicate_keys(e):
+                raise
+            logging.info("Ledger entries already recorded; skipping")
+            return False
+    return True
+
+
+def _only_duplicate_keys(error: BulkWriteError) -> bool:
+    write_errors = error.details.get("writeErrors", [])
+    return bool(write_errors) and all(write_error.get("code") == 11000 for write_error in write_errors)
+
+
+async def record_ledger_entry(db, artisan_id, entry_type: str, amount_minor: int,
+                              currency: str = "USD", reference_id: Optional[str] = None) -> bool:
+    """Append a single entry and update the artisan's balance atomically"""
+    return await record_ledger_entries(db, [{
+        "artisan_id": artisan_id,
+        "entry_type": entry_type,
+        "amount_minor": amount_minor,
+        "currency": currency,
+        "reference_id": reference_id
+    }])
+
+
+async def _apply_balance_deltas(db, deltas: Dict[tuple, int], session):
+    now = datetime.now()
+    await db[BALANCES_COLLECTION].bulk_write([
+        UpdateOne(
+            {"artisan_id": artisan_id, "currency": currency},
+            {"$inc": {"balance_minor": delta}, "$set": {"updated_at": now}},
+            upsert=True
+        )
+        for (artisan_id, currency), delta in deltas.items()
+    ], ordered=False, session=session)
+
+
+async def get_artisan_balances(db, artisan_id) -> List[dict]:
+    """Current balances for an artisan, one per currency, read from the pre-aggregated documents"""
+    return await db[BALANCES_COLLECTION].find(
+        {"artisan_id": artisan_id},
+        {"_id": 0, "currency": 1, "balance_minor": 1, "updated_at": 1}
+    ).to_list(None)
+
+
+async def run_payouts(db, min_payout_minor: int = 1, batch_size: int = 1000,
+                      settle_chunk: int = 500) -> dict:
+    """Settle every artisan's unsettled ledger entries in one streaming pass
+
+    Unsettled entries are read with a single cursor ordered by artisan and
+    currency, so each artisan's total is known as soon as the cursor moves
+    past them. Settlements are written in chunks, each chunk in one
+    transaction: settled marks, payout entries and balance decrements.
+    Entries are settled by their exact _id; a chunk some of whose entries
+    another run settled first is rolled back and left for the next run.
+    """
+    payout_id = f"payout_{datetime.now():%Y%m%d%H%M%S}_{uuid.uuid4().hex[:8]}"
+    cutoff = datetime.now()
+    summary = {"payout_id": payout_id, "artisans": 0, "amount_minor": 0, "skipped": 0}
+
+    pending: List[dict] = []
+    current_key = None
+    current_total = 0
+    current_ids: List = []
+
+    async def settle(chunk: List[dict]):
+        try:
+            async with await db.client.start_session() as session:
+                async with session.start_transaction():
+                    await _settle_chunk(db, chunk, payout_id, session)
+        except PayoutConflict as e:
+            logging.warning(f"Payout run {payout_id} skipped {len(chunk)} balances: {e}")
+            summary["skipped"] += len(chunk)
+            return
+        summary["artisans"] += len(chunk)
+        summary["amount_minor"] += sum(item["amount_minor"] for item in chunk)
+
+    def close_group():
+        if current_key is not None and current_total >= min_payout_minor:
+            pending.append({
+                "artisan_id": current_key[0],
+                "currency": current_key[1],
+                "amount_minor": current_total,
+                "entry_ids": current_ids
+            })
+
+    cursor = db[LEDGER_COLLECTION].find(
+        {"payout_id": None, "created_at": {"$lt": cutoff}},
+        {"artisan_id": 1, "currency": 1, "amount_minor": 1}
+    ).sort([("artisan_id", 1), ("currency", 1), ("_id", 1)]).batch_size(batch_size)
+
+    async for entry in cursor:
+        key = (entry["artisan_id"], entry["currency"])
+        if key != current_key:
+            close_group()
+            current_key, current_total, current_ids = key, 0, []
+            if len(pending) >= settle_chunk:
+                await settle(pending)
+                pending = []
+        current_total += entry["amount_minor"]
+        current_ids.append(entry["_id"])
+
+    close_group()
+    if pending:
+        await settle(pending)
+
+    logging.info(
+        f"Payout run {payout_id} settled {summary['artisans']} balances "
+        f"totalling {summary['amount_minor']} minor units"
+    )
+    return summary
+
+
+async def _settle_chunk(db, chunk: List[dict], payout_id: str, session):
+    entry_ids = [entry_id for item in chunk for entry_id in item["entry_ids"]]
+    result = await db[LEDGER_COLLECTION].update_many(
+        {"_id": {"$in": entry_ids}, "payout_id": None},
+        {"$set": {"payout_id": payout_id}},
+        session=session
+    )
+    if result.modified_count != len(entry_ids):
+        # Raising aborts the transaction, so nothing in the chunk is paid out
+        raise PayoutConflict(
+            f"{len(entry_ids) - result.modified_count} of {len(entry_ids)} entries were already settled"
+        )
+    await db[LEDGER_COLLECTION].insert_many([
+        _ledger_entry(
+            item["artisan_id"], "payout", item["amount_minor"], item["currency"],
+            reference_id=f"{payout_id}:{item['artisan_id']}:{item['currency']}",
+            payout_id=payout_id
+        )
+        for item in chunk
+    ], session=session)
+    await _apply_balance_deltas(db, {
+        (item["artisan_id"], item["currency"]): -item["amount_minor"]
+        for item in chunk
+    }, session)
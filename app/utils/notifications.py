@@ -0,0 +1,117 @@
+from collections import Counter
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from .batch_writer import BatchInsertWriter
+
+NOTIFICATIONS_COLLECTION = "notifications"
+COUNTERS_COLLECTION = "notification_counters"
+
+# Notifications are deleted by a TTL index after this long
+NOTIFICATION_RETENTION_SECONDS = 90 * 86400
+
+# What clients see of a notification; the rest (pending_channels) is digest bookkeeping
+NOTIFICATION_PUBLIC_FIELDS = ("_id", "user_id", "type", "message", "related_entity_id", "read", "created_at")
+NOTIFICATION_PUBLIC_PROJECTION = {field: 1 for field in NOTIFICATION_PUBLIC_FIELDS}
+
+
+def public_notification(notification: dict) -> dict:
+    return {field: notification[field] for field in NOTIFICATION_PUBLIC_FIELDS if field in notification}
+
+
+class NotificationService:
+    """Create notifications without putting a write on the request path
+
+    notify() only queues. Queued notifications are written with one
+    insert_many per batch; then, per batch, every recipient's unread
+    counter is bumped in one bulk write and each notification is pushed
+    live to its recipient's sockets. Each notification is also marked
+    pending for the digest channels, which DigestWorker sends in batches.
+    """
+
+    def __init__(self, app, manager, flush_interval: float = 0.05, max_batch: int = 500,
+                 digest_channels: Iterable[str] = ()):
+        self.app = app
+        self.manager = manager
+        self.digest_channels = list(digest_channels)
+        self.writer = BatchInsertWriter(
+            app,
+            NOTIFICATIONS_COLLECTION,
+            flush_interval=flush_interval,
+            max_batch=max_batch,
+            on_batch=self._on_batch
+        )
+
+    def start(self):
+        self.writer.start()
+
+    async def stop(self):
+        await self.writer.stop()
+
+    def notify(self, user_id, notification_type: str, message: str,
+               related_entity_id: Optional[ObjectId] = None) -> dict:
+        """Queue a notification for a user and return the document that will be stored"""
+        notification = {
+            "_id": ObjectId(),
+            "user_id": ObjectId(user_id),
+            "type": notification_type,
+            "message": message,
+            "related_entity_id": related_entity_id,
+            "read": False,
+            "pending_channels": list(self.digest_channels),
+            "created_at": datetime.now()
+        }
+        self.writer.submit(notification)
+        return notification
+
+    async def _on_batch(self, notifications: List[dict]):
+        counts = Counter(notification["user_id"] for notification in notifications)
+        await self.app.mongodb[COUNTERS_COLLECTION].bulk_write([
+            UpdateOne({"_id": user_id}, {"$inc": {"unread": count}}, upsert=True)
+            for user_id, count in counts.items()
+        ], ordered=False)
+
+        for notification in notifications:
+            await self.manager.send_personal_message(
+                {"type": "notification", "notification": public_notification(notification)},
+                str(notification["user_id"])
+            )
+
+
+async def get_unread_count(db, user_id) -> int:
+    counter = await db[COUNTERS_COLLECTION].find_one({"_id": user_id})
+    return counter["unread"] if counter else 0
+
+
+async def mark_notifications_read(db, user_id, up_to: Optional[dict] = None) -> int:
+    """Mark a user's unread notifications read, all of them or those up to a notification
+
+    Returns how many changed. Marking everything also resets the counter
+    from a count of what is still unread, which corrects any drift from
+    unread notifications that expired.
+    """
+    query = {"user_id": user_id, "read": False}
+    if up_to is not None:
+        query["$or"] = [
+            {"created_at": {"$lt": up_to["created_at"]}},
+            {"created_at": up_to["created_at"], "_id": {"$lte": up_to["_id"]}}
+        ]
+
+    result = await db[NOTIFICATIONS_COLLECTION].update_many(query, {"$set": {"read": True}})
+
+    if up_to is None:
+        remaining = await db[NOTIFICATIONS_COLLECTION].count_documents({"user_id": user_id, "read": False})
+        await db[COUNTERS_COLLECTION].update_one(
+            {"_id": user_id}, {"$set": {"unread": remaining}}, upsert=True
+        )
+    elif result.modified_count:
+        await db[COUNTERS_COLLECTION].update_one(
+            {"_id": user_id},
+            [{"$set": {"unread": {"$max": [
+                0, {"$subtract": [{"$ifNull": ["$unread", 0]}, result.modified_count]}
+            ]}}}]
+        )
+    return result.modified_count
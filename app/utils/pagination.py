@@ -0,0 +1,42 @@
+import base64
+from datetime import datetime
+from typing import Tuple
+from bson import ObjectId
+from bson.errors import InvalidId
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded"""
+
+
+def encode_cursor(created_at: datetime, document_id: ObjectId) -> str:
+    """Encode a (created_at, _id) keyset position as an opaque cursor"""
+    raw = f"{created_at.isoformat()}|{document_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    """Decode a cursor produced by encode_cursor"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, document_id = base64.urlsafe_b64decode(padded).decode().split("|", 1)
+        return datetime.fromisoformat(created_at), ObjectId(document_id)
+    except (ValueError, InvalidId, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+
+def keyset_filter(cursor: str, field: str = "created_at", direction: int = -1) -> dict:
+    """Build the filter selecting documents strictly past a cursor on (field, _id)"""
+    value, document_id = decode_cursor(cursor)
+    return keyset_range(value, document_id, field, direction)
+
+
+def keyset_range(value, document_id: ObjectId, field: str = "created_at", direction: int = -1) -> dict:
+    """Build the filter selecting documents strictly past a known (field, _id) position"""
+    op = "$lt" if direction < 0 else "$gt"
+    return {
+        "$or": [
+            {field: {op: value}},
+            {field: value, "_id": {op: document_id}}
+        ]
+    }
@@ -1,8 +1,27 @@
 from typing import NamedTuple
+import asyncio
 import logging
+import random
+import ssl
+import time
+import uuid
 from enum import Enum
 from typing import Optional
 
+import anyio
+import httpx
+
+from .cache import TTLCache
+
+
+PAYPAL_API_BASES = {
+    "sandbox": "https://api-m.sandbox.paypal.com",
+    "live": "https://api-m.paypal.com",
+}
+
+# Refresh PayPal OAuth tokens this many seconds before they actually expire
+PAYPAL_TOKEN_REFRESH_MARGIN = 60
+
 
 class PaymentResult(NamedTuple):
     success: bool
@@ -10,47 +29,99 @@ class PaymentResult(NamedTuple):
     message: str
 
 class PaymentProcessor:
-    """Abstract base class for payment processors"""
-    
+    """Abstract base class for payment processors
+
+    Processors are long-lived: one instance is created at startup and shared
+    by every request, so implementations must keep their HTTP clients pooled
+    and must never block the event loop.
+    """
+
     async def process_payment(
         self,
         method: str,
         amount: float,
         currency: str,
         token: str,
-        description: str = ""
+        description: str = "",
+        idempotency_key: Optional[str] = None
     ) -> PaymentResult:
         raise NotImplementedError
 
+    async def close(self):
+        """Release pooled connections held by the processor"""
+
+def _pooled_stripe_http_client(timeout: float, max_connections: int):
+    """A stripe.HTTPXClient whose async connection pool is bounded
+
+    HTTPXClient builds its httpx client in __init__ and takes no pool
+    limits, so this subclass runs the base HTTPClient setup (proxy and
+    certificate options) and builds the same client with limits added.
+    """
+    import stripe
+
+    class PooledHTTPXClient(stripe.HTTPXClient):
+        def __init__(self, timeout: float, max_connections: int, **kwargs):
+            stripe.HTTPClient.__init__(self, **kwargs)
+            self.httpx = httpx
+            self.anyio = anyio
+            self._timeout = timeout
+            self._client = None
+            self._client_async = httpx.AsyncClient(
+                verify=ssl.create_default_context(cafile=stripe.ca_bundle_path) if self._verify_ssl_certs else False,
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections
+                )
+            )
+
+    return PooledHTTPXClient(timeout, max_connections)
+
 class StripeProcessor(PaymentProcessor):
     """Payment processor for Stripe"""
-    
-    def __init__(self, api_key: str):
+
+    def __init__(
+        self,
+        api_key: str,
+        timeout: float = 30.0,
+        max_connections: int = 20,
+        max_network_retries: int = 0,
+        api_base: Optional[str] = None
+    ):
+        import stripe
+
         self.api_key = api_key
-    
+        # One pooled httpx.AsyncClient for the processor's lifetime
+        self._http_client = _pooled_stripe_http_client(timeout, max_connections)
+        self._client = stripe.StripeClient(
+            api_key,
+            http_client=self._http_client,
+            max_network_retries=max_network_retries,
+            base_addresses={"api": api_base} if api_base else {}
+        )
+
     async def process_payment(
         self,
         method: str,
         amount: float,
         currency: str,
         token: str,
-        description: str = ""
+        description: str = "",
+        idempotency_key: Optional[str] = None
     ) -> PaymentResult:
         try:
-            import stripe
-            stripe.api_key = self.api_key
-            
             # Convert amount to cents/pence
-            amount_in_cents = int(amount * 100)
-            
-            
-            charge = stripe.Charge.create(
-                amount=amount_in_cents,
-                currency=currency,
-                source=token,
-                description=description
+            amount_in_cents = int(round(amount * 100))
+
+            charge = await self._client.charges.create_async(
+                params={
+                    "amount": amount_in_cents,
+                    "currency": currency,
+                    "source": token,
+                    "description": description
+                },
+                options={"idempotency_key": idempotency_key} if idempotency_key else {}
             )
-            
+
             if charge.paid:
                 return PaymentResult(
                     success=True,
@@ -71,45 +142,100 @@ class StripeProcessor(PaymentProcessor):
                 message=str(e)
             )
 
+    async def close(self):
+        await self._http_client.close_async()
+
 class PayPalProcessor(PaymentProcessor):
     """Payment processor for PayPal"""
-    
-    def __init__(self, client_id: str, client_secret: str):
+
+    def __init__(
+        self,
+        client_id: str,
+        client_secret: str,
+        environment: str = "sandbox",
+        timeout: float = 30.0,
+        max_connections: int = 20,
+        api_base: Optional[str] = None
+    ):
         self.client_id = client_id
         self.client_secret = client_secret
-    
+        self._client = httpx.AsyncClient(
+            base_url=api_base or PAYPAL_API_BASES[environment],
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            )
+        )
+        self._access_token: Optional[str] = None
+        self._token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+
+    async def _get_access_token(self) -> str:
+        """Return the cached OAuth token, fetching a new one when it is about to expire"""
+        if self._access_token and time.monotonic() < self._token_expires_at:
+            return self._access_token
+
+        # Only one coroutine refreshes; the rest wait and reuse its token
+        async with self._token_lock:
+            if self._access_token and time.monotonic() < self._token_expires_at:
+                return self._access_token
+
+            response = await self._client.post(
+                "/v1/oauth2/token",
+                data={"grant_type": "client_credentials"},
+                auth=(self.client_id, self.client_secret)
+            )
+            response.raise_for_status()
+            payload = response.json()
+
+            self._access_token = payload["access_token"]
+            self._token_expires_at = (
+                time.monotonic()
+                + payload.get("expires_in", 3600)
+                - PAYPAL_TOKEN_REFRESH_MARGIN
+            )
+            return self._access_token
+
     async def process_payment(
         self,
         method: str,
         amount: float,
         currency: str,
         token: str,
-        description: str = ""
+        description: str = "",
+        idempotency_key: Optional[str] = None
     ) -> PaymentResult:
         try:
-            from paypalcheckoutsdk.core import PayPalHttpClient, SandboxEnvironment
-            from paypalcheckoutsdk.orders import OrdersCaptureRequest
-            
-            
-            environment = SandboxEnvironment(
-                client_id=self.client_id,
-                client_secret=self.client_secret
+            access_token = await self._get_access_token()
+
+            headers = {
+                "Authorization": f"Bearer {access_token}",
+                "Content-Type": "application/json"
+            }
+            if idempotency_key:
+                headers["PayPal-Request-Id"] = idempotency_key
+
+            response = await self._client.post(
+                f"/v2/checkout/orders/{token}/capture",
+                headers=headers
             )
-            client = PayPalHttpClient(environment)
-            
-            request = OrdersCaptureRequest(token)
-            response = client.execute(request)
-            
-            if response.result.status == "COMPLETED":
+            if response.status_code == 401:
+                # Token was revoked early; force a refresh on the next call
+                self._access_token = None
+            response.raise_for_status()
+            result = response.json()
+
+            if result.get("status") == "COMPLETED":
                 return PaymentResult(
                     success=True,
-                    transaction_id=response.result.id,
+                    transaction_id=result.get("id"),
                     message="Payment successful"
                 )
             else:
                 return PaymentResult(
                     success=False,
-                    transaction_id=response.result.id,
+                    transaction_id=result.get("id"),
                     message="Payment failed"
                 )
         except Exception as e:
@@ -120,30 +246,164 @@ class PayPalProcessor(PaymentProcessor):
                 message=str(e)
             )
 
+    async def close(self):
+        await self._client.aclose()
+
+class FakeProcessor(PaymentProcessor):
+    """Local stand-in processor for development and load testing
+
+    Charges succeed after a simulated latency unless a configurable share of
+    them is declined. With api_base set, each charge is instead posted to a
+    Stripe-shaped HTTP server (see benchmarks/fake_processor_server.py) so
+    the network path is exercised too.
+    """
+
+    def __init__(
+        self,
+        latency_ms: float = 50.0,
+        latency_jitter_ms: float = 0.0,
+        failure_rate: float = 0.0,
+        timeout: float = 30.0,
+        max_connections: int = 20,
+        api_base: Optional[str] = None,
+        seed: Optional[int] = None,
+        idempotency_cache_size: int = 100000
+    ):
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        # Real processors replay the first result for a repeated idempotency key,
+        # for a day; over HTTP the fake server does the replaying instead
+        self._idempotent_results = TTLCache(maxsize=idempotency_cache_size, ttl=86400)
+        self._client = None
+        if api_base:
+            self._client = httpx.AsyncClient(
+                base_url=api_base,
+                timeout=timeout,
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections
+                )
+            )
+
+    async def _charge_locally(self) -> PaymentResult:
+        latency = self.latency_ms + self._random.uniform(-1, 1) * self.latency_jitter_ms
+        await asyncio.sleep(max(latency, 0) / 1000)
+
+        transaction_id = f"fake_{uuid.uuid4().hex[:24]}"
+        if self._random.random() < self.failure_rate:
+            return PaymentResult(
+                success=False,
+                transaction_id=transaction_id,
+                message="Card declined"
+            )
+        return PaymentResult(
+            success=True,
+            transaction_id=transaction_id,
+            message="Payment successful"
+        )
+
+    async def _charge_over_http(self, amount: float, currency: str, token: str,
+                                idempotency_key: Optional[str]) -> PaymentResult:
+        response = await self._client.post(
+            "/v1/charges",
+            data={
+                "amount": int(round(amount * 100)),
+                "currency": currency,
+                "source": token
+            },
+            headers={"Idempotency-Key": idempotency_key} if idempotency_key else None
+        )
+        response.raise_for_status()
+        charge = response.json()
+        return PaymentResult(
+            success=charge["paid"],
+            transaction_id=charge["id"],
+            message="Payment successful" if charge["paid"] else charge.get("failure_message") or "Payment failed"
+        )
+
+    async def process_payment(
+        self,
+        method: str,
+        amount: float,
+        currency: str,
+        token: str,
+        description: str = "",
+        idempotency_key: Optional[str] = None
+    ) -> PaymentResult:
+        try:
+            if self._client is not None:
+                return await self._charge_over_http(amount, currency, token, idempotency_key)
+        except Exception as e:
+            logging.error(f"Fake payment error: {e}")
+            return PaymentResult(
+                success=False,
+                transaction_id=None,
+                message=str(e)
+            )
+
+        if idempotency_key:
+            replay = self._idempotent_results.get(idempotency_key)
+            if replay is not None:
+                return replay
+
+        result = await self._charge_locally()
+        if idempotency_key:
+            self._idempotent_results.set(idempotency_key, result)
+        return result
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+
+def create_processor(settings) -> PaymentProcessor:
+    """Create the long-lived processor for the configured backend"""
+    if settings.PAYMENT_PROCESSOR == "stripe":
+        return StripeProcessor(
+            settings.STRIPE_API_KEY,
+            timeout=settings.PAYMENT_TIMEOUT_SECONDS,
+            max_connections=settings.PAYMENT_MAX_CONNECTIONS,
+            api_base=settings.STRIPE_API_BASE
+        )
+    elif settings.PAYMENT_PROCESSOR == "paypal":
+        return PayPalProcessor(
+            settings.PAYPAL_CLIENT_ID,
+            settings.PAYPAL_CLIENT_SECRET,
+            environment=settings.PAYPAL_ENVIRONMENT,
+            timeout=settings.PAYMENT_TIMEOUT_SECONDS,
+            max_connections=settings.PAYMENT_MAX_CONNECTIONS,
+            api_base=settings.PAYPAL_API_BASE
+        )
+    elif settings.PAYMENT_PROCESSOR == "fake":
+        return FakeProcessor(
+            latency_ms=settings.FAKE_PROCESSOR_LATENCY_MS,
+            latency_jitter_ms=settings.FAKE_PROCESSOR_LATENCY_JITTER_MS,
+            failure_rate=settings.FAKE_PROCESSOR_FAILURE_RATE,
+            timeout=settings.PAYMENT_TIMEOUT_SECONDS,
+            max_connections=settings.PAYMENT_MAX_CONNECTIONS,
+            api_base=settings.FAKE_PROCESSOR_API_BASE
+        )
+    else:
+        raise ValueError("Invalid payment processor configured")
+
 async def process_payment(
+    processor: PaymentProcessor,
     method: str,
     amount: float,
     token: str,
-    settings
+    currency: str = "USD",
+    idempotency_key: Optional[str] = None
 ) -> PaymentResult:
-    """Process a payment using the configured processor"""
+    """Process a payment using the shared processor created at startup"""
     try:
-        if settings.PAYMENT_PROCESSOR == "stripe":
-            processor = StripeProcessor(settings.STRIPE_API_KEY)
-        elif settings.PAYMENT_PROCESSOR == "paypal":
-            processor = PayPalProcessor(
-                settings.PAYPAL_CLIENT_ID,
-                settings.PAYPAL_CLIENT_SECRET
-            )
-        else:
-            raise ValueError("Invalid payment processor configured")
-        
         return await processor.process_payment(
             method=method,
             amount=amount,
-            currency="USD",  # Or get from settings
+            currency=currency,
             token=token,
-            description="Artisan Booking Service"
+            description="Artisan Booking Service",
+            idempotency_key=idempotency_key
         )
     except Exception as e:
         logging.error(f"Payment processing error: {e}")
@@ -151,4 +411,4 @@ async def process_payment(
             success=False,
             transaction_id=None,
             message=str(e)
-        )
\ No newline at end of file
+        )
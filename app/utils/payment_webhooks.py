@@ -0,0 +1,433 @@
+from datetime import datetime, timedelta
+from typing import List, Optional
+from urllib.parse import urlparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import socket
+import zlib
+
+import httpx
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from .ledger import record_ledger_entry, to_minor_units
+
+WEBHOOK_EVENTS_COLLECTION = "payment_webhook_events"
+
+# (provider, event type) -> payment status applied to the matching payment
+PAYMENT_EVENT_STATUSES = {
+    ("stripe", "charge.succeeded"): "completed",
+    ("stripe", "charge.failed"): "failed",
+    ("stripe", "charge.refunded"): "refunded",
+    ("paypal", "PAYMENT.CAPTURE.COMPLETED"): "completed",
+    ("paypal", "PAYMENT.CAPTURE.DENIED"): "failed",
+    ("paypal", "PAYMENT.CAPTURE.REFUNDED"): "refunded",
+}
+
+# Payment status -> bookings.payment_status
+BOOKING_PAYMENT_STATUSES = {
+    "completed": "paid",
+    "failed": "failed",
+    "partially_refunded": "partially_refunded",
+    "refunded": "refunded",
+}
+
+# Once refunded, late success/failure events must not overwrite the payment's status
+REFUNDED_STATUSES = ["partially_refunded", "refunded"]
+
+_paypal_cert_cache: dict = {}
+
+
+class WebhookVerificationError(Exception):
+    """Raised when a webhook payload fails signature verification"""
+
+
+def verify_stripe_webhook(payload: bytes, headers, secret: str, tolerance: int = 300) -> dict:
+    """Verify the Stripe-Signature header and return the decoded event"""
+    import stripe
+
+    try:
+        stripe.WebhookSignature.verify_header(
+            payload.decode("utf-8"),
+            headers.get("stripe-signature", ""),
+            secret,
+            tolerance
+        )
+    except stripe.SignatureVerificationError as e:
+        raise WebhookVerificationError(str(e))
+
+    event = json.loads(payload)
+    charge = event.get("data", {}).get("object", {})
+    return {
+        "id": event["id"],
+        "type": event["type"],
+        "transaction_id": charge.get("id"),
+        # Cumulative, in minor units; less than the charge amount for a partial refund
+        "amount_refunded": charge.get("amount_refunded"),
+        "payload": event
+    }
+
+
+async def _get_paypal_public_key(cert_url: str):
+    """Fetch and cache PayPal's signing certificate; only cache misses touch the network"""
+    public_key = _paypal_cert_cache.get(cert_url)
+    if public_key is not None:
+        return public_key
+
+    parsed = urlparse(cert_url)
+    if parsed.scheme != "https" or not (parsed.hostname or "").endswith(".paypal.com"):
+        raise WebhookVerificationError("Untrusted PayPal certificate URL")
+
+    from cryptography import x509
+
+    async with httpx.AsyncClient(timeout=5.0) as client:
+        response = await client.get(cert_url)
+        response.raise_for_status()
+
+    public_key = x509.load_pem_x509_certificate(response.content).public_key()
+    _paypal_cert_cache[cert_url] = public_key
+    return public_key
+
+
+async def verify_paypal_webhook(payload: bytes, headers, webhook_id: str) -> dict:
+    """Verify PayPal transmission headers offline and return the decoded event"""
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    transmission_id = headers.get("paypal-transmission-id")
+    transmission_time = headers.get("paypal-transmission-time")
+    signature = headers.get("paypal-transmission-sig")
+    cert_url = headers.get("paypal-cert-url")
+    if not (transmission_id and transmission_time and signature and cert_url):
+        raise WebhookVerificationError("Missing PayPal transmission headers")
+
+    message = f"{transmission_id}|{transmission_time}|{webhook_id}|{zlib.crc32(payload)}"
+    public_key = await _get_paypal_public_key(cert_url)
+    try:
+        public_key.verify(
+            base64.b64decode(signature),
+            message.encode(),
+            padding.PKCS1v15(),
+            hashes.SHA256()
+        )
+    except (InvalidSignature, ValueError):
+        raise WebhookVerificationError("Invalid PayPal webhook signature")
+
+    event = json.loads(payload)
+    resource = event.get("resource", {})
+    order_id = resource.get("supplementary_data", {}).get("related_ids", {}).get("order_id")
+    # Refund events carry the capture's cumulative refunded total
+    refunded = resource.get("seller_payable_breakdown", {}).get("total_refunded_amount")
+    return {
+        "id": event["id"],
+        "type": event["event_type"],
+        "transaction_id": order_id or resource.get("id"),
+        "amount_refunded": to_minor_units(refunded["value"], refunded["currency_code"]) if refunded else None,
+        "payload": event
+    }
+
+
+async def verify_webhook(provider: str, payload: bytes, headers, settings) -> dict:
+    """Verify a webhook for the given provider and return the normalized event"""
+    try:
+        if provider == "stripe":
+            return verify_stripe_webhook(payload, headers, settings.STRIPE_WEBHOOK_SECRET)
+        elif provider == "paypal":
+            return await verify_paypal_webhook(payload, headers, settings.PAYPAL_WEBHOOK_ID)
+    except (KeyError, ValueError) as e:
+        raise WebhookVerificationError(f"Malformed webhook payload: {e}")
+    raise WebhookVerificationError(f"Unknown payment provider: {provider}")
+
+
+async def enqueue_webhook_event(db, provider: str, event: dict) -> bool:
+    """Durably record an event for the worker; returns False if it was already received"""
+    try:
+        await db[WEBHOOK_EVENTS_COLLECTION].insert_one({
+            "_id": f"{provider}:{event['id']}",
+            "provider": provider,
+            "event_type": event["type"],
+            "transaction_id": event["transaction_id"],
+            "amount_refunded": event.get("amount_refunded"),
+            "payload": event["payload"],
+            "status": "pending",
+            "attempts": 0,
+            "locked_until": None,
+            "received_at": datetime.now()
+        })
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+async def apply_payment_events(db, events: List[dict]) -> List[dict]:
+    """Apply a batch of events to payments and bookings with two bulk writes
+
+    Refund events are applied one by one afterwards: whether a refund is
+    full or partial, and how much to take back from the artisan, depends on
+    the payment's amount and on what was already refunded.
+
+    Returns the events whose payment could not be found. A webhook can
+    arrive before the payment it is about has been stored, so these are
+    retried later rather than acknowledged.
+    """
+    payment_updates = []
+    refunds = []
+    transaction_ids = set()
+    now = datetime.now()
+
+    for event in events:
+        payment_status = PAYMENT_EVENT_STATUSES.get((event["provider"], event["event_type"]))
+        if payment_status is None or not event.get("transaction_id"):
+            continue
+
+        transaction_ids.add(event["transaction_id"])
+        if payment_status == "refunded":
+            refunds.append(event)
+            continue
+
+        payment_updates.append(UpdateOne(
+            {"transaction_id": event["transaction_id"], "status": {"$nin": REFUNDED_STATUSES}},
+            {"$set": {"status": payment_status, "updated_at": now}}
+        ))
+
+    if not transaction_ids:
+        return []
+
+    if payment_updates:
+        # Ordered so events for the same transaction apply in the order received
+        await db["payments"].bulk_write(payment_updates, ordered=True)
+
+    if refunds:
+        refunded_payments = {
+            payment["transaction_id"]: payment
+            for payment in await db["payments"].find(
+                {"transaction_id": {"$in": [event["transaction_id"] for event in refunds]}},
+                {"transaction_id": 1, "artisan_id": 1, "amount": 1, "currency": 1, "refunded_minor": 1}
+            ).to_list(None)
+        }
+        for event in refunds:
+            payment = refunded_payments.get(event["transaction_id"])
+            if payment is not None:
+                await apply_refund(db, payment, event.get("amount_refunded"), now)
+
+    payments = await db["payments"].find(
+        {"transaction_id": {"$in": list(transaction_ids)}},
+        {"transaction_id": 1, "booking_id": 1, "status": 1}
+    ).to_list(None)
+
+    booking_updates = [
+        UpdateOne(
+            {"_id": payment["booking_id"]},
+            {"$set": {
+                "payment_status": BOOKING_PAYMENT_STATUSES[payment["status"]],
+                "updated_at": now
+            }}
+        )
+        for payment in payments
+        if payment["status"] in BOOKING_PAYMENT_STATUSES
+    ]
+    if booking_updates:
+        await db["bookings"].bulk_write(booking_updates, ordered=False)
+
+    matched = {payment["transaction_id"] for payment in payments}
+    return [
+        event for event in events
+        if event.get("transaction_id") in transaction_ids and event["transaction_id"] not in matched
+    ]
+
+
+async def apply_refund(db, payment: dict, amount_refunded: Optional[int], now: datetime):
+    """Debit the artisan for newly refunded money and mark the payment refunded or partially refunded
+
+    amount_refunded is the processor's cumulative refunded total in minor
+    units; None (events queued before it was recorded) means a full refund.
+    payment.refunded_minor tracks what the ledger already holds, so a
+    replayed or out-of-order event debits nothing. Ledger entries are keyed
+    by the cumulative total they bring the payment to, and a full refund
+    keeps the plain payment id as its reference.
+    """
+    currency = payment.get("currency", "USD")
+    amount_minor = to_minor_units(payment["amount"], currency)
+    refunded_minor = amount_minor if amount_refunded is None else min(amount_refunded, amount_minor)
+    already_refunded = payment.get("refunded_minor", 0)
+
+    if refunded_minor > already_refunded:
+        reference_id = str(payment["_id"])
+        if refunded_minor < amount_minor:
+            reference_id += f":{refunded_minor}"
+        # Raises on failure so the event is retried rather than acknowledged
+        await record_ledger_entry(
+            db,
+            payment["artisan_id"],
+            "refund",
+            refunded_minor - already_refunded,
+            currency=currency,
+            reference_id=reference_id
+        )
+        payment["refunded_minor"] = refunded_minor
+
+    total_refunded = max(refunded_minor, already_refunded)
+    await db["payments"].update_one(
+        {"_id": payment["_id"]},
+        {
+            "$max": {"refunded_minor": total_refunded},
+            "$set": {
+                "status": "refunded" if total_refunded >= amount_minor else "partially_refunded",
+                "updated_at": now
+            }
+        }
+    )
+
+
+class PaymentWebhookWorker:
+    """Drain queued payment webhook events in batches
+
+    Events are claimed with a lease so several workers (or a restarted one)
+    can share the queue; an event whose lease expires is picked up again.
+    When a batch fails its events are retried one at a time, so a single bad
+    event cannot hold the rest back. Failed events, and events whose
+    payment is not stored yet, wait with exponential backoff before their
+    next attempt. An event that has failed max_attempts times is
+    dead-lettered: left in the queue with status "dead" and the last error,
+    for someone to look at.
+    """
+
+    def __init__(
+        self,
+        app,
+        batch_size: int = 500,
+        poll_interval: float = 1.0,
+        lease_seconds: float = 60.0,
+        max_attempts: int = 10,
+        retry_base: float = 30.0,
+        retry_max: float = 3600.0
+    ):
+        self.app = app
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def notify(self):
+        """Wake the worker early after an event is enqueued"""
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                drained = await self.drain_once()
+            except Exception as e:
+                logging.error(f"Payment webhook worker error: {e}")
+                drained = 0
+
+            if drained < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    def retry_delay(self, attempts: int) -> float:
+        delay = min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _claim_batch(self, db) -> List[dict]:
+        now = datetime.now()
+        claimable = {
+            "status": "pending",
+            "$or": [{"locked_until": None}, {"locked_until": {"$lt": now}}]
+        }
+
+        candidates = await db[WEBHOOK_EVENTS_COLLECTION].find(claimable, {"_id": 1}) \
+            .sort("received_at", 1) \
+            .limit(self.batch_size) \
+            .to_list(self.batch_size)
+        if not candidates:
+            return []
+
+        lease = now + timedelta(seconds=self.lease_seconds)
+        ids = [candidate["_id"] for candidate in candidates]
+        await db[WEBHOOK_EVENTS_COLLECTION].update_many(
+            {"_id": {"$in": ids}, **claimable},
+            {"$set": {"locked_until": lease, "locked_by": self.worker_id}, "$inc": {"attempts": 1}}
+        )
+
+        # Only the events this worker actually won
+        return await db[WEBHOOK_EVENTS_COLLECTION].find(
+            {"_id": {"$in": ids}, "locked_by": self.worker_id, "locked_until": lease}
+        ).sort("received_at", 1).to_list(None)
+
+    async def drain_once(self) -> int:
+        """Claim, apply and acknowledge one batch; returns the number of events claimed"""
+        db = self.app.mongodb
+        events = await self._claim_batch(db)
+        if not events:
+            return 0
+
+        processed = events
+        unmatched = []
+        failed = []
+        try:
+            unmatched = await apply_payment_events(db, events)
+        except Exception as e:
+            logging.error(f"Payment webhook batch failed ({e}); applying its events one at a time")
+            processed = []
+            for event in events:
+                try:
+                    unmatched += await apply_payment_events(db, [event])
+                    processed.append(event)
+                except Exception as event_error:
+                    failed.append((event, f"{type(event_error).__name__}: {event_error}"))
+
+        unmatched_ids = {event["_id"] for event in unmatched}
+        processed = [event for event in processed if event["_id"] not in unmatched_ids]
+        failed += [(event, f"No payment with transaction id {event['transaction_id']}") for event in unmatched]
+
+        now = datetime.now()
+        if processed:
+            await db[WEBHOOK_EVENTS_COLLECTION].update_many(
+                {"_id": {"$in": [event["_id"] for event in processed]}},
+                {"$set": {"status": "processed", "processed_at": now}}
+            )
+
+        # Failed events stay pending, locked until their backoff has passed
+        dead = 0
+        for event, error in failed:
+            update = {"last_error": error}
+            if event["attempts"] >= self.max_attempts:
+                dead += 1
+                update.update({"status": "dead", "dead_at": now, "locked_until": None})
+                logging.error(f"Dead-lettering payment webhook event {event['_id']} after {event['attempts']} attempts: {error}")
+            else:
+                update["locked_until"] = now + timedelta(seconds=self.retry_delay(event["attempts"]))
+            await db[WEBHOOK_EVENTS_COLLECTION].update_one(
+                {"_id": event["_id"], "locked_by": self.worker_id},
+                {"$set": update}
+            )
+
+        logging.info(
+            f"Processed {len(processed)} payment webhook events ({len(unmatched)} awaiting their payment, "
+            f"{len(failed) - len(unmatched)} failed, {dead} dead-lettered)"
+        )
+        return len(events)
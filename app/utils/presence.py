@@ -0,0 +1,227 @@
+from typing import Dict, Iterable, Optional, Set, Tuple
+import asyncio
+import logging
+import time
+import uuid
+
+from .websocket import ConnectionListener, ConnectionManager
+
+PRESENCE_CHANNEL = "__presence__"
+
+
+class PresenceService(ConnectionListener):
+    """Online status and typing indicators built on a ConnectionManager
+
+    Each worker knows who is connected to it and shares that with the other
+    workers over the manager's pub/sub backend: a batch of changes per
+    flush, plus a full snapshot every snapshot_interval so a worker that
+    died without saying goodbye ages out. Presence lookups are therefore
+    answered from memory.
+
+    Going offline is debounced by offline_grace, so a phone that drops and
+    reconnects does not flap. Typing signals are rate-limited to one per
+    sender and conversation every typing_interval and delivered as one
+    batched frame per recipient per flush.
+    """
+
+    def __init__(
+        self,
+        manager: ConnectionManager,
+        offline_grace: float = 5.0,
+        typing_interval: float = 2.0,
+        flush_interval: float = 0.5,
+        snapshot_interval: float = 30.0,
+        max_watched: int = 200
+    ):
+        self.manager = manager
+        self.offline_grace = offline_grace
+        self.typing_interval = typing_interval
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.max_watched = max_watched
+        self.worker_id = uuid.uuid4().hex
+        # Users this worker reports as online
+        self.local_online: Set[str] = set()
+        # worker_id -> (users online there, when that worker was last heard from)
+        self.remote_online: Dict[str, Tuple[Set[str], float]] = {}
+        self._offline_timers: Dict[str, asyncio.TimerHandle] = {}
+        self._changes: Dict[str, bool] = {}
+        self._snapshot_due = True
+        self._last_snapshot = 0.0
+        # Watched user -> connections watching them, and the reverse
+        self._watchers: Dict[str, Set[str]] = {}
+        self._watching: Dict[str, Set[str]] = {}
+        self._notify: Dict[str, Dict[str, bool]] = {}
+        # recipient -> {sender: when typing was last announced}
+        self._typing_sent: Dict[str, Dict[str, float]] = {}
+        self._typing_pending: Dict[str, Set[str]] = {}
+        self._task: Optional[asyncio.Task] = None
+        manager.add_listener(self)
+
+    async def start(self):
+        self.manager.add_channel_handler(PRESENCE_CHANNEL, self._on_presence)
+        # Ask the other workers for their snapshots instead of waiting a full interval
+        await self.manager.pubsub.publish(PRESENCE_CHANNEL, {"worker": self.worker_id, "hello": True})
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for timer in self._offline_timers.values():
+            timer.cancel()
+        # Everyone here is about to be disconnected; let the other workers know now
+        await self.manager.pubsub.publish(PRESENCE_CHANNEL, {"worker": self.worker_id, "snapshot": []})
+
+    def is_online(self, user_id: str) -> bool:
+        return user_id in self.local_online or any(
+            user_id in users for users, _ in self.remote_online.values()
+        )
+
+    def online_among(self, user_ids: Iterable[str]) -> Dict[str, bool]:
+        """Bulk presence lookup, answered from memory"""
+        online = set(self.local_online)
+        for users, _ in self.remote_online.values():
+            online |= users
+        return {user_id: user_id in online for user_id in user_ids}
+
+    def watch(self, connection_id: str, user_ids: Iterable[str]) -> Dict[str, bool]:
+        """Send a connection presence changes for these users; returns their current state"""
+        watching = self._watching.setdefault(connection_id, set())
+        for user_id in user_ids:
+            if len(watching) >= self.max_watched:
+                break
+            watching.add(user_id)
+            self._watchers.setdefault(user_id, set()).add(connection_id)
+        return self.online_among(watching)
+
+    def typing(self, sender_id: str, recipient_id: str):
+        """Note that sender is typing to recipient; repeats within typing_interval are dropped"""
+        now = time.monotonic()
+        sent = self._typing_sent.setdefault(recipient_id, {})
+        if now - sent.get(sender_id, float("-inf")) < self.typing_interval:
+            return
+        sent[sender_id] = now
+        self._typing_pending.setdefault(recipient_id, set()).add(sender_id)
+
+    def connection_opened(self, connection_id: str, user_id: str, first: bool):
+        timer = self._offline_timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        if user_id not in self.local_online:
+            self._set_local(user_id, True)
+
+    def connection_closed(self, connection_id: str, user_id: str, last: bool):
+        for watched in self._watching.pop(connection_id, ()):
+            watchers = self._watchers.get(watched)
+            if watchers is not None:
+                watchers.discard(connection_id)
+                if not watchers:
+                    del self._watchers[watched]
+        self._notify.pop(connection_id, None)
+        if last and user_id not in self._offline_timers:
+            self._offline_timers[user_id] = asyncio.get_running_loop().call_later(
+                self.offline_grace, self._offline_grace_expired, user_id
+            )
+
+    def _offline_grace_expired(self, user_id: str):
+        self._offline_timers.pop(user_id, None)
+        if user_id not in self.manager.user_connections:
+            self._set_local(user_id, False)
+
+    def _set_local(self, user_id: str, online: bool):
+        was_online = self.is_online(user_id)
+        if online:
+            self.local_online.add(user_id)
+        else:
+            self.local_online.discard(user_id)
+        self._changes[user_id] = online
+        if self.is_online(user_id) != was_online:
+            self._queue_notify(user_id, online)
+
+    def _queue_notify(self, user_id: str, online: bool):
+        for connection_id in self._watchers.get(user_id, ()):
+            self._notify.setdefault(connection_id, {})[user_id] = online
+
+    def _apply_remote(self, worker_id: str, users: Set[str]):
+        """Replace what we know about a worker, notifying watchers of effective changes"""
+        previous, _ = self.remote_online.get(worker_id, (set(), 0.0))
+        changed = previous ^ users
+        before = {user_id: self.is_online(user_id) for user_id in changed}
+        if users:
+            self.remote_online[worker_id] = (users, time.monotonic())
+        else:
+            self.remote_online.pop(worker_id, None)
+        for user_id, was_online in before.items():
+            online = self.is_online(user_id)
+            if online != was_online:
+                self._queue_notify(user_id, online)
+
+    async def _on_presence(self, message: dict):
+        worker_id = message["worker"]
+        if worker_id == self.worker_id:
+            return
+        if message.get("hello"):
+            self._snapshot_due = True
+        elif "snapshot" in message:
+            self._apply_remote(worker_id, set(message["snapshot"]))
+        else:
+            users, _ = self.remote_online.get(worker_id, (set(), 0.0))
+            users = set(users)
+            for user_id, online in message["changes"].items():
+                if online:
+                    users.add(user_id)
+                else:
+                    users.discard(user_id)
+            self._apply_remote(worker_id, users)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing presence updates: {e}")
+
+    async def flush(self):
+        """Publish pending presence changes and deliver batched typing and presence frames"""
+        now = time.monotonic()
+        if self._snapshot_due or now - self._last_snapshot >= self.snapshot_interval:
+            self._snapshot_due = False
+            self._last_snapshot = now
+            self._changes.clear()
+            await self.manager.pubsub.publish(
+                PRESENCE_CHANNEL, {"worker": self.worker_id, "snapshot": list(self.local_online)}
+            )
+        elif self._changes:
+            changes, self._changes = self._changes, {}
+            await self.manager.pubsub.publish(
+                PRESENCE_CHANNEL, {"worker": self.worker_id, "changes": changes}
+            )
+
+        # Workers that missed several snapshots are assumed gone
+        stale_after = self.snapshot_interval * 3
+        for worker_id, (_, seen_at) in list(self.remote_online.items()):
+            if now - seen_at > stale_after:
+                self._apply_remote(worker_id, set())
+
+        notify, self._notify = self._notify, {}
+        for connection_id, users in notify.items():
+            self.manager.send_to_connection(connection_id, {"type": "presence", "users": users})
+
+        pending, self._typing_pending = self._typing_pending, {}
+        for recipient_id, senders in pending.items():
+            await self.manager.send_personal_message({
+                "type": "typing",
+                "user_ids": sorted(senders)
+            }, recipient_id, coalesce_key="typing")
+
+        for recipient_id, sent in list(self._typing_sent.items()):
+            for sender_id, announced_at in list(sent.items()):
+                if now - announced_at >= self.typing_interval:
+                    del sent[sender_id]
+            if not sent:
+                del self._typing_sent[recipient_id]
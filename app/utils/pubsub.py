@@ -0,0 +1,269 @@
+from datetime import datetime
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+import asyncio
+import logging
+
+import orjson
+from pymongo.errors import OperationFailure
+
+BROADCAST_CHANNEL = "__broadcast__"
+
+# handler(channel, message) delivers a published message to local connections
+DeliveryHandler = Callable[[str, dict], Awaitable[None]]
+
+
+class PubSubBackend:
+    """Carry per-user channel messages to every worker process
+
+    ConnectionManager publishes to a user's channel and each worker delivers
+    the messages for users connected to it. Channels are named after user ids;
+    BROADCAST_CHANNEL reaches every connection.
+    """
+
+    def __init__(self):
+        self._handler: Optional[DeliveryHandler] = None
+
+    def bind(self, handler: DeliveryHandler):
+        """Set the callback that delivers messages to this process's connections"""
+        self._handler = handler
+
+    async def start(self):
+        pass
+
+    async def publish(self, channel: str, message: dict):
+        raise NotImplementedError
+
+    def subscribe(self, channel: str):
+        """Start receiving a channel because a local connection needs it"""
+
+    def unsubscribe(self, channel: str):
+        """Stop receiving a channel after its last local connection closed"""
+
+    async def close(self):
+        pass
+
+
+class InMemoryPubSub(PubSubBackend):
+    """Single-process backend: publishing is local delivery"""
+
+    async def publish(self, channel: str, message: dict):
+        await self._handler(channel, message)
+
+
+class BatchingPubSub(PubSubBackend):
+    """Base for cross-process backends
+
+    Publishes are buffered and written out together every flush_interval
+    seconds, or as soon as max_batch messages are waiting. If the listener's
+    connection drops it is reopened, backing off from reconnect_base up to
+    reconnect_max seconds between attempts, so delivery from other workers
+    resumes on its own.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = 0.002,
+        max_batch: int = 500,
+        reconnect_base: float = 0.5,
+        reconnect_max: float = 30.0
+    ):
+        super().__init__()
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.reconnect_base = reconnect_base
+        self.reconnect_max = reconnect_max
+        self.reconnects_total = 0
+        self._reconnect_delay = reconnect_base
+        self._buffer: List[Tuple[str, bytes]] = []
+        self._pending = asyncio.Event()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _spawn(self, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"{type(self).__name__} task failed", exc_info=task.exception())
+
+    async def start(self):
+        self._spawn(self._flusher())
+        self._spawn(self._listen_forever())
+
+    async def _listen_forever(self):
+        while True:
+            try:
+                await self._listen()
+                logging.warning(f"{type(self).__name__} listener stopped; reconnecting")
+            except Exception:
+                logging.exception(
+                    f"{type(self).__name__} listener failed; reconnecting in {self._reconnect_delay:.1f}s"
+                )
+            await asyncio.sleep(self._reconnect_delay)
+            self._reconnect_delay = min(self._reconnect_delay * 2, self.reconnect_max)
+            self.reconnects_total += 1
+
+    def _listening(self):
+        """Called by _listen once it is receiving again; resets the reconnect backoff"""
+        self._reconnect_delay = self.reconnect_base
+
+    async def publish(self, channel: str, message: dict):
+        self._buffer.append((channel, orjson.dumps(message, default=str)))
+        if len(self._buffer) >= self.max_batch:
+            await self._flush()
+        else:
+            self._pending.set()
+
+    async def _flusher(self):
+        while True:
+            await self._pending.wait()
+            await asyncio.sleep(self.flush_interval)
+            await self._flush()
+
+    async def _flush(self):
+        batch, self._buffer = self._buffer, []
+        self._pending.clear()
+        if not batch:
+            return
+        try:
+            await self._send_batch(batch)
+        except Exception as e:
+            logging.error(f"Failed to publish {len(batch)} WebSocket messages: {e}")
+
+    async def _deliver(self, channel: str, payload):
+        try:
+            await self._handler(channel, orjson.loads(payload))
+        except Exception as e:
+            logging.error(f"Error delivering message on channel {channel}: {e}")
+
+    async def _send_batch(self, batch: List[Tuple[str, bytes]]):
+        raise NotImplementedError
+
+    async def _listen(self):
+        """Receive published messages until the connection drops"""
+        raise NotImplementedError
+
+    async def close(self):
+        await self._flush()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class RedisPubSub(BatchingPubSub):
+    """Backend for any Redis-compatible server (Redis, Valkey, KeyDB, ...)
+
+    Each worker subscribes only to the channels of users connected to it, and
+    a batch of publishes goes out as one pipelined round trip. The live
+    channel set is kept here so a reconnect can subscribe to all of it again.
+    """
+
+    def __init__(self, url: str, prefix: str = "ws:", **kwargs):
+        super().__init__(**kwargs)
+        import redis.asyncio as redis
+
+        self.prefix = prefix
+        self._redis = redis.from_url(url)
+        self._pubsub = self._redis.pubsub()
+        self._channels: Set[str] = {BROADCAST_CHANNEL}
+
+    def subscribe(self, channel: str):
+        self._channels.add(channel)
+        self._spawn(self._pubsub.subscribe(self.prefix + channel))
+
+    def unsubscribe(self, channel: str):
+        self._channels.discard(channel)
+        self._spawn(self._pubsub.unsubscribe(self.prefix + channel))
+
+    async def _send_batch(self, batch: List[Tuple[str, bytes]]):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for channel, payload in batch:
+                pipe.publish(self.prefix + channel, payload)
+            await pipe.execute()
+
+    async def _listen(self):
+        # A fresh PubSub each time, so a dropped connection is never reused
+        previous, self._pubsub = self._pubsub, self._redis.pubsub()
+        try:
+            await previous.aclose()
+        except Exception:
+            pass
+        await self._pubsub.subscribe(*(self.prefix + channel for channel in self._channels))
+        self._listening()
+        async for item in self._pubsub.listen():
+            if item["type"] != "message":
+                continue
+            channel = item["channel"].decode()[len(self.prefix):]
+            await self._deliver(channel, item["data"])
+
+    async def close(self):
+        await super().close()
+        await self._pubsub.aclose()
+        await self._redis.aclose()
+
+
+class MongoChangeStreamPubSub(BatchingPubSub):
+    """Backend that needs nothing beyond the MongoDB replica set we already run
+
+    Each flushed batch is one document in a TTL'd collection; every worker
+    tails inserts with a change stream and keeps the events for its users.
+    After a dropped stream the worker resumes from the last event it saw, so
+    nothing published in between is missed.
+    """
+
+    def __init__(self, app, collection: str = "ws_events", **kwargs):
+        super().__init__(**kwargs)
+        self.app = app
+        self.collection = collection
+        self._channels: Set[str] = set()
+        self._resume_token: Optional[dict] = None
+
+    def subscribe(self, channel: str):
+        self._channels.add(channel)
+
+    def unsubscribe(self, channel: str):
+        self._channels.discard(channel)
+
+    async def _send_batch(self, batch: List[Tuple[str, bytes]]):
+        await self.app.mongodb[self.collection].insert_one({
+            "events": [[channel, payload] for channel, payload in batch],
+            "created_at": datetime.now()
+        })
+
+    async def _listen(self):
+        pipeline = [{"$match": {"operationType": "insert"}}]
+        try:
+            async with self.app.mongodb[self.collection].watch(
+                pipeline, resume_after=self._resume_token
+            ) as stream:
+                self._listening()
+                async for change in stream:
+                    for channel, payload in change["fullDocument"]["events"]:
+                        if channel == BROADCAST_CHANNEL or channel in self._channels:
+                            await self._deliver(channel, payload)
+                    self._resume_token = stream.resume_token
+        except OperationFailure as e:
+            # ChangeStreamHistoryLost / ChangeStreamFatalError: the token can never be resumed from
+            if e.code in (280, 286):
+                logging.error(f"Cannot resume WebSocket event stream ({e}); starting from now")
+                self._resume_token = None
+            raise
+
+
+def create_pubsub(settings, app) -> PubSubBackend:
+    """Build the pub/sub backend selected by WEBSOCKET_PUBSUB_BACKEND"""
+    batching = {
+        "flush_interval": settings.PUBSUB_FLUSH_INTERVAL_MS / 1000,
+        "max_batch": settings.PUBSUB_MAX_BATCH
+    }
+    if settings.WEBSOCKET_PUBSUB_BACKEND == "memory":
+        return InMemoryPubSub()
+    elif settings.WEBSOCKET_PUBSUB_BACKEND == "redis":
+        return RedisPubSub(settings.REDIS_URL, **batching)
+    elif settings.WEBSOCKET_PUBSUB_BACKEND == "mongo":
+        return MongoChangeStreamPubSub(app, **batching)
+    else:
+        raise ValueError("Invalid WebSocket pub/sub backend configured")
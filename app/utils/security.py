@@ -1,10 +1,11 @@
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from fastapi import Depends, HTTPException, status,Request
+from fastapi import Depends, HTTPException, status,Request, WebSocket
 from fastapi.security import OAuth2PasswordBearer
 from typing import Optional
 import logging
+from bson import ObjectId
 
 from ..models.client import PyObjectId
 
@@ -33,52 +34,68 @@ def create_access_token(data: dict, secret_key: str, algorithm: str, expires_del
     encoded_jwt = jwt.encode(to_encode, secret_key, algorithm=algorithm)
     return encoded_jwt
 
-async def get_current_client(request: Request, token: str = Depends(oauth2_scheme)):
-    """Get the current authenticated client from the JWT token"""
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+async def _user_from_token(app, token: str, collections=("clients", "artisans"),
+                           projection: Optional[dict] = None) -> Optional[dict]:
+    """Decode a JWT and load its subject from the first collection that has it; None if invalid"""
     try:
         payload = jwt.decode(
-            token, 
-            request.app.settings.SECRET_KEY, 
-            algorithms=[request.app.settings.ALGORITHM]
+            token,
+            app.settings.SECRET_KEY,
+            algorithms=[app.settings.ALGORITHM]
         )
-        client_id: str = payload.get("sub")
-        if client_id is None:
-            raise credentials_exception
     except JWTError as e:
         logging.error(f"JWT error: {e}")
-        raise credentials_exception
-    
-    client = await request.app.mongodb["clients"].find_one({"_id": PyObjectId(client_id)})
-    if client is None:
-        raise credentials_exception
-    return client
+        return None
 
-async def get_current_artisan(request: Request, token: str = Depends(oauth2_scheme)):
-    """Get the current authenticated artisan from the JWT token"""
-    credentials_exception = HTTPException(
+    user_id = payload.get("sub")
+    if user_id is None or not ObjectId.is_valid(user_id):
+        return None
+
+    for collection in collections:
+        user = await app.mongodb[collection].find_one({"_id": PyObjectId(user_id)}, projection)
+        if user is not None:
+            return user
+    return None
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(
-            token, 
-            request.app.settings.SECRET_KEY, 
-            algorithms=[request.app.settings.ALGORITHM]
-        )
-        artisan_id: str = payload.get("sub")
-        if artisan_id is None:
-            raise credentials_exception
-    except JWTError as e:
-        logging.error(f"JWT error: {e}")
-        raise credentials_exception
-    
-    artisan = await request.app.mongodb["artisans"].find_one({"_id": PyObjectId(artisan_id)})
+
+async def get_current_client(request: Request, token: str = Depends(oauth2_scheme)):
+    """Get the current authenticated client from the JWT token"""
+    client = await _user_from_token(request.app, token, ["clients"])
+    if client is None:
+        raise _credentials_exception()
+    return client
+
+async def get_current_artisan(request: Request, token: str = Depends(oauth2_scheme)):
+    """Get the current authenticated artisan from the JWT token"""
+    artisan = await _user_from_token(request.app, token, ["artisans"])
     if artisan is None:
-        raise credentials_exception
-    return artisan
\ No newline at end of file
+        raise _credentials_exception()
+    return artisan
+
+async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)):
+    """Get the current authenticated client or artisan from the JWT token"""
+    user = await _user_from_token(request.app, token, projection={"hashed_password": 0})
+    if user is None:
+        raise _credentials_exception()
+    return user
+
+async def get_current_admin(request: Request, token: str = Depends(oauth2_scheme)):
+    """Get the current user, who must be listed in ADMIN_USER_IDS"""
+    user = await get_current_user(request, token)
+    admin_ids = {user_id.strip() for user_id in request.app.settings.ADMIN_USER_IDS.split(",")}
+    if str(user["_id"]) not in admin_ids:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+    return user
+
+async def get_websocket_user(websocket: WebSocket, token: str) -> Optional[dict]:
+    """Authenticate a WebSocket once at connect; returns the client or artisan, or None"""
+    return await _user_from_token(websocket.app, token, projection={"hashed_password": 0})
@@ -0,0 +1,137 @@
+from email.message import Message
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import logging
+import time
+
+import aiosmtplib
+
+
+class _PooledConnection:
+    def __init__(self, client: aiosmtplib.SMTP):
+        self.client = client
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+
+class SMTPConnectionPool:
+    """A few persistent, authenticated SMTP connections shared by every sender
+
+    Connecting, STARTTLS and AUTH happen once per connection rather than
+    once per message. A connection is retired after max_messages (relays
+    commonly cap messages per session) or after sitting idle for max_idle
+    seconds, before the server drops it. A send that fails because the
+    connection went away is retried once on a fresh connection.
+    """
+
+    def __init__(
+        self,
+        hostname: str,
+        port: int,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        size: int = 4,
+        max_messages: int = 100,
+        max_idle: float = 60.0,
+        timeout: float = 30.0,
+        use_tls: Optional[bool] = None
+    ):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self.timeout = timeout
+        # Implicit TLS on 465; elsewhere STARTTLS whenever the server offers it
+        self.use_tls = port == 465 if use_tls is None else use_tls
+        self.sent_total = 0
+        self.connects_total = 0
+        self._idle: List[_PooledConnection] = []
+        self._slots = asyncio.Semaphore(size)
+
+    async def _connect(self) -> _PooledConnection:
+        client = aiosmtplib.SMTP(
+            hostname=self.hostname,
+            port=self.port,
+            username=self.username or None,
+            password=self.password or None,
+            timeout=self.timeout,
+            use_tls=self.use_tls
+        )
+        await client.connect()
+        self.connects_total += 1
+        return _PooledConnection(client)
+
+    async def _discard(self, connection: _PooledConnection):
+        try:
+            await asyncio.wait_for(connection.client.quit(), self.timeout)
+        except Exception:
+            connection.client.close()
+
+    async def _acquire(self) -> _PooledConnection:
+        while self._idle:
+            connection = self._idle.pop()
+            if time.monotonic() - connection.last_used < self.max_idle and connection.client.is_connected:
+                return connection
+            await self._discard(connection)
+        return await self._connect()
+
+    async def _release(self, connection: _PooledConnection):
+        connection.last_used = time.monotonic()
+        if connection.sent >= self.max_messages:
+            await self._discard(connection)
+        else:
+            self._idle.append(connection)
+
+    async def send(self, message: Message):
+        """Send a message on a pooled connection, reconnecting once if it was dropped"""
+        async with self._slots:
+            connection = await self._acquire()
+            try:
+                await connection.client.send_message(message)
+            except (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError, ConnectionError) as e:
+                logging.info(f"SMTP connection to {self.hostname} lost ({e}); reconnecting")
+                connection.client.close()
+                connection = await self._connect()
+                try:
+                    await connection.client.send_message(message)
+                except Exception:
+                    await self._discard(connection)
+                    raise
+            except Exception:
+                # The session may be mid-transaction; don't hand it to the next sender
+                await self._discard(connection)
+                raise
+            connection.sent += 1
+            self.sent_total += 1
+            await self._release(connection)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(self._discard(connection) for connection in idle))
+
+
+_pools: Dict[Tuple[str, int, Optional[str]], SMTPConnectionPool] = {}
+_pool_options: dict = {}
+
+
+def configure_smtp_pools(**options):
+    """Set the size and limits used for pools created from now on"""
+    _pool_options.update(options)
+
+
+def get_smtp_pool(hostname: str, port: int, username: Optional[str], password: Optional[str]) -> SMTPConnectionPool:
+    """The shared pool for an SMTP account, created on first use"""
+    key = (hostname, port, username)
+    pool = _pools.get(key)
+    if pool is None:
+        pool = _pools[key] = SMTPConnectionPool(hostname, port, username, password, **_pool_options)
+    return pool
+
+
+async def close_smtp_pools():
+    pools = list(_pools.values())
+    _pools.clear()
+    await asyncio.gather(*(pool.close() for pool in pools))
@@ -1,66 +1,408 @@
-from fastapi import WebSocket, WebSocketDisconnect
-from typing import Dict, List
-import json
+from fastapi import WebSocket, WebSocketDisconnect, status
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set
+import asyncio
 import logging
+import time
+import zlib
 from bson import ObjectId
+import orjson
+
+from .pubsub import BROADCAST_CHANNEL, InMemoryPubSub, PubSubBackend
+
+# "text" is plain JSON text frames; "binary" is the same JSON bytes as
+# binary frames; "deflate" is zlib-compressed JSON in binary frames
+FRAME_ENCODINGS = ("text", "binary", "deflate")
+
+# Carries a message's coalesce key between workers; removed before the frame is built
+COALESCE_KEY_FIELD = "__coalesce_key__"
+
+
+def _frame_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def encode_frame(message) -> bytes:
+    """Encode a message as JSON; ObjectIds become strings and datetimes ISO 8601"""
+    return orjson.dumps(message, default=_frame_default)
+
+
+class Frame:
+    """One outbound message, encoded at most once per encoding however many sockets it goes to"""
+
+    __slots__ = ("message", "coalesce_key", "_encoded", "_text", "_compressed")
+
+    def __init__(self, message: dict, coalesce_key: Optional[str] = None):
+        self.message = message
+        self.coalesce_key = coalesce_key
+        self._encoded: Optional[bytes] = None
+        self._text: Optional[str] = None
+        self._compressed: Optional[bytes] = None
+
+    @property
+    def encoded(self) -> bytes:
+        if self._encoded is None:
+            self._encoded = encode_frame(self.message)
+        return self._encoded
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.encoded.decode()
+        return self._text
+
+    @property
+    def compressed(self) -> bytes:
+        if self._compressed is None:
+            self._compressed = zlib.compress(self.encoded)
+        return self._compressed
+
+
+class ConnectionWriter:
+    """Own one socket's bounded outbound queue and the task that drains it
+
+    Producers only ever enqueue, so nothing upstream waits on a slow socket.
+    A frame with a coalesce_key replaces a still-queued frame with the same
+    key instead of queueing behind it. Frames go out in the
+    encoding the client asked for when it connected.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        connection_id: str,
+        on_evict: Callable[[str, str], None],
+        max_queue: int = 256,
+        max_queue_delay: float = 10.0,
+        send_timeout: float = 5.0,
+        encoding: str = "text"
+    ):
+        self.websocket = websocket
+        self.connection_id = connection_id
+        self.encoding = encoding
+        self.max_queue = max_queue
+        self.max_queue_delay = max_queue_delay
+        self.send_timeout = send_timeout
+        self.sent = 0
+        self.coalesced = 0
+        self._on_evict = on_evict
+        # Entries are [frame, enqueued_at] lists so coalescing can swap the frame in place
+        self._queue: Deque[list] = deque()
+        self._coalesce: Dict[str, list] = {}
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    @property
+    def oldest_age(self) -> float:
+        return time.monotonic() - self._queue[0][1] if self._queue else 0.0
+
+    def enqueue(self, frame: Frame) -> bool:
+        """Queue a frame; False means the consumer is too far behind and should be evicted"""
+        coalesce_key = frame.coalesce_key
+        if coalesce_key is not None and coalesce_key in self._coalesce:
+            self._coalesce[coalesce_key][0] = frame
+            self.coalesced += 1
+            return True
+
+        if len(self._queue) >= self.max_queue or self.oldest_age > self.max_queue_delay:
+            return False
+
+        entry = [frame, time.monotonic()]
+        self._queue.append(entry)
+        if coalesce_key is not None:
+            self._coalesce[coalesce_key] = entry
+        self._ready.set()
+        return True
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+
+            entry = self._queue.popleft()
+            frame = entry[0]
+            coalesce_key = frame.coalesce_key
+            if coalesce_key is not None and self._coalesce.get(coalesce_key) is entry:
+                del self._coalesce[coalesce_key]
+
+            try:
+                await asyncio.wait_for(self._send(frame), self.send_timeout)
+            except Exception as e:
+                logging.error(f"Error sending message to {self.connection_id}: {e!r}")
+                self._on_evict(self.connection_id, "send failed")
+                return
+            self.sent += 1
+
+    def _send(self, frame: Frame):
+        if self.encoding == "binary":
+            return self.websocket.send_bytes(frame.encoded)
+        elif self.encoding == "deflate":
+            return self.websocket.send_bytes(frame.compressed)
+        return self.websocket.send_text(frame.text)
+
+    def stop(self):
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+
+class ConnectionListener:
+    """Receives connection lifecycle events from a ConnectionManager"""
+
+    def connection_opened(self, connection_id: str, user_id: str, first: bool):
+        """first is True when this is the user's only connection on this worker"""
+
+    def connection_closed(self, connection_id: str, user_id: str, last: bool):
+        """last is True when the user has no connections left on this worker"""
 
 class ConnectionManager:
-    """Manage WebSocket connections for real-time communication"""
+    """Manage WebSocket connections for real-time communication
+
+    Sends go through a pub/sub backend so a message reaches the user on
+    whichever worker process holds their connections; each worker delivers
+    only to its own sockets, by queueing on each connection's writer.
+    Channels registered with add_channel_handler are internal and go to
+    their handler instead of to sockets.
+
+    Every heartbeat_interval each socket is sent a ping frame, and sockets
+    nothing has been received from for idle_timeout are closed, at most
+    reap_batch_size at a time. Clients answer pings with a pong frame;
+    any inbound frame counts as a sign of life.
+    """
     
-    def __init__(self):
+    def __init__(
+        self,
+        send_timeout: float = 5.0,
+        max_queue: int = 256,
+        max_queue_delay: float = 10.0,
+        pubsub: Optional[PubSubBackend] = None,
+        heartbeat_interval: float = 25.0,
+        idle_timeout: float = 75.0,
+        reap_batch_size: int = 500,
+        max_connections_per_user: int = 5
+    ):
+        self.send_timeout = send_timeout
+        self.max_queue = max_queue
+        self.max_queue_delay = max_queue_delay
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.reap_batch_size = reap_batch_size
+        self.max_connections_per_user = max_connections_per_user
+        self.pubsub = pubsub or InMemoryPubSub()
+        self.pubsub.bind(self._deliver)
         self.active_connections: Dict[str, WebSocket] = {}
-        self.user_connections: Dict[str, List[str]] = {}
+        self.user_connections: Dict[str, Set[str]] = {}
+        # Reverse index so disconnect never scans every user
+        self.connection_users: Dict[str, str] = {}
+        self.writers: Dict[str, ConnectionWriter] = {}
+        # When something was last received on each connection (monotonic)
+        self.last_seen: Dict[str, float] = {}
+        self.evicted_total = 0
+        self.reaped_total = 0
+        self.listeners: List[ConnectionListener] = []
+        self.channel_handlers: Dict[str, Callable[[dict], Awaitable[None]]] = {}
+        self._closing: Set[asyncio.Task] = set()
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    def add_listener(self, listener: ConnectionListener):
+        self.listeners.append(listener)
+
+    def add_channel_handler(self, channel: str, handler: Callable[[dict], Awaitable[None]]):
+        """Route messages published on an internal channel to handler"""
+        self.channel_handlers[channel] = handler
+        self.pubsub.subscribe(channel)
+
+    async def start(self, pubsub: Optional[PubSubBackend] = None):
+        """Attach the pub/sub backend and begin delivering published messages"""
+        if pubsub is not None:
+            self.pubsub = pubsub
+            self.pubsub.bind(self._deliver)
+        await self.pubsub.start()
+        for channel in [*self.user_connections, *self.channel_handlers]:
+            self.pubsub.subscribe(channel)
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def close(self):
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            try:
+                await self._heartbeat_task
+            except asyncio.CancelledError:
+                pass
+        await self.pubsub.close()
+
+    def touch(self, connection_id: str):
+        """Record that a frame arrived on a connection"""
+        if connection_id in self.last_seen:
+            self.last_seen[connection_id] = time.monotonic()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.reap_idle()
+                # Coalesced, so a socket that is behind never holds more than one ping
+                self._enqueue_many(list(self.writers), {"type": "ping"}, coalesce_key="ping")
+            except Exception as e:
+                logging.error(f"Error in WebSocket heartbeat: {e}")
 
-    async def connect(self, websocket: WebSocket, user_id: str, connection_id: str):
-        """Accept a new WebSocket connection"""
+    async def reap_idle(self) -> int:
+        """Close connections idle for longer than idle_timeout, one batch at a time"""
+        cutoff = time.monotonic() - self.idle_timeout
+        stale = [connection_id for connection_id, seen in self.last_seen.items() if seen < cutoff]
+        for start in range(0, len(stale), self.reap_batch_size):
+            closing = [
+                self._evict(connection_id, "idle", code=status.WS_1001_GOING_AWAY)
+                for connection_id in stale[start:start + self.reap_batch_size]
+            ]
+            # Let each batch of close handshakes finish before starting the next
+            await asyncio.gather(*(task for task in closing if task is not None))
+        self.reaped_total += len(stale)
+        return len(stale)
+
+    async def connect(self, websocket: WebSocket, user_id: str, connection_id: str,
+                      encoding: str = "text"):
+        """Accept a new WebSocket connection that wants frames in the given encoding"""
         await websocket.accept()
+        existing = self.user_connections.get(user_id, ())
+        if len(existing) >= self.max_connections_per_user:
+            # Make room by dropping the connection we have heard from least recently
+            oldest = min(existing, key=lambda existing_id: self.last_seen.get(existing_id, 0.0))
+            self._evict(oldest, "per-user connection cap reached", code=status.WS_1008_POLICY_VIOLATION)
         self.active_connections[connection_id] = websocket
-        if user_id not in self.user_connections:
-            self.user_connections[user_id] = []
-        self.user_connections[user_id].append(connection_id)
+        self.last_seen[connection_id] = time.monotonic()
+        self.connection_users[connection_id] = user_id
+        self.writers[connection_id] = ConnectionWriter(
+            websocket,
+            connection_id,
+            self._evict,
+            max_queue=self.max_queue,
+            max_queue_delay=self.max_queue_delay,
+            send_timeout=self.send_timeout,
+            encoding=encoding
+        )
+        first = user_id not in self.user_connections
+        if first:
+            self.user_connections[user_id] = set()
+            self.pubsub.subscribe(user_id)
+        self.user_connections[user_id].add(connection_id)
+        for listener in self.listeners:
+            listener.connection_opened(connection_id, user_id, first)
         logging.info(f"New connection: {connection_id} for user {user_id}")
 
     def disconnect(self, connection_id: str):
         """Remove a WebSocket connection"""
-        if connection_id in self.active_connections:
-            del self.active_connections[connection_id]
-            for user_id, connections in self.user_connections.items():
-                if connection_id in connections:
-                    connections.remove(connection_id)
-                    if not connections:
-                        del self.user_connections[user_id]
-                    break
-            logging.info(f"Connection closed: {connection_id}")
-
-    async def send_personal_message(self, message: dict, user_id: str):
-        """Send a message to a specific user"""
-        if user_id in self.user_connections:
-            for connection_id in self.user_connections[user_id]:
-                if connection_id in self.active_connections:
-                    try:
-                        await self.active_connections[connection_id].send_json(message)
-                    except Exception as e:
-                        logging.error(f"Error sending message to {connection_id}: {e}")
-                        self.disconnect(connection_id)
+        if self.active_connections.pop(connection_id, None) is None:
+            return
+        self.last_seen.pop(connection_id, None)
+        writer = self.writers.pop(connection_id, None)
+        if writer is not None:
+            writer.stop()
+        user_id = self.connection_users.pop(connection_id, None)
+        connections = self.user_connections.get(user_id)
+        last = False
+        if connections is not None:
+            connections.discard(connection_id)
+            if not connections:
+                del self.user_connections[user_id]
+                self.pubsub.unsubscribe(user_id)
+                last = True
+        for listener in self.listeners:
+            listener.connection_closed(connection_id, user_id, last)
+        logging.info(f"Connection closed: {connection_id}")
+
+    def _evict(self, connection_id: str, reason: str,
+               code: int = status.WS_1013_TRY_AGAIN_LATER) -> Optional[asyncio.Task]:
+        """Drop a slow, broken or idle consumer; the client is expected to reconnect"""
+        websocket = self.active_connections.get(connection_id)
+        if websocket is None:
+            return None
+        logging.warning(f"Evicting WebSocket connection {connection_id}: {reason}")
+        self.evicted_total += 1
+        self.disconnect(connection_id)
+        task = asyncio.create_task(self._close_socket(websocket, code))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+        return task
+
+    async def _close_socket(self, websocket: WebSocket, code: int):
+        try:
+            await asyncio.wait_for(
+                websocket.close(code=code),
+                self.send_timeout
+            )
+        except Exception:
+            pass
+
+    def _enqueue_many(self, connection_ids: List[str], message: dict, coalesce_key: Optional[str] = None):
+        # Shared by every recipient, so it is encoded once however many sockets it reaches
+        frame = Frame(message, coalesce_key)
+        for connection_id in connection_ids:
+            writer = self.writers.get(connection_id)
+            if writer is not None and not writer.enqueue(frame):
+                self._evict(connection_id, f"send queue full ({writer.depth} queued)")
+
+    async def _deliver(self, channel: str, message: dict):
+        """Queue a published message on the writers of the sockets held by this process"""
+        handler = self.channel_handlers.get(channel)
+        if handler is not None:
+            await handler(message)
+            return
+        if channel == BROADCAST_CHANNEL:
+            # Snapshot first: evictions mutate the connection maps
+            connection_ids = list(self.writers)
+        else:
+            connection_ids = list(self.user_connections.get(channel, ()))
+        coalesce_key = message.get(COALESCE_KEY_FIELD)
+        if coalesce_key is not None:
+            message = {key: value for key, value in message.items() if key != COALESCE_KEY_FIELD}
+        self._enqueue_many(connection_ids, message, coalesce_key)
+
+    def send_to_connection(self, connection_id: str, message: dict):
+        """Queue a message for one local connection, such as an ack for a frame it sent"""
+        self._enqueue_many([connection_id], message)
+
+    async def send_personal_message(self, message: dict, user_id: str, coalesce_key: Optional[str] = None):
+        """Send a message to a specific user
+
+        A newer message with the same coalesce_key replaces one still queued
+        for the user's sockets; the key itself never reaches the client.
+        """
+        if coalesce_key is not None:
+            message = {**message, COALESCE_KEY_FIELD: coalesce_key}
+        await self.pubsub.publish(user_id, message)
 
     async def broadcast(self, message: dict):
         """Send a message to all connected clients"""
-        for connection_id, websocket in self.active_connections.items():
-            try:
-                await websocket.send_json(message)
-            except Exception as e:
-                logging.error(f"Error broadcasting to {connection_id}: {e}")
-                self.disconnect(connection_id)
-
-def serialize_for_websocket(data):
-    """Convert MongoDB documents to JSON-serializable format"""
-    if isinstance(data, (list, tuple)):
-        return [serialize_for_websocket(item) for item in data]
-    elif isinstance(data, dict):
-        return {key: serialize_for_websocket(value) for key, value in data.items()}
-    elif isinstance(data, ObjectId):
-        return str(data)
-    elif hasattr(data, 'isoformat'):
-        return data.isoformat()
-    else:
-        return data
\ No newline at end of file
+        await self.pubsub.publish(BROADCAST_CHANNEL, message)
+
+    def queue_depths(self) -> Dict[str, int]:
+        """Current outbound queue depth of every local connection"""
+        return {connection_id: writer.depth for connection_id, writer in self.writers.items()}
+
+    def metrics(self) -> dict:
+        """Aggregate send-queue gauges and counters for this process"""
+        depths = [writer.depth for writer in self.writers.values()]
+        # Stale: missed at least one heartbeat round trip, not yet reaped
+        stale_cutoff = time.monotonic() - self.heartbeat_interval * 2
+        stale = sum(1 for seen in self.last_seen.values() if seen < stale_cutoff)
+        return {
+            "connections": len(self.writers),
+            "live_connections": len(self.last_seen) - stale,
+            "stale_connections": stale,
+            "queued_messages": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "max_queue_delay_seconds": max(
+                (writer.oldest_age for writer in self.writers.values()), default=0.0
+            ),
+            "sent_messages": sum(writer.sent for writer in self.writers.values()),
+            "coalesced_messages": sum(writer.coalesced for writer in self.writers.values()),
+            "evicted_connections": self.evicted_total,
+            "reaped_connections": self.reaped_total,
+        }
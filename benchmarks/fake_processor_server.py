@@ -0,0 +1,93 @@
+"""Local stand-in for the Stripe and PayPal endpoints used by the payment processors
+
+Run it directly (``python benchmarks/fake_processor_server.py --latency-ms 50``)
+or start it in-process with ``run_in_thread`` from a benchmark.
+"""
+import argparse
+import asyncio
+import random
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from utils.cache import TTLCache
+
+
+def create_app(latency_ms: float = 50.0, failure_rate: float = 0.0) -> Starlette:
+    """Build the fake processor app, delaying every call by latency_ms"""
+    delay = latency_ms / 1000
+    # Like Stripe, a repeated Idempotency-Key gets the first charge back for a day
+    charges = TTLCache(maxsize=100000, ttl=86400)
+
+    async def stripe_charge(request: Request):
+        form = await request.form()
+        idempotency_key = request.headers.get("idempotency-key")
+        await asyncio.sleep(delay)
+        if idempotency_key:
+            replay = charges.get(idempotency_key)
+            if replay is not None:
+                return JSONResponse(replay, headers={"Idempotent-Replayed": "true"})
+        declined = random.random() < failure_rate
+        charge = {
+            "id": f"ch_{uuid.uuid4().hex[:24]}",
+            "object": "charge",
+            "amount": int(form.get("amount", 0)),
+            "currency": form.get("currency", "usd"),
+            "paid": not declined,
+            "status": "failed" if declined else "succeeded",
+            "failure_message": "Card declined" if declined else None
+        }
+        if idempotency_key:
+            charges.set(idempotency_key, charge)
+        return JSONResponse(charge)
+
+    async def paypal_token(request: Request):
+        await asyncio.sleep(delay)
+        return JSONResponse({
+            "access_token": uuid.uuid4().hex,
+            "token_type": "Bearer",
+            "expires_in": 32400
+        })
+
+    async def paypal_capture(request: Request):
+        await asyncio.sleep(delay)
+        return JSONResponse({
+            "id": request.path_params["order_id"],
+            "status": "COMPLETED"
+        })
+
+    return Starlette(routes=[
+        Route("/v1/charges", stripe_charge, methods=["POST"]),
+        Route("/v1/oauth2/token", paypal_token, methods=["POST"]),
+        Route("/v2/checkout/orders/{order_id}/capture", paypal_capture, methods=["POST"]),
+    ])
+
+
+def run_in_thread(port: int, latency_ms: float = 50.0, failure_rate: float = 0.0) -> uvicorn.Server:
+    """Start the fake server on a daemon thread and wait until it accepts connections"""
+    server = uvicorn.Server(uvicorn.Config(
+        create_app(latency_ms, failure_rate), host="127.0.0.1", port=port, log_level="warning"
+    ))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency_ms, args.failure_rate), host="127.0.0.1", port=args.port)
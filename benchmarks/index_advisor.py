@@ -0,0 +1,774 @@
+"""Query-shape index advisor: explain() every query the app issues against seeded data
+
+Seeds a scratch database on a local mongod with a few thousand documents
+per collection, creates the app's indexes (utils.database.INDEXES), then
+runs explain("executionStats") for each query shape in QUERY_SHAPES, the
+filters, sorts and limits the routers and workers actually send. A shape
+is flagged for:
+
+    collscan          the winning plan reads the whole collection
+    in_memory_sort    a blocking SORT stage; no index provides the order
+    poor_selectivity  keys or documents examined per result above --max-ratio
+
+Each flagged shape gets a recommended index, built equality fields first,
+then the sort, then range fields. Findings a shape knowingly accepts are
+listed in its allow set.
+
+Every shape names the functions that send it. Before explaining anything
+the advisor reads the app's source and finds each query call on a
+collection; one whose filter is not keyed on _id must be covered by a
+shape naming its function and collection, or be listed in UNSHAPED with
+the reason. So a new router query, or a shape whose query was removed,
+shows up without a database.
+
+With --check the run exits non-zero on an uncovered query, a stale shape,
+or any finding a shape does not allow, so a dropped index or a new
+unindexed query fails the check. --coverage-only runs just the source
+check. Everything else needs a mongod to talk to, e.g.
+
+    docker run --rm -p 27017:27017 mongo:7
+    python benchmarks/index_advisor.py --check
+"""
+import argparse
+import ast
+import asyncio
+import json
+import random
+import sys
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+sys.path.insert(0, str(APP_DIR))
+
+from utils.conversations import conversation_key
+from utils.database import INDEXES, create_indexes
+from utils.ledger import _ledger_entry, to_minor_units
+from utils.pagination import keyset_range
+
+class QueryShape:
+    """One query as the app issues it; filter and sort are built from seeded samples
+
+    sources are the functions that send it, as "<path under app/>:<function>".
+    """
+
+    def __init__(
+        self,
+        name: str,
+        collection: str,
+        filter: Callable[["Samples"], dict],
+        sort: Optional[List[tuple]] = None,
+        limit: Optional[int] = None,
+        projection: Optional[dict] = None,
+        allow: Set[str] = frozenset(),
+        note: str = "",
+        sources: Tuple[str, ...] = ()
+    ):
+        self.name = name
+        self.collection = collection
+        self.filter = filter
+        self.sort = sort or []
+        self.limit = limit
+        self.projection = projection
+        self.allow = set(allow)
+        self.note = note
+        self.sources = sources
+
+
+class Samples:
+    """Concrete values for query shapes, taken from the busiest seeded users"""
+
+    def __init__(self, now: datetime, client_id, partner_id, artisan_id, message: dict, notification: dict,
+                 booking_id, transaction_ids: List[str]):
+        self.now = now
+        self.client_id = client_id
+        self.partner_id = partner_id
+        self.artisan_id = artisan_id
+        self.message = message
+        self.notification = notification
+        self.booking_id = booking_id
+        self.transaction_ids = transaction_ids
+        self.conversation_key = conversation_key(client_id, partner_id)
+
+
+QUERY_SHAPES = [
+    # Bookings
+    QueryShape("bookings.list", "bookings",
+               lambda s: {"client_id": s.client_id}, sort=[("date", 1)], limit=100,
+               sources=("routers/bookings.py:get_client_bookings",)),
+    QueryShape("bookings.list_by_status", "bookings",
+               lambda s: {"client_id": s.client_id, "status": "accepted"}, sort=[("date", 1)], limit=100,
+               sources=("routers/bookings.py:get_client_bookings",)),
+    QueryShape("bookings.dashboard_upcoming", "bookings",
+               lambda s: {"client_id": s.client_id, "status": {"$in": ["pending", "accepted"]},
+                          "date": {"$gte": s.now}},
+               sort=[("date", 1)], limit=5,
+               sources=("routers/clients.py:get_client_dashboard",)),
+    QueryShape("bookings.dashboard_past", "bookings",
+               lambda s: {"client_id": s.client_id, "status": "completed", "date": {"$lt": s.now}},
+               sort=[("date", -1)], limit=5,
+               sources=("routers/clients.py:get_client_dashboard",)),
+    QueryShape("bookings.dashboard_unpaid", "bookings",
+               lambda s: {"client_id": s.client_id, "status": "accepted", "payment_status": {"$ne": "paid"}},
+               sort=[("date", 1)], limit=5,
+               sources=("routers/clients.py:get_client_dashboard",)),
+    QueryShape("bookings.availability", "bookings",
+               lambda s: {"artisan_id": s.artisan_id, "status": {"$in": ["pending", "accepted"]},
+                          "$or": [
+                              {"date": {"$lt": s.now + timedelta(hours=2)}, "end_time": {"$gt": s.now}},
+                              {"date": {"$gte": s.now, "$lt": s.now + timedelta(hours=2)}}
+                          ]},
+               sources=("routers/bookings.py:check_artisan_availability",)),
+    QueryShape("bookings.export", "bookings",
+               lambda s: {"client_id": s.client_id}, sort=[("created_at", 1)],
+               sources=("routers/bookings.py:export_client_bookings",)),
+    # Payments
+    QueryShape("payments.list", "payments",
+               lambda s: {"client_id": s.client_id}, sort=[("created_at", -1)], limit=100,
+               sources=("routers/payments.py:get_client_payments",)),
+    QueryShape("payments.list_by_status", "payments",
+               lambda s: {"client_id": s.client_id, "status": "completed"}, sort=[("created_at", -1)], limit=100,
+               sources=("routers/payments.py:get_client_payments",)),
+    QueryShape("payments.export", "payments",
+               lambda s: {"client_id": s.client_id}, sort=[("created_at", 1)],
+               sources=("routers/payments.py:export_client_payments",)),
+    QueryShape("payments.completed_for_booking", "payments",
+               lambda s: {"booking_id": s.booking_id, "status": "completed"},
+               sources=("routers/payments.py:record_booking_payment",)),
+    QueryShape("payments.by_transaction", "payments",
+               lambda s: {"transaction_id": {"$in": s.transaction_ids}},
+               sources=("utils/payment_webhooks.py:apply_payment_events",)),
+    QueryShape("artisan_balances.by_artisan", "artisan_balances",
+               lambda s: {"artisan_id": s.artisan_id},
+               sources=("utils/ledger.py:get_artisan_balances",)),
+    QueryShape("ledger_entries.unsettled", "ledger_entries",
+               lambda s: {"payout_id": None, "created_at": {"$lt": s.now}},
+               sort=[("artisan_id", 1), ("currency", 1), ("_id", 1)],
+               sources=("utils/ledger.py:run_payouts",)),
+    # Artisans and reviews
+    QueryShape("artisans.search_text", "artisans",
+               lambda s: {"$text": {"$search": "plumber"}},
+               sort=[("score", {"$meta": "textScore"})], limit=10,
+               projection={"score": {"$meta": "textScore"}},
+               sources=("routers/artisans.py:search_artisans",)),
+    QueryShape("artisans.search_by_rating", "artisans",
+               lambda s: {"rating": {"$gte": 4.0}}, sort=[("rating", -1)], limit=10,
+               sources=("routers/artisans.py:search_artisans",)),
+    QueryShape("artisans.search_by_location", "artisans",
+               lambda s: {"location": {"$regex": "lagos", "$options": "i"}}, limit=10,
+               allow={"collscan", "poor_selectivity"},
+               note="case-insensitive substring match; no B-tree index can serve it",
+               sources=("routers/artisans.py:search_artisans",)),
+    QueryShape("reviews.feed", "reviews",
+               lambda s: {"artisan_id": s.artisan_id}, sort=[("created_at", -1), ("_id", -1)], limit=21,
+               sources=("routers/artisans.py:_fetch_review_page",)),
+    QueryShape("reviews.rating_histogram", "reviews",
+               lambda s: {"artisan_id": s.artisan_id},
+               sources=("routers/reviews.py:update_artisan_rating",)),
+    QueryShape("reviews.by_booking", "reviews",
+               lambda s: {"booking_id": s.booking_id},
+               sources=("routers/reviews.py:create_review",)),
+    # Messages and conversations
+    QueryShape("messages.thread", "messages",
+               lambda s: {"conversation_key": s.conversation_key},
+               sort=[("created_at", -1), ("_id", -1)], limit=50,
+               sources=("routers/messages.py:get_messages",)),
+    QueryShape("messages.thread_before", "messages",
+               lambda s: {"$and": [
+                   {"conversation_key": s.conversation_key},
+                   keyset_range(s.message["created_at"], s.message["_id"], direction=-1)
+               ]},
+               sort=[("created_at", -1), ("_id", -1)], limit=50,
+               sources=("routers/messages.py:get_messages",)),
+    QueryShape("messages.inbox", "messages",
+               lambda s: {"$or": [{"sender_id": s.client_id}, {"recipient_id": s.client_id}]},
+               sort=[("created_at", -1), ("_id", -1)], limit=50,
+               sources=("routers/messages.py:get_messages",)),
+    QueryShape("messages.replay", "messages",
+               lambda s: {"recipient_id": s.client_id,
+                          **keyset_range(s.message["created_at"], s.message["_id"], direction=1)},
+               sort=[("created_at", 1), ("_id", 1)], limit=1001,
+               sources=("routers/messages.py:replay_missed_events",)),
+    QueryShape("messages.unread_in_thread", "messages",
+               lambda s: {"conversation_key": s.conversation_key, "recipient_id": s.client_id, "read": False},
+               sources=("routers/messages.py:mark_conversation_as_read",)),
+    QueryShape("conversations.list", "conversations",
+               lambda s: {"participants": s.client_id},
+               sort=[("last_message_at", -1), ("_id", -1)], limit=21,
+               sources=("routers/messages.py:get_conversations", "routers/clients.py:get_client_dashboard")),
+    QueryShape("conversations.by_participant", "conversations",
+               lambda s: {"participants": s.client_id},
+               sources=("utils/conversations.py:refresh_participant_summary",)),
+    QueryShape("reports.by_reporter", "reports",
+               lambda s: {"message_id": s.message["_id"], "reporter_id": s.message["recipient_id"]},
+               sources=("routers/messages.py:report_message",)),
+    # Notifications
+    QueryShape("notifications.list", "notifications",
+               lambda s: {"user_id": s.client_id}, sort=[("created_at", -1), ("_id", -1)], limit=21,
+               sources=("routers/notifications.py:get_notifications", "routers/clients.py:get_client_dashboard")),
+    QueryShape("notifications.list_unread", "notifications",
+               lambda s: {"user_id": s.client_id, "read": False},
+               sort=[("created_at", -1), ("_id", -1)], limit=21,
+               sources=("routers/notifications.py:get_notifications",)),
+    QueryShape("notifications.replay", "notifications",
+               lambda s: {"user_id": s.client_id, "created_at": {"$gte": s.notification["created_at"]}},
+               sort=[("created_at", 1), ("_id", 1)], limit=1000,
+               sources=("routers/messages.py:replay_missed_events",)),
+    QueryShape("notifications.unread_count", "notifications",
+               lambda s: {"user_id": s.client_id, "read": False},
+               sources=("utils/notifications.py:mark_notifications_read",)),
+    QueryShape("notifications.mark_read_up_to", "notifications",
+               lambda s: {"user_id": s.client_id, "read": False, "$or": [
+                   {"created_at": {"$lt": s.now}},
+                   {"created_at": s.now, "_id": {"$lte": ObjectId()}}
+               ]},
+               sources=("utils/notifications.py:mark_notifications_read",)),
+    QueryShape("notifications.digest_pass", "notifications",
+               lambda s: {"pending_channels": "email", "created_at": {"$lt": s.now}},
+               sort=[("user_id", 1), ("created_at", 1)],
+               sources=("utils/digests.py:run_channel",)),
+    # Queues and workers
+    QueryShape("email_outbox.claim", "email_outbox",
+               lambda s: {"status": "pending", "next_attempt_at": {"$lte": s.now},
+                          "$or": [{"locked_until": None}, {"locked_until": {"$lt": s.now}}]},
+               sort=[("next_attempt_at", 1)], limit=100, projection={"_id": 1},
+               sources=("utils/email_outbox.py:_claim_batch",)),
+    QueryShape("payment_webhook_events.claim", "payment_webhook_events",
+               lambda s: {"status": "pending",
+                          "$or": [{"locked_until": None}, {"locked_until": {"$lt": s.now}}]},
+               sort=[("received_at", 1)], limit=500, projection={"_id": 1},
+               sources=("utils/payment_webhooks.py:_claim_batch",)),
+    QueryShape("clients.by_email", "clients",
+               lambda s: {"email": "client0@example.com"},
+               sources=("routers/clients.py:login_client", "routers/clients.py:register_client")),
+]
+
+# Query call sites that have no shape on purpose, with the reason
+UNSHAPED: Dict[str, str] = {
+    "utils/booking_claims.py:claim_booking_payment": "claims one booking by _id",
+    "utils/conversations.py:backfill_conversation_keys": "one-off migration, walks messages in _id order",
+    "utils/conversations.py:rebuild_conversations": "maintenance rebuild; reads every message by design",
+}
+
+QUERY_METHODS = {
+    "find", "find_one", "count_documents", "aggregate", "distinct",
+    "update_one", "update_many", "replace_one", "delete_one", "delete_many",
+    "find_one_and_update", "find_one_and_replace", "find_one_and_delete"
+}
+
+
+class _QueryFinder(ast.NodeVisitor):
+    """Collect (function, collection, line, call) for every query on a db["..."] collection
+
+    A collection handed to a helper, as in export_response(db["payments"], ...),
+    counts as a query by the function that hands it over.
+    """
+
+    def __init__(self, constants: Dict[str, str]):
+        self.constants = constants
+        self.function = "<module>"
+        self.sites: List[Tuple[str, str, int, str]] = []
+
+    def visit_FunctionDef(self, node):
+        outer, self.function = self.function, node.name
+        self.generic_visit(node)
+        self.function = outer
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def _collection(self, node) -> Optional[str]:
+        if not isinstance(node, ast.Subscript):
+            return None
+        if ast.unparse(node.value).rsplit(".", 1)[-1] not in ("db", "mongodb"):
+            return None
+        key = node.slice
+        if isinstance(key, ast.Constant) and isinstance(key.value, str):
+            return key.value
+        if isinstance(key, ast.Name) and key.id in self.constants:
+            return self.constants[key.id]
+        return ast.unparse(key)
+
+    def visit_Call(self, node):
+        func = node.func
+        collection = self._collection(func.value) if isinstance(func, ast.Attribute) else None
+        if collection is not None and func.attr in QUERY_METHODS:
+            filter = node.args[0] if node.args else None
+            keyed = isinstance(filter, ast.Dict) and any(
+                isinstance(key, ast.Constant) and key.value == "_id" for key in filter.keys
+            )
+            if not keyed:
+                self.sites.append((self.function, collection, node.lineno, func.attr))
+        for argument in node.args:
+            handed = self._collection(argument)
+            if handed is not None:
+                self.sites.append((self.function, handed, node.lineno, ast.unparse(func)))
+        self.generic_visit(node)
+
+
+def query_sites() -> List[dict]:
+    """Every query in the app's source that is not keyed on _id"""
+    trees = {path: ast.parse(path.read_text(encoding="utf-8")) for path in sorted(APP_DIR.rglob("*.py"))}
+    # Collection names are often module constants imported elsewhere, so gather them app-wide
+    constants = {
+        target.id: node.value.value
+        for tree in trees.values() for node in tree.body if isinstance(node, ast.Assign)
+        and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+        for target in node.targets if isinstance(target, ast.Name)
+    }
+    sites = []
+    for path, tree in trees.items():
+        finder = _QueryFinder(constants)
+        finder.visit(tree)
+        relative = path.relative_to(APP_DIR).as_posix()
+        sites.extend(
+            {"source": f"{relative}:{function}", "collection": collection, "line": line, "call": call}
+            for function, collection, line, call in finder.sites
+        )
+    return sites
+
+
+def coverage(shapes: List[QueryShape]) -> Tuple[List[dict], List[str]]:
+    """Query call sites no shape covers, and shape sources that no longer send that query"""
+    sites = query_sites()
+    found = {(site["source"], site["collection"]) for site in sites}
+    covered = {(source, shape.collection) for shape in shapes for source in shape.sources}
+    uncovered = [
+        site for site in sites
+        if (site["source"], site["collection"]) not in covered and site["source"] not in UNSHAPED
+    ]
+    stale = sorted(
+        f"{shape.name}: {source}" for shape in shapes for source in shape.sources
+        if (source, shape.collection) not in found
+    ) + sorted(
+        f"UNSHAPED: {source}" for source in UNSHAPED
+        if not any(site["source"] == source for site in sites)
+    )
+    return uncovered, stale
+
+
+# Platform fee applied when seeding the ledger, in basis points
+SEED_FEE_BPS = 1000
+
+
+async def seed(db, scale: int, rng: random.Random) -> Samples:
+    """Fill a scratch database with data shaped like production, skewed toward a few busy users
+
+    Documents carry the fields and values the app writes; ledger entries are
+    built with utils.ledger the way payments, refunds and payout runs record them.
+    """
+    now = datetime.now()
+    clients = [ObjectId() for _ in range(50 * scale)]
+    artisans = [ObjectId() for _ in range(20 * scale)]
+    professions = ["plumber", "electrician", "carpenter", "painter", "mason", "tailor"]
+    cities = ["Lagos", "Abuja", "Ibadan", "Kano", "Enugu"]
+
+    # Activity follows rank, so a few accounts hold most of the documents, as real ones do
+    def skewed(users):
+        weights = [1 / (rank + 1) for rank in range(len(users))]
+        return lambda: rng.choices(users, weights)[0]
+
+    some_client, some_artisan = skewed(clients), skewed(artisans)
+
+    def when(days: float = 180):
+        return now - timedelta(seconds=rng.uniform(-30 * 86400, days * 86400))
+
+    def before_now(days: float = 180):
+        return now - timedelta(seconds=rng.uniform(0, days * 86400))
+
+    await db["clients"].insert_many([
+        {"_id": client_id, "name": f"Client {index}", "email": f"client{index}@example.com",
+         "location": rng.choice(cities), "hashed_password": "", "created_at": when()}
+        for index, client_id in enumerate(clients)
+    ])
+    await db["artisans"].insert_many([
+        {"_id": artisan_id, "name": f"Artisan {index}", "email": f"artisan{index}@example.com",
+         "profession": rng.choice(professions), "skills": rng.sample(professions, 2),
+         "location": rng.choice(cities), "rating": round(rng.uniform(1, 5), 1), "created_at": when()}
+        for index, artisan_id in enumerate(artisans)
+    ])
+
+    bookings = []
+    for _ in range(1000 * scale):
+        date = when()
+        bookings.append({
+            "client_id": some_client(), "artisan_id": some_artisan(), "service_name": "Repair",
+            "date": date, "end_time": date + timedelta(hours=2), "duration": 2,
+            "status": rng.choice(["pending", "accepted", "completed", "completed", "declined", "cancelled"]),
+            "payment_status": rng.choice(["pending"] * 4 + ["paid"] * 4 + ["failed", "refunded", "partially_refunded"]),
+            "created_at": date - timedelta(days=3)
+        })
+    await db["bookings"].insert_many(bookings)
+
+    payments = []
+    for index in range(600 * scale):
+        created_at = before_now()
+        payment = {
+            "_id": ObjectId(), "client_id": some_client(), "artisan_id": some_artisan(), "booking_id": ObjectId(),
+            "amount": float(rng.randint(10, 500)), "method": rng.choice(["credit_card", "paypal"]),
+            "currency": "USD", "transaction_id": f"ch_{index:024d}",
+            "status": rng.choice(["completed"] * 6 + ["pending", "failed", "partially_refunded", "refunded"]),
+            "created_at": created_at, "updated_at": created_at
+        }
+        amount_minor = to_minor_units(payment["amount"], payment["currency"])
+        if payment["status"] == "refunded":
+            payment["refunded_minor"] = amount_minor
+        elif payment["status"] == "partially_refunded":
+            payment["refunded_minor"] = rng.randint(1, amount_minor - 1)
+        payments.append(payment)
+    await db["payments"].insert_many(payments)
+
+    # Ledger: a charge and a fee per paid payment, a refund debit per refunded one,
+    # all referenced by the payment id; weekly payout runs have settled all but the last week
+    entries = []
+    for payment in payments:
+        if payment["status"] in ("pending", "failed"):
+            continue
+        artisan_id, currency = payment["artisan_id"], payment["currency"]
+        amount_minor = to_minor_units(payment["amount"], currency)
+        reference_id = str(payment["_id"])
+        recorded = [
+            _ledger_entry(artisan_id, "charge", amount_minor, currency, reference_id),
+            _ledger_entry(artisan_id, "fee", amount_minor * SEED_FEE_BPS // 10000, currency, reference_id)
+        ]
+        for entry in recorded:
+            entry["created_at"] = payment["created_at"]
+        refunded_minor = payment.get("refunded_minor", 0)
+        if refunded_minor:
+            refund = _ledger_entry(
+                artisan_id, "refund", refunded_minor, currency,
+                reference_id if refunded_minor >= amount_minor else f"{reference_id}:{refunded_minor}"
+            )
+            refund["created_at"] = min(payment["created_at"] + timedelta(days=rng.uniform(0, 14)), now)
+            recorded.append(refund)
+        entries.extend(recorded)
+
+    runs: Dict[int, Tuple[str, datetime]] = {}
+    payouts: Counter = Counter()
+    for entry in entries:
+        weeks = (now - entry["created_at"]).days // 7
+        if not weeks:
+            continue
+        run_at = now - timedelta(days=7 * weeks)
+        payout_id, _ = runs.setdefault(
+            weeks, (f"payout_{run_at:%Y%m%d%H%M%S}_{rng.getrandbits(32):08x}", run_at)
+        )
+        entry["payout_id"] = payout_id
+        payouts[(weeks, entry["artisan_id"], entry["currency"])] += entry["amount_minor"]
+    for (weeks, artisan_id, currency), amount_minor in payouts.items():
+        if amount_minor <= 0:
+            continue
+        payout_id, run_at = runs[weeks]
+        payout = _ledger_entry(artisan_id, "payout", amount_minor, currency,
+                               reference_id=f"{payout_id}:{artisan_id}:{currency}", payout_id=payout_id)
+        payout["created_at"] = run_at
+        entries.append(payout)
+    await db["ledger_entries"].insert_many(entries)
+
+    balances: Counter = Counter()
+    for entry in entries:
+        balances[(entry["artisan_id"], entry["currency"])] += entry["amount_minor"]
+    await db["artisan_balances"].insert_many([
+        {"artisan_id": artisan_id, "currency": currency, "balance_minor": balance_minor, "updated_at": now}
+        for (artisan_id, currency), balance_minor in balances.items()
+    ])
+
+    reviewed = rng.sample(bookings, min(400 * scale, len(bookings)))
+    await db["reviews"].insert_many([
+        {"artisan_id": booking["artisan_id"], "client_id": booking["client_id"], "booking_id": booking["_id"],
+         "rating": rng.randint(1, 5), "comment": "Good work", "created_at": when()}
+        for booking in reviewed
+    ])
+
+    messages = []
+    for _ in range(4000 * scale):
+        sender, recipient = some_client(), some_client()
+        if sender == recipient:
+            continue
+        messages.append({
+            "sender_id": sender, "recipient_id": recipient, "content": "hello",
+            "conversation_key": conversation_key(sender, recipient),
+            "read": rng.random() < 0.8, "created_at": when()
+        })
+    await db["messages"].insert_many(messages)
+
+    conversations = {}
+    for message in messages:
+        conversation = conversations.setdefault(message["conversation_key"], {
+            "conversation_key": message["conversation_key"],
+            "participants": sorted([message["sender_id"], message["recipient_id"]]),
+            "last_message_at": message["created_at"]
+        })
+        conversation["last_message_at"] = max(conversation["last_message_at"], message["created_at"])
+    await db["conversations"].insert_many(list(conversations.values()))
+
+    # The busiest users make the worst-case samples; artisans[0] has the highest weight
+    client_id, _ = Counter(m["recipient_id"] for m in messages).most_common(1)[0]
+    (partner_id, _), = Counter(m["sender_id"] for m in messages if m["recipient_id"] == client_id).most_common(1)
+    thread = sorted(
+        (m for m in messages if m["conversation_key"] == conversation_key(client_id, partner_id)),
+        key=lambda m: m["created_at"]
+    )
+    message = thread[len(thread) // 2]
+
+    reported = rng.sample([m for m in messages if m is not message], min(50 * scale, len(messages) - 1))
+    reported.append(message)
+    await db["reports"].insert_many([
+        {"message_id": report["_id"], "reporter_id": report["recipient_id"],
+         "sender_id": report["sender_id"], "recipient_id": report["recipient_id"],
+         "reason": "spam", "created_at": report["created_at"], "status": "pending"}
+        for report in reported
+    ])
+
+    await db["notifications"].insert_many([
+        {"user_id": some_client(), "type": "new_message", "message": "You have a message",
+         "read": rng.random() < 0.7, "pending_channels": ["email"] if rng.random() < 0.1 else [],
+         "created_at": when(90)}
+        for _ in range(4000 * scale)
+    ])
+    await db["email_outbox"].insert_many([
+        {"recipient_email": "someone@example.com", "subject": "Hi", "body": "",
+         "status": rng.choice(["sent"] * 8 + ["pending", "dead"]), "attempts": 1,
+         "next_attempt_at": when(7), "locked_until": None, "created_at": when(7)}
+        for _ in range(400 * scale)
+    ])
+    await db["payment_webhook_events"].insert_many([
+        {"_id": f"stripe:evt_{index}", "provider": "stripe", "event_type": "charge.succeeded",
+         "transaction_id": rng.choice(payments)["transaction_id"], "amount_refunded": None, "payload": {},
+         "status": rng.choice(["processed"] * 9 + ["pending"]), "attempts": 1,
+         "locked_until": None, "received_at": when(30)}
+        for index in range(200 * scale)
+    ])
+
+    notification = await db["notifications"].find_one({"user_id": client_id}, sort=[("created_at", 1)])
+    return Samples(
+        now, client_id, partner_id, artisans[0], message,
+        notification or {"_id": ObjectId(), "created_at": now - timedelta(days=7)},
+        reviewed[0]["_id"],
+        # A webhook batch looks payments up by the transaction ids it carries
+        [payment["transaction_id"] for payment in rng.sample(payments, min(500, len(payments)))]
+    )
+
+
+def _stages(plan: dict):
+    """Every stage of a plan tree, classic or slot-based engine"""
+    plan = plan.get("queryPlan", plan)
+    yield plan
+    for child in ([plan["inputStage"]] if "inputStage" in plan else []) + plan.get("inputStages", []):
+        yield from _stages(child)
+
+
+def _is_equality(condition) -> bool:
+    # A plain value, None included, is an exact match on the index key
+    if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+        return set(condition) <= {"$eq", "$in"}
+    return True
+
+
+def _classify(filter: dict, equality: List[str], ranges: List[str], alternatives: List[list]):
+    for field, condition in filter.items():
+        if field == "$and":
+            for clause in condition:
+                _classify(clause, equality, ranges, alternatives)
+        elif field == "$or":
+            alternatives.append(condition)
+        elif field.startswith("$") or field == "_id":
+            continue
+        elif _is_equality(condition):
+            equality.append(field)
+        else:
+            ranges.append(field)
+
+
+def recommend(filter: dict, sort: List[tuple]) -> List[Tuple[List[tuple], int]]:
+    """Index keys for a shape: equality fields, then the sort, then range fields
+
+    Returns each recommendation with how many of its keys are equality
+    fields, whose direction does not matter.
+
+    An $or over the sort fields (keyset pagination) or over one field
+    (null-or-expired leases) is a range on those fields. An $or whose
+    branches test different fields gets one index per branch, each led by
+    the shared equality fields, so the planner can merge the branches.
+    """
+    equality, ranges, alternatives = [], [], []
+    _classify(filter, equality, ranges, alternatives)
+    sort_fields = {field for field, _ in sort} | {"_id"}
+
+    branches = [{}]
+    for alternative in alternatives:
+        fields = [{field for field in branch if not field.startswith("$")} for branch in alternative]
+        union = set().union(*fields)
+        if union <= sort_fields | set(equality) or len(union) == 1:
+            ranges.extend(sorted(union - sort_fields))
+        elif branches == [{}]:
+            branches = alternative
+        else:
+            ranges.extend(sorted(union))
+
+    recommended = []
+    for branch in branches:
+        branch_equality, branch_ranges = [], []
+        _classify(branch, branch_equality, branch_ranges, [])
+        keys = []
+        for field in equality + branch_equality:
+            if field not in dict(keys):
+                keys.append((field, 1))
+        leading = len(keys)
+        for field, direction in sort:
+            if isinstance(direction, int) and field not in dict(keys):
+                keys.append((field, direction))
+        for field in ranges + branch_ranges:
+            if field not in dict(keys):
+                keys.append((field, 1))
+        if keys and (keys, leading) not in recommended:
+            recommended.append((keys, leading))
+    # A recommendation that is a prefix of another is served by the longer one
+    return [
+        (keys, leading) for keys, leading in recommended
+        if not any(other != keys and other[:len(keys)] == keys for other, _ in recommended)
+    ]
+
+
+def existing_index(collection: str, keys: List[tuple], leading: int) -> Optional[str]:
+    """Name of a declared index that could serve the recommended keys
+
+    Its keys must start with the recommended fields. Past the equality
+    fields, directions must all match or all be reversed, since an index
+    can be walked backwards.
+    """
+    for model in INDEXES.get(collection, []):
+        declared = list(model.document["key"].items())[:len(keys)]
+        if [field for field, _ in declared] != [field for field, _ in keys]:
+            continue
+        if not all(isinstance(direction, int) for _, direction in declared):
+            continue
+        signs = {wanted * have for (_, wanted), (_, have) in zip(keys[leading:], declared[leading:])}
+        if len(signs) <= 1:
+            return model.document["name"]
+    return None
+
+
+async def analyse(db, shape: QueryShape, samples: Samples, max_ratio: float) -> dict:
+    filter = shape.filter(samples)
+    command = {"find": shape.collection, "filter": filter}
+    if shape.sort:
+        command["sort"] = dict(shape.sort)
+    if shape.limit:
+        command["limit"] = shape.limit
+    if shape.projection:
+        command["projection"] = shape.projection
+    explain = await db.command({"explain": command, "verbosity": "executionStats"})
+
+    stats = explain["executionStats"]
+    stage_names = [stage["stage"] for stage in _stages(explain["queryPlanner"]["winningPlan"])]
+    matched = await db[shape.collection].count_documents(filter) if "$text" not in filter else stats["nReturned"]
+    expected = max(min(matched, shape.limit) if shape.limit else matched, 1)
+    examined = max(stats["totalKeysExamined"], stats["totalDocsExamined"])
+
+    flags = []
+    if "COLLSCAN" in stage_names:
+        flags.append("collscan")
+    if "SORT" in stage_names:
+        flags.append("in_memory_sort")
+    if examined / expected > max_ratio:
+        flags.append("poor_selectivity")
+
+    recommended = recommend(filter, shape.sort) if flags else []
+    return {
+        "shape": shape.name,
+        "collection": shape.collection,
+        "plan": " <- ".join(stage_names),
+        "returned": stats["nReturned"],
+        "keys_examined": stats["totalKeysExamined"],
+        "docs_examined": stats["totalDocsExamined"],
+        "millis": stats["executionTimeMillis"],
+        "flags": flags,
+        "regressions": [flag for flag in flags if flag not in shape.allow],
+        "recommended": [
+            {"keys": keys, "already_declared_as": existing_index(shape.collection, keys, leading)}
+            for keys, leading in recommended
+        ],
+        "note": shape.note
+    }
+
+
+def report(results: List[dict]):
+    width = max(len(result["shape"]) for result in results)
+    for result in results:
+        status = "ok" if not result["flags"] else ",".join(
+            flag if flag in result["regressions"] else f"{flag}(allowed)" for flag in result["flags"]
+        )
+        print(f"{result['shape']:<{width}}  {result['docs_examined']:>6} docs  {result['keys_examined']:>6} keys  "
+              f"{result['returned']:>5} out  {result['millis']:>4} ms  {status}")
+        print(f"{'':<{width}}  {result['plan']}")
+        for recommendation in result["recommended"]:
+            keys = ", ".join(f"({field!r}, {direction})" for field, direction in recommendation["keys"])
+            declared = recommendation["already_declared_as"]
+            suffix = f"  (declared as {declared}, but not chosen)" if declared else ""
+            print(f"{'':<{width}}  recommend IndexModel([{keys}]){suffix}")
+        if result["note"] and result["flags"]:
+            print(f"{'':<{width}}  note: {result['note']}")
+
+    regressions = [result for result in results if result["regressions"]]
+    print(f"\n{len(results)} query shapes, {sum(1 for r in results if r['flags'])} flagged, "
+          f"{len(regressions)} not allowed")
+
+
+def report_coverage(uncovered: List[dict], stale: List[str]):
+    for site in uncovered:
+        print(f"no query shape: {site['source']} line {site['line']}  {site['collection']}.{site['call']}")
+    for entry in stale:
+        print(f"stale query shape: {entry} no longer queries that collection")
+    print(f"{len(uncovered)} query call sites without a shape, {len(stale)} stale shape sources\n")
+
+
+async def main(args):
+    shapes = [shape for shape in QUERY_SHAPES if not args.shape or shape.name.startswith(tuple(args.shape))]
+    uncovered, stale = coverage(QUERY_SHAPES)
+    report_coverage(uncovered, stale)
+    failed = bool(uncovered or stale)
+    if args.coverage_only:
+        return 1 if args.check and failed else 0
+
+    client = AsyncIOMotorClient(args.mongodb_url, serverSelectionTimeoutMS=5000)
+    await client.drop_database(args.mongodb_name)
+    db = client[args.mongodb_name]
+    try:
+        samples = await seed(db, args.scale, random.Random(args.seed))
+        await create_indexes(db)
+        results = [await analyse(db, shape, samples, args.max_ratio) for shape in shapes]
+    finally:
+        if not args.keep_data:
+            await client.drop_database(args.mongodb_name)
+        client.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2, default=str))
+    else:
+        report(results)
+    failed = failed or any(result["regressions"] for result in results)
+    return 1 if args.check and failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongodb-url", default="mongodb://localhost:27017")
+    parser.add_argument("--mongodb-name", default="artisan_booking_index_advisor",
+                        help="scratch database; dropped before and after the run")
+    parser.add_argument("--scale", type=int, default=5, help="multiplies the seeded document counts")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--max-ratio", type=float, default=10.0,
+                        help="keys or documents examined per expected result before flagging")
+    parser.add_argument("--shape", action="append", help="only shapes whose name starts with this")
+    parser.add_argument("--check", action="store_true",
+                        help="exit 1 on uncovered queries, stale shapes or findings a shape does not allow")
+    parser.add_argument("--coverage-only", action="store_true",
+                        help="only check that every query in the app has a shape; needs no mongod")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--keep-data", action="store_true", help="leave the scratch database in place")
+    sys.exit(asyncio.run(main(parser.parse_args())))
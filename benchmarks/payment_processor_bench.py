@@ -0,0 +1,83 @@
+"""Compare per-request, blocking processor calls with the shared pooled processors
+
+Usage: python benchmarks/payment_processor_bench.py --requests 500 --concurrency 50
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_processor_server import run_in_thread
+from utils.payment_processor import PayPalProcessor, StripeProcessor
+
+
+async def blocking_charge(base_url: str) -> bool:
+    """The previous behaviour: a fresh client and a synchronous call inside the event loop"""
+    session = requests.Session()
+    token = session.post(f"{base_url}/v1/oauth2/token", auth=("id", "secret")).json()
+    response = session.post(
+        f"{base_url}/v2/checkout/orders/ORDER/capture",
+        headers={"Authorization": f"Bearer {token['access_token']}"}
+    )
+    return response.json()["status"] == "COMPLETED"
+
+
+async def pooled_charge(processor) -> bool:
+    result = await processor.process_payment("paypal", 10.0, "USD", "ORDER")
+    return result.success
+
+
+async def run(label: str, call, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            ok = await call()
+            latencies.append(time.perf_counter() - started)
+            return ok
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(
+        f"{label:<10} {total / elapsed:8.1f} req/s  "
+        f"p50 {statistics.median(latencies) * 1000:7.1f} ms  "
+        f"p99 {p99 * 1000:7.1f} ms  "
+        f"failures {results.count(False)}"
+    )
+
+
+async def main(args):
+    base_url = f"http://127.0.0.1:{args.port}"
+    run_in_thread(args.port, args.latency_ms)
+
+    await run("blocking", lambda: blocking_charge(base_url), args.requests, args.concurrency)
+
+    paypal = PayPalProcessor("id", "secret", api_base=base_url, max_connections=args.concurrency)
+    await run("paypal", lambda: pooled_charge(paypal), args.requests, args.concurrency)
+    await paypal.close()
+
+    stripe = StripeProcessor("sk_test_fake", api_base=base_url, max_connections=args.concurrency)
+    await run("stripe", lambda: pooled_charge(stripe), args.requests, args.concurrency)
+    await stripe.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
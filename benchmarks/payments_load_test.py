@@ -0,0 +1,170 @@
+"""End-to-end load test for POST /api/payments/
+
+Seeds a client and a batch of accepted bookings directly into Mongo, then pays
+each booking through a running API and reports throughput and tail latency.
+Start the API with the fake processor first, e.g. from app/:
+
+    PAYMENT_PROCESSOR=fake FAKE_PROCESSOR_LATENCY_MS=50 uvicorn main:app --workers 4
+
+then run:
+
+    python benchmarks/payments_load_test.py --requests 2000 --concurrency 100
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+
+import httpx
+from bson import ObjectId
+from jose import jwt
+from motor.motor_asyncio import AsyncIOMotorClient
+
+
+def seeded_emails(run_id: str):
+    return [f"loadtest-{run_id}@example.com", f"loadtest-artisan-{run_id}@example.com"]
+
+
+async def seed(db, bookings: int):
+    """Insert one client, one artisan and accepted, unpaid bookings to pay for"""
+    now = datetime.now()
+    run_id = uuid.uuid4().hex[:8]
+    client_id, artisan_id = ObjectId(), ObjectId()
+    client_email, artisan_email = seeded_emails(run_id)
+
+    await db["clients"].insert_one({
+        "_id": client_id,
+        "name": "Load Test Client",
+        "email": client_email,
+        "location": "Lagos",
+        "hashed_password": "",
+        "created_at": now,
+        "updated_at": now
+    })
+    await db["artisans"].insert_one({
+        "_id": artisan_id,
+        "name": "Load Test Artisan",
+        "email": artisan_email,
+        "profession": "Plumber",
+        "skills": [],
+        "location": "Lagos",
+        "description": "",
+        "hashed_password": "",
+        "created_at": now,
+        "updated_at": now
+    })
+    result = await db["bookings"].insert_many([
+        {
+            "client_id": client_id,
+            "artisan_id": artisan_id,
+            "service_name": "Load test",
+            "service_description": "",
+            "date": now + timedelta(days=1),
+            "duration": 1.0,
+            "location": "Lagos",
+            "status": "accepted",
+            "agreed_price": 25.0,
+            "payment_status": "pending",
+            "created_at": now,
+            "updated_at": now
+        }
+        for _ in range(bookings)
+    ])
+    return run_id, client_id, artisan_id, result.inserted_ids
+
+
+async def cleanup(db, run_id: str, client_id: ObjectId, artisan_id: ObjectId):
+    """Delete everything the run wrote, found by its client, artisan and emails"""
+    await db["payments"].delete_many({"client_id": client_id})
+    await db["bookings"].delete_many({"client_id": client_id})
+    await db["idempotency_keys"].delete_many({"_id": {"$regex": f"^payments:{client_id}:"}})
+    await db["ledger_entries"].delete_many({"artisan_id": artisan_id})
+    await db["artisan_balances"].delete_many({"artisan_id": artisan_id})
+    await db["notifications"].delete_many({"user_id": {"$in": [client_id, artisan_id]}})
+    await db["notification_counters"].delete_many({"_id": {"$in": [client_id, artisan_id]}})
+    await db["email_outbox"].delete_many({"recipient_email": {"$in": seeded_emails(run_id)}})
+    await db["clients"].delete_one({"_id": client_id})
+    await db["artisans"].delete_one({"_id": artisan_id})
+
+
+async def main(args):
+    db = AsyncIOMotorClient(args.mongodb_url)[args.mongodb_name]
+    run_id, client_id, artisan_id, booking_ids = await seed(db, args.requests)
+    try:
+        await run(args, client_id, booking_ids)
+    finally:
+        if not args.keep_data:
+            # Notifications are written in the background; let the API flush them first
+            await asyncio.sleep(1)
+            await cleanup(db, run_id, client_id, artisan_id)
+
+
+async def run(args, client_id: ObjectId, booking_ids: list):
+    token = jwt.encode(
+        {"sub": str(client_id), "exp": datetime.now() + timedelta(hours=1)},
+        args.secret_key,
+        algorithm=args.algorithm
+    )
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    statuses = Counter()
+
+    async with httpx.AsyncClient(
+        base_url=args.base_url,
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=args.timeout,
+        limits=httpx.Limits(max_connections=args.concurrency)
+    ) as http:
+
+        async def pay(booking_id):
+            headers = {"Idempotency-Key": uuid.uuid4().hex} if args.idempotency_keys else {}
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await http.post("/api/payments/", headers=headers, json={
+                        "booking_id": str(booking_id),
+                        "amount": 25.0,
+                        "method": "credit_card",
+                        "currency": "USD",
+                        "token": "tok_visa"
+                    })
+                    statuses[response.status_code] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(pay(booking_id) for booking_id in booking_ids))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    print(f"requests     {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.1f} req/s)")
+    print(f"latency      p50 {statistics.median(latencies) * 1000:.1f} ms  "
+          f"p95 {percentile(0.95):.1f} ms  p99 {percentile(0.99):.1f} ms  "
+          f"max {latencies[-1] * 1000:.1f} ms")
+    print(f"responses    {dict(statuses)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--mongodb-url", default="mongodb://localhost:27017")
+    parser.add_argument("--mongodb-name", default="artisan_booking")
+    parser.add_argument("--secret-key", default="your-secret-key")
+    parser.add_argument("--algorithm", default="HS256")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--idempotency-keys", action="store_true",
+                        help="send a unique Idempotency-Key with every request")
+    parser.add_argument("--keep-data", action="store_true",
+                        help="leave everything the run wrote in place")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,128 @@
+"""Email throughput: a fresh smtplib session per message vs the pooled async sender
+
+Starts a local aiosmtpd sink that accepts AUTH and counts what it receives,
+then sends the same messages both ways. The previous path opened a
+connection, said EHLO, logged in, sent and quit for every message, blocking
+the event loop throughout. The pooled path reuses a few authenticated
+aiosmtplib connections. --latency-ms delays the sink's EHLO, AUTH and DATA
+replies to stand in for a remote relay; STARTTLS is left out because the
+sink has no certificate, which flatters the per-message path.
+
+Usage: python benchmarks/smtp_bench.py --messages 500 --latency-ms 5
+"""
+import argparse
+import asyncio
+import logging
+import smtplib
+import sys
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from pathlib import Path
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+# aiosmtpd logs a deprecation warning about its own login_data on every AUTH
+logging.getLogger("mail.log").setLevel(logging.ERROR)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from utils.smtp import SMTPConnectionPool
+
+
+class Sink:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.received = 0
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        await asyncio.sleep(self.latency)
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        await asyncio.sleep(self.latency)
+        self.received += 1
+        return "250 OK"
+
+
+def authenticator(latency: float):
+    def authenticate(server, session, envelope, mechanism, auth_data):
+        # aiosmtpd calls this synchronously, so the delay blocks the sink's loop like a slow relay
+        time.sleep(latency)
+        return AuthResult(success=True)
+    return authenticate
+
+
+def build_message(index: int) -> MIMEMultipart:
+    message = MIMEMultipart()
+    message["From"] = "bench@example.com"
+    message["To"] = f"user{index}@example.com"
+    message["Subject"] = f"Benchmark message {index}"
+    message.attach(MIMEText(f"<p>Hello {index}</p>" * 20, "html"))
+    return message
+
+
+async def per_message(host: str, port: int, messages: int) -> float:
+    started = time.perf_counter()
+    for index in range(messages):
+        with smtplib.SMTP(host, port) as server:
+            server.login("bench", "secret")
+            server.send_message(build_message(index))
+    return time.perf_counter() - started
+
+
+async def pooled(host: str, port: int, messages: int, size: int, concurrency: int) -> tuple:
+    pool = SMTPConnectionPool(host, port, "bench", "secret", size=size, use_tls=False)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(index: int):
+        async with semaphore:
+            await pool.send(build_message(index))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(index) for index in range(messages)))
+    elapsed = time.perf_counter() - started
+    await pool.close()
+    return elapsed, pool.connects_total
+
+
+async def main(args):
+    latency = args.latency_ms / 1000
+    sink = Sink(latency)
+    controller = Controller(
+        sink,
+        hostname="127.0.0.1",
+        port=args.port,
+        authenticator=authenticator(latency),
+        auth_require_tls=False
+    )
+    controller.start()
+    try:
+        baseline = await per_message("127.0.0.1", args.port, args.messages)
+        pooled_elapsed, connects = await pooled(
+            "127.0.0.1", args.port, args.messages, args.pool_size, args.concurrency
+        )
+    finally:
+        controller.stop()
+
+    print(f"messages           {args.messages} each way, sink received {sink.received}")
+    print(f"per-message smtplib {baseline:.2f}s  {args.messages / baseline:8.1f} msg/s  "
+          f"{args.messages} connections")
+    print(f"pooled aiosmtplib   {pooled_elapsed:.2f}s  {args.messages / pooled_elapsed:8.1f} msg/s  "
+          f"{connects} connections")
+    print(f"speedup             {baseline / pooled_elapsed:.1f}x")
+    return 0 if sink.received == args.messages * 2 else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--pool-size", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=50,
+                        help="sends in flight at once on the pooled path")
+    parser.add_argument("--latency-ms", type=float, default=2.0,
+                        help="delay before the sink answers EHLO, AUTH and DATA")
+    parser.add_argument("--port", type=int, default=8025)
+    sys.exit(asyncio.run(main(parser.parse_args())))
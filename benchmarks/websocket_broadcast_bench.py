@@ -0,0 +1,96 @@
+"""Broadcast latency of ConnectionManager with many simulated connections
+
+Compares the previous serial fan-out with per-connection writer queues. A
+small share of connections are slow consumers, which is what made serial
+sends hurt. "enqueue" is how long the publisher is held up; "delivered" is
+when the last socket has the message.
+
+Usage: python benchmarks/websocket_broadcast_bench.py --connections 10000
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from utils.websocket import ConnectionManager
+
+
+class FakeWebSocket:
+    """Stand-in socket whose sends take a fixed simulated time"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.sent = 0
+
+    async def accept(self):
+        pass
+
+    async def close(self, code=1000):
+        pass
+
+    async def send_json(self, message):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+
+    async def send_text(self, data):
+        await self.send_json(data)
+
+    async def send_bytes(self, data):
+        await self.send_json(data)
+
+
+def make_sockets(count: int, slow_share: float, slow_latency: float, fast_latency: float):
+    rng = random.Random(42)
+    return [
+        FakeWebSocket(slow_latency if rng.random() < slow_share else fast_latency)
+        for _ in range(count)
+    ]
+
+
+async def serial_broadcast(sockets, message):
+    """The previous behaviour: await each socket in turn"""
+    for websocket in sockets:
+        await websocket.send_json(message)
+
+
+async def main(args):
+    message = {"type": "announcement", "content": "x" * 200}
+
+    sockets = make_sockets(args.connections, args.slow_share, args.slow_latency, args.fast_latency)
+    started = time.perf_counter()
+    await serial_broadcast(sockets, message)
+    print(f"serial      {(time.perf_counter() - started) * 1000:9.1f} ms")
+
+    manager = ConnectionManager(send_timeout=args.send_timeout)
+    sockets = make_sockets(args.connections, args.slow_share, args.slow_latency, args.fast_latency)
+    for index, websocket in enumerate(sockets):
+        await manager.connect(websocket, f"user-{index % (args.connections // 2 or 1)}", f"conn-{index}")
+
+    started = time.perf_counter()
+    await manager.broadcast(message)
+    print(f"enqueue     {(time.perf_counter() - started) * 1000:9.1f} ms")
+    while any(websocket.sent == 0 for websocket in sockets):
+        await asyncio.sleep(0.001)
+    print(f"delivered   {(time.perf_counter() - started) * 1000:9.1f} ms  "
+          f"({len(manager.active_connections)} connections still live)")
+    print(f"metrics     {manager.metrics()}")
+
+    started = time.perf_counter()
+    for index in range(args.connections):
+        manager.disconnect(f"conn-{index}")
+    print(f"disconnect  {(time.perf_counter() - started) * 1000:9.1f} ms for all connections")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--slow-share", type=float, default=0.01)
+    parser.add_argument("--slow-latency", type=float, default=0.05)
+    parser.add_argument("--fast-latency", type=float, default=0.0)
+    parser.add_argument("--send-timeout", type=float, default=1.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,197 @@
+"""Reconnect storm against the chat WebSocket's resume-from-cursor replay
+
+Seeds a sender and a recipient, then has several recipient "devices" drop
+and reconnect their sockets every few hundred milliseconds while the sender
+posts messages over REST. Each device resumes with the cursor of the last
+event it saw. At the end every device must hold every message; the run
+reports gaps, duplicates and how long replays took. Start the API first,
+e.g. from app/:
+
+    uvicorn main:app --workers 4
+
+then run:
+
+    python benchmarks/websocket_reconnect_storm.py --devices 50 --messages 500
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import httpx
+import websockets
+from bson import ObjectId
+from jose import jwt
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from utils.pagination import decode_cursor, encode_cursor
+
+
+class Device:
+    """One client connection that keeps dropping and resuming"""
+
+    def __init__(self, url: str, rng: random.Random, cursor: str):
+        self.url = url
+        self.rng = rng
+        self.cursor = cursor
+        self.position = decode_cursor(cursor)
+        self.received = []
+        self.connects = 0
+        self.replay_latencies = []
+
+    def _advance(self, cursor: str):
+        position = decode_cursor(cursor)
+        if position > self.position:
+            self.cursor, self.position = cursor, position
+
+    def _handle(self, frame: dict) -> bool:
+        """Record a frame; True once a replay has finished"""
+        if frame["type"] == "new_message":
+            self.received.append(frame["message_id"])
+            self._advance(frame["cursor"])
+        elif frame["type"] == "replay" and frame["kind"] == "messages":
+            for event in frame["items"]:
+                self.received.append(event["message_id"])
+                self._advance(event["cursor"])
+        elif frame["type"] == "replay_done":
+            return True
+        return False
+
+    async def session(self, duration: float):
+        started = time.perf_counter()
+        self.connects += 1
+        async with websockets.connect(f"{self.url}&since={self.cursor}") as ws:
+            replaying = True
+            deadline = started + duration
+            while True:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0 and not replaying:
+                    break
+                try:
+                    frame = json.loads(await asyncio.wait_for(ws.recv(), max(timeout, 0.5)))
+                except asyncio.TimeoutError:
+                    if replaying:
+                        raise RuntimeError("replay did not finish")
+                    break
+                if self._handle(frame) and replaying:
+                    replaying = False
+                    self.replay_latencies.append(time.perf_counter() - started)
+
+    async def storm(self, stop: asyncio.Event, min_session: float, max_session: float):
+        while not stop.is_set():
+            try:
+                await self.session(self.rng.uniform(min_session, max_session))
+            except (OSError, websockets.WebSocketException, RuntimeError):
+                pass
+            await asyncio.sleep(self.rng.uniform(0, min_session))
+        # One last resume picks up anything sent while disconnected
+        await self.session(0)
+
+
+async def seed(db):
+    now = datetime.now()
+    user_ids = [ObjectId(), ObjectId()]
+    await db["clients"].insert_many([
+        {
+            "_id": user_id,
+            "name": f"Storm {role}",
+            "email": f"storm-{role}-{user_id}@example.com",
+            "location": "Lagos",
+            "hashed_password": "",
+            "created_at": now,
+            "updated_at": now
+        }
+        for role, user_id in zip(("sender", "recipient"), user_ids)
+    ])
+    return user_ids
+
+
+async def main(args):
+    db = AsyncIOMotorClient(args.mongodb_url)[args.mongodb_name]
+    sender_id, recipient_id = await seed(db)
+
+    def token(user_id):
+        return jwt.encode(
+            {"sub": str(user_id), "exp": datetime.now() + timedelta(hours=1)},
+            args.secret_key,
+            algorithm=args.algorithm
+        )
+
+    ws_base = args.base_url.replace("http", "ws", 1)
+    url = f"{ws_base}/api/messages/ws/{recipient_id}?token={token(recipient_id)}"
+    # Devices start from "now", as if they had seen everything sent before the run
+    start_cursor = encode_cursor(datetime.now(), ObjectId("0" * 24))
+    rng = random.Random(42)
+    devices = [Device(url, random.Random(rng.random()), start_cursor) for _ in range(args.devices)]
+    stop = asyncio.Event()
+    storms = [
+        asyncio.create_task(device.storm(stop, args.min_session, args.max_session))
+        for device in devices
+    ]
+
+    sent = []
+    async with httpx.AsyncClient(
+        base_url=args.base_url,
+        headers={"Authorization": f"Bearer {token(sender_id)}"},
+        timeout=30.0
+    ) as http:
+        started = time.perf_counter()
+        for index in range(args.messages):
+            response = await http.post("/api/messages/", json={
+                "recipient_id": str(recipient_id),
+                "content": f"storm message {index}"
+            })
+            response.raise_for_status()
+            sent.append(response.json()["_id"])
+            await asyncio.sleep(1 / args.rate)
+        elapsed = time.perf_counter() - started
+
+    stop.set()
+    await asyncio.gather(*storms)
+
+    expected = set(sent)
+    missing = sum(len(expected - set(device.received)) for device in devices)
+    duplicates = sum(len(device.received) - len(set(device.received)) for device in devices)
+    connects = sum(device.connects for device in devices)
+    replays = sorted(latency for device in devices for latency in device.replay_latencies)
+
+    print(f"messages     {len(sent)} sent in {elapsed:.2f}s")
+    print(f"reconnects   {connects} across {len(devices)} devices ({connects / elapsed:.1f}/s)")
+    if replays:
+        print(f"replay       p50 {statistics.median(replays) * 1000:.1f} ms  "
+              f"p95 {replays[int(len(replays) * 0.95)] * 1000:.1f} ms  "
+              f"max {replays[-1] * 1000:.1f} ms")
+    print(f"missing      {missing}")
+    print(f"duplicates   {duplicates}")
+
+    if not args.keep_data:
+        await db["messages"].delete_many({"sender_id": sender_id})
+        await db["conversations"].delete_many({"participants": sender_id})
+        await db["clients"].delete_many({"_id": {"$in": [sender_id, recipient_id]}})
+
+    return 1 if missing else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--mongodb-url", default="mongodb://localhost:27017")
+    parser.add_argument("--mongodb-name", default="artisan_booking")
+    parser.add_argument("--secret-key", default="your-secret-key")
+    parser.add_argument("--algorithm", default="HS256")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=100.0, help="messages sent per second")
+    parser.add_argument("--min-session", type=float, default=0.05,
+                        help="shortest time a device stays connected, in seconds")
+    parser.add_argument("--max-session", type=float, default=0.5)
+    parser.add_argument("--keep-data", action="store_true",
+                        help="leave seeded users and messages in place")
+    sys.exit(asyncio.run(main(parser.parse_args())))
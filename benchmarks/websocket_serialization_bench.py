@@ -0,0 +1,108 @@
+"""Encoding cost of WebSocket frames: previous path vs shared orjson frames
+
+The previous path ran serialize_for_websocket and then send_json's stdlib
+json.dumps for every recipient. The current path encodes a Frame once with
+orjson and every recipient reuses the bytes. The payload is a conversation
+snapshot: a page of conversations with ObjectIds and datetimes.
+
+Usage: python benchmarks/websocket_serialization_bench.py --recipients 1000
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from bson import ObjectId
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from utils.websocket import Frame
+
+
+def serialize_for_websocket(data):
+    """The helper frames used to go through, kept here as the baseline"""
+    if isinstance(data, (list, tuple)):
+        return [serialize_for_websocket(item) for item in data]
+    elif isinstance(data, dict):
+        return {key: serialize_for_websocket(value) for key, value in data.items()}
+    elif isinstance(data, ObjectId):
+        return str(data)
+    elif hasattr(data, 'isoformat'):
+        return data.isoformat()
+    else:
+        return data
+
+
+def conversation_snapshot(conversations: int) -> dict:
+    now = datetime.now()
+    return {
+        "type": "conversations",
+        "items": [
+            {
+                "_id": ObjectId(),
+                "participants": [ObjectId(), ObjectId()],
+                "participant_summaries": {
+                    str(ObjectId()): {"_id": ObjectId(), "name": f"User {index}", "profile_picture": None, "role": "client"}
+                    for _ in range(2)
+                },
+                "last_message": {
+                    "message_id": ObjectId(),
+                    "sender_id": ObjectId(),
+                    "content": "Are you available on Thursday afternoon? " * 3,
+                    "created_at": now - timedelta(minutes=index)
+                },
+                "last_message_at": now - timedelta(minutes=index),
+                "unread": {str(ObjectId()): index % 5}
+            }
+            for index in range(conversations)
+        ]
+    }
+
+
+def previous_path(message: dict, recipients: int) -> int:
+    size = 0
+    for _ in range(recipients):
+        # What send_json did after the caller serialized the document
+        text = json.dumps(serialize_for_websocket(message), separators=(",", ":"), ensure_ascii=False)
+        size = len(text.encode())
+    return size
+
+
+def frame_path(message: dict, recipients: int, encoding: str) -> int:
+    frame = Frame(message)
+    size = 0
+    for _ in range(recipients):
+        if encoding == "text":
+            size = len(frame.text)
+        elif encoding == "binary":
+            size = len(frame.encoded)
+        else:
+            size = len(frame.compressed)
+    return size
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    size = function(*args)
+    return time.perf_counter() - started, size
+
+
+def main(args):
+    message = conversation_snapshot(args.conversations)
+    rows = [("serialize_for_websocket + json", *timed(previous_path, message, args.recipients))]
+    for encoding in ("text", "binary", "deflate"):
+        rows.append((f"Frame ({encoding})", *timed(frame_path, message, args.recipients, encoding)))
+
+    print(f"{args.conversations} conversations to {args.recipients} recipients")
+    baseline = rows[0][1]
+    for name, elapsed, size in rows:
+        print(f"{name:32} {elapsed * 1000:9.1f} ms  {baseline / elapsed:7.1f}x  {size:7d} bytes/frame")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--recipients", type=int, default=1000)
+    main(parser.parse_args())
@@ -0,0 +1,39 @@
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+# The app imports its modules as top-level packages (utils, models, ...)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db():
+    """A throwaway database, with the app's indexes, on the server at MONGODB_TEST_URL
+
+    Ledger writes and payout runs use transactions, so the server must be a
+    replica set (a single-node one is enough). Tests that need a database
+    are skipped when MONGODB_TEST_URL is not set.
+    """
+    url = os.environ.get("MONGODB_TEST_URL")
+    if not url:
+        pytest.skip("MONGODB_TEST_URL is not set")
+
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from utils.database import create_indexes
+
+    client = AsyncIOMotorClient(url)
+    database = client[f"test_{uuid.uuid4().hex[:12]}"]
+    await create_indexes(database)
+    try:
+        yield database
+    finally:
+        await client.drop_database(database.name)
+        client.close()
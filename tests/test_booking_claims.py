@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+from utils.booking_claims import (
+    BookingClaimConflict,
+    claim_booking_payment,
+    complete_booking_payment,
+    mark_booking_charged,
+    processor_idempotency_key,
+    release_booking_claim
+)
+
+pytestmark = pytest.mark.anyio
+
+LEASE_SECONDS = 300
+
+
+async def insert_booking(db, **fields) -> dict:
+    booking = {"_id": ObjectId(), "status": "accepted", "payment_status": "pending", **fields}
+    await db["bookings"].insert_one(booking)
+    return booking
+
+
+async def claim(db, booking):
+    return await claim_booking_payment(db, {"_id": booking["_id"]}, LEASE_SECONDS)
+
+
+def test_idempotency_key_follows_the_payment_attempt():
+    booking_id = ObjectId()
+
+    assert processor_idempotency_key({"_id": booking_id}) == f"booking:{booking_id}:0"
+    assert processor_idempotency_key({"_id": booking_id, "payment_attempts": 2}) == f"booking:{booking_id}:2"
+
+
+async def test_second_claim_conflicts_while_the_first_is_live(db):
+    booking = await insert_booking(db)
+
+    claimed = await claim(db, booking)
+
+    assert claimed["_id"] == booking["_id"]
+    with pytest.raises(BookingClaimConflict):
+        await claim(db, booking)
+
+
+async def test_stale_claim_is_taken_over_with_the_same_idempotency_key(db):
+    booking = await insert_booking(db)
+    first = await claim(db, booking)
+    await db["bookings"].update_one(
+        {"_id": booking["_id"]},
+        {"$set": {"processing_claimed_at": datetime.now() - timedelta(seconds=LEASE_SECONDS + 1)}}
+    )
+
+    second = await claim(db, booking)
+
+    assert second["processing_claim_id"] != first["processing_claim_id"]
+    # The processor sees a replay of the charge the dead request may have made
+    assert processor_idempotency_key(second) == processor_idempotency_key(first)
+
+
+async def test_released_claim_charges_under_a_fresh_key(db):
+    booking = await insert_booking(db)
+    first = await claim(db, booking)
+
+    await release_booking_claim(db, first)
+    second = await claim(db, booking)
+
+    assert second["payment_status"] == "pending"
+    assert processor_idempotency_key(second) != processor_idempotency_key(first)
+
+
+async def test_release_by_a_superseded_claimer_changes_nothing(db):
+    booking = await insert_booking(db)
+    stale = await claim(db, booking)
+    await db["bookings"].update_one(
+        {"_id": booking["_id"]},
+        {"$set": {"processing_claimed_at": datetime.now() - timedelta(seconds=LEASE_SECONDS + 1)}}
+    )
+    current = await claim(db, booking)
+
+    await release_booking_claim(db, stale)
+
+    stored = await db["bookings"].find_one({"_id": booking["_id"]})
+    assert stored["payment_status"] == "processing"
+    assert stored["processing_claim_id"] == current["processing_claim_id"]
+    assert stored.get("payment_attempts", 0) == 0
+
+
+async def test_recorded_charge_is_handed_to_the_next_claim(db):
+    booking = await insert_booking(db)
+    first = await claim(db, booking)
+
+    await mark_booking_charged(db, first, "ch_123")
+    # The claim was given up, so a retry does not wait for the lease
+    retry = await claim(db, booking)
+
+    assert retry["charged_transaction_id"] == "ch_123"
+
+
+async def test_paid_booking_cannot_be_claimed(db):
+    booking = await insert_booking(db)
+    claimed = await claim(db, booking)
+
+    await complete_booking_payment(db, claimed)
+
+    assert await claim(db, booking) is None
+    stored = await db["bookings"].find_one({"_id": booking["_id"]})
+    assert stored["payment_status"] == "paid"
+    assert "processing_claim_id" not in stored
+
+
+async def test_unknown_booking_is_not_claimed(db):
+    assert await claim_booking_payment(db, {"_id": ObjectId()}, LEASE_SECONDS) is None
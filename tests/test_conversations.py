@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+from utils.conversations import (
+    LAST_MESSAGE_PREVIEW_LENGTH,
+    conversation_key,
+    mark_conversations_read,
+    record_conversation_messages
+)
+
+
+def test_conversation_key_ignores_who_sent_what():
+    first, second = ObjectId(), ObjectId()
+
+    assert conversation_key(first, second) == conversation_key(second, first)
+
+
+def test_conversation_key_is_the_same_for_ids_and_their_strings():
+    first, second = ObjectId(), ObjectId()
+
+    assert conversation_key(first, second) == conversation_key(str(second), str(first))
+    assert conversation_key(first, second) == ":".join(sorted([str(first), str(second)]))
+
+
+def test_conversation_key_differs_per_pair():
+    first, second, third = ObjectId(), ObjectId(), ObjectId()
+
+    assert conversation_key(first, second) != conversation_key(first, third)
+
+
+def message(sender_id, recipient_id, created_at, content="hello") -> dict:
+    return {
+        "_id": ObjectId(),
+        "sender_id": sender_id,
+        "recipient_id": recipient_id,
+        "content": content,
+        "created_at": created_at
+    }
+
+
+@pytest.mark.anyio
+async def test_late_message_counts_as_unread_without_replacing_the_last_one(db):
+    client_id, artisan_id = ObjectId(), ObjectId()
+    now = datetime.now()
+    newest = message(client_id, artisan_id, now, content="x" * (LAST_MESSAGE_PREVIEW_LENGTH + 50))
+
+    await record_conversation_messages(db, [newest])
+    await record_conversation_messages(db, [message(client_id, artisan_id, now - timedelta(minutes=5))])
+    await record_conversation_messages(db, [message(artisan_id, client_id, now - timedelta(minutes=1))])
+
+    conversation = await db["conversations"].find_one({"conversation_key": conversation_key(client_id, artisan_id)})
+    assert await db["conversations"].count_documents({}) == 1
+    assert conversation["last_message"]["message_id"] == newest["_id"]
+    assert len(conversation["last_message"]["content"]) == LAST_MESSAGE_PREVIEW_LENGTH
+    assert conversation["unread"] == {str(artisan_id): 2, str(client_id): 1}
+
+
+@pytest.mark.anyio
+async def test_unread_counter_never_drops_below_zero(db):
+    client_id, artisan_id = ObjectId(), ObjectId()
+    await record_conversation_messages(db, [message(client_id, artisan_id, datetime.now())])
+
+    await mark_conversations_read(db, artisan_id, {client_id: 3})
+
+    conversation = await db["conversations"].find_one({"conversation_key": conversation_key(client_id, artisan_id)})
+    assert conversation["unread"][str(artisan_id)] == 0
@@ -0,0 +1,90 @@
+import importlib.util
+from datetime import datetime
+from pathlib import Path
+
+from bson import ObjectId
+
+from utils.pagination import keyset_range
+
+# benchmarks/ is a directory of scripts, not a package
+_spec = importlib.util.spec_from_file_location(
+    "index_advisor", Path(__file__).resolve().parent.parent / "benchmarks" / "index_advisor.py"
+)
+index_advisor = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(index_advisor)
+
+recommend = index_advisor.recommend
+existing_index = index_advisor.existing_index
+
+USER = ObjectId()
+NOW = datetime(2024, 5, 17)
+
+
+def test_equality_fields_lead_then_the_sort():
+    assert recommend({"client_id": USER, "status": "accepted"}, [("date", 1)]) == [
+        ([("client_id", 1), ("status", 1), ("date", 1)], 2)
+    ]
+
+
+def test_range_fields_come_after_the_sort():
+    assert recommend({"client_id": USER, "created_at": {"$gte": NOW}}, [("date", -1)]) == [
+        ([("client_id", 1), ("date", -1), ("created_at", 1)], 1)
+    ]
+
+
+def test_in_is_treated_as_equality_and_id_is_ignored():
+    assert recommend({"_id": {"$in": [USER]}, "transaction_id": {"$in": ["ch_1"]}}, []) == [
+        ([("transaction_id", 1)], 1)
+    ]
+    assert recommend({"_id": USER}, []) == []
+
+
+def test_keyset_pagination_is_served_by_the_sort_keys():
+    query = {"user_id": USER, **keyset_range(NOW, ObjectId())}
+
+    assert recommend(query, [("created_at", -1), ("_id", -1)]) == [
+        ([("user_id", 1), ("created_at", -1), ("_id", -1)], 1)
+    ]
+
+
+def test_null_or_expired_lease_is_a_range_on_that_field():
+    query = {"status": "pending", "$or": [{"locked_until": None}, {"locked_until": {"$lt": NOW}}]}
+
+    assert recommend(query, [("received_at", 1)]) == [
+        ([("status", 1), ("received_at", 1), ("locked_until", 1)], 1)
+    ]
+
+
+def test_or_over_different_fields_gets_one_index_per_branch():
+    query = {"$or": [{"sender_id": USER}, {"recipient_id": USER}]}
+
+    assert recommend(query, [("created_at", 1), ("_id", 1)]) == [
+        ([("sender_id", 1), ("created_at", 1), ("_id", 1)], 1),
+        ([("recipient_id", 1), ("created_at", 1), ("_id", 1)], 1)
+    ]
+
+
+def test_recommendation_covered_by_a_longer_one_is_dropped():
+    query = {"$or": [{"sender_id": USER}, {"sender_id": USER, "recipient_id": ObjectId()}]}
+
+    assert recommend(query, []) == [([("sender_id", 1), ("recipient_id", 1)], 2)]
+
+
+def test_declared_index_walked_backwards_serves_the_reversed_sort():
+    forwards = [("recipient_id", 1), ("created_at", 1), ("_id", 1)]
+    backwards = [("recipient_id", 1), ("created_at", -1), ("_id", -1)]
+
+    assert existing_index("messages", forwards, 1) == "recipient_id_1_created_at_1__id_1"
+    assert existing_index("messages", backwards, 1) == "recipient_id_1_created_at_1__id_1"
+
+
+def test_declared_index_with_mixed_directions_does_not_serve_the_sort():
+    assert existing_index("messages", [("recipient_id", 1), ("created_at", -1), ("_id", 1)], 1) is None
+    assert existing_index("messages", [("created_at", 1)], 0) is None
+
+
+def test_every_query_in_the_app_has_a_shape():
+    uncovered, stale = index_advisor.coverage(index_advisor.QUERY_SHAPES)
+
+    assert [site["source"] for site in uncovered] == []
+    assert stale == []
@@ -0,0 +1,137 @@
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+from utils.ledger import (
+    PayoutConflict,
+    _settle_chunk,
+    get_artisan_balances,
+    record_ledger_entries,
+    record_ledger_entry,
+    run_payouts,
+    to_minor_units
+)
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize("amount, currency, expected", [
+    (19.99, "USD", 1999),
+    (0.1 + 0.2, "USD", 30),
+    (1.005, "usd", 101),
+    (2.675, "EUR", 268),
+    (1500, "JPY", 1500),
+    (1500.5, "jpy", 1501),
+    (0, "USD", 0),
+])
+def test_to_minor_units(amount, currency, expected):
+    assert to_minor_units(amount, currency) == expected
+
+
+def charge(artisan_id, amount_minor, reference_id, currency="USD") -> dict:
+    return {
+        "artisan_id": artisan_id,
+        "entry_type": "charge",
+        "amount_minor": amount_minor,
+        "currency": currency,
+        "reference_id": reference_id
+    }
+
+
+async def balances(db, artisan_id) -> dict:
+    return {
+        balance["currency"]: balance["balance_minor"]
+        for balance in await get_artisan_balances(db, artisan_id)
+    }
+
+
+async def age_entries(db):
+    # Payout runs only settle entries written before they started
+    await db["ledger_entries"].update_many({}, {"$set": {"created_at": datetime.now() - timedelta(seconds=1)}})
+
+
+async def test_entries_are_signed_and_summed_per_currency(db):
+    artisan_id = ObjectId()
+
+    await record_ledger_entries(db, [
+        charge(artisan_id, 2000, "pay_1"),
+        {**charge(artisan_id, 200, "pay_1"), "entry_type": "fee"},
+        charge(artisan_id, 1500, "pay_2", currency="EUR")
+    ])
+    await record_ledger_entry(db, artisan_id, "refund", 500, reference_id="pay_1")
+
+    assert await balances(db, artisan_id) == {"USD": 1300, "EUR": 1500}
+
+
+async def test_recording_the_same_reference_twice_changes_nothing(db):
+    artisan_id = ObjectId()
+
+    assert await record_ledger_entries(db, [charge(artisan_id, 2000, "pay_1")]) is True
+    assert await record_ledger_entries(db, [charge(artisan_id, 2000, "pay_1")]) is False
+
+    assert await balances(db, artisan_id) == {"USD": 2000}
+    assert await db["ledger_entries"].count_documents({"artisan_id": artisan_id}) == 1
+
+
+async def test_payout_run_settles_every_balance_once(db):
+    artisans = [ObjectId() for _ in range(5)]
+    for index, artisan_id in enumerate(artisans):
+        await record_ledger_entries(db, [
+            charge(artisan_id, 1000, f"pay_{index}_a"),
+            charge(artisan_id, 250, f"pay_{index}_b")
+        ])
+    await age_entries(db)
+
+    # Chunks smaller than the number of artisans, so several transactions are written
+    summary = await run_payouts(db, settle_chunk=2)
+
+    assert summary["artisans"] == 5
+    assert summary["amount_minor"] == 5 * 1250
+    for artisan_id in artisans:
+        assert await balances(db, artisan_id) == {"USD": 0}
+    assert await db["ledger_entries"].count_documents({"payout_id": None}) == 0
+    assert (await run_payouts(db))["artisans"] == 0
+
+
+async def test_balances_below_the_minimum_wait_for_a_later_run(db):
+    small, large = ObjectId(), ObjectId()
+    await record_ledger_entries(db, [charge(small, 300, "pay_small"), charge(large, 3000, "pay_large")])
+    await age_entries(db)
+
+    summary = await run_payouts(db, min_payout_minor=1000)
+
+    assert summary["artisans"] == 1
+    assert await balances(db, small) == {"USD": 300}
+    assert await balances(db, large) == {"USD": 0}
+    assert await db["ledger_entries"].count_documents({"artisan_id": small, "payout_id": None}) == 1
+
+
+async def test_entries_recorded_after_the_run_started_are_left_for_the_next(db):
+    artisan_id = ObjectId()
+    await record_ledger_entries(db, [charge(artisan_id, 1000, "pay_1")])
+    await age_entries(db)
+    await db["ledger_entries"].insert_one({
+        **charge(artisan_id, 700, "pay_2"), "payout_id": None, "created_at": datetime.now() + timedelta(minutes=1)
+    })
+
+    summary = await run_payouts(db)
+
+    assert summary["amount_minor"] == 1000
+    assert await db["ledger_entries"].count_documents({"reference_id": "pay_2", "payout_id": None}) == 1
+
+
+async def test_entries_settled_by_another_run_are_not_paid_out_again(db):
+    artisan_id = ObjectId()
+    await record_ledger_entries(db, [charge(artisan_id, 1000, "pay_1")])
+    entry = await db["ledger_entries"].find_one({"reference_id": "pay_1"})
+    await db["ledger_entries"].update_one({"_id": entry["_id"]}, {"$set": {"payout_id": "payout_other"}})
+    chunk = [{"artisan_id": artisan_id, "currency": "USD", "amount_minor": 1000, "entry_ids": [entry["_id"]]}]
+
+    async with await db.client.start_session() as session:
+        with pytest.raises(PayoutConflict):
+            async with session.start_transaction():
+                await _settle_chunk(db, chunk, "payout_this", session)
+
+    assert await balances(db, artisan_id) == {"USD": 1000}
+    assert await db["ledger_entries"].count_documents({"entry_type": "payout"}) == 0
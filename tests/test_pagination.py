@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+from utils.pagination import (
+    InvalidCursor,
+    decode_cursor,
+    encode_cursor,
+    keyset_filter,
+    keyset_range
+)
+
+
+def matches(document: dict, query: dict) -> bool:
+    """Evaluate the $or/$lt/$gt filters keyset_range builds against one document"""
+    if "$or" in query:
+        return any(matches(document, branch) for branch in query["$or"])
+    for field, condition in query.items():
+        value = document[field]
+        if isinstance(condition, dict):
+            (op, bound), = condition.items()
+            if not (value < bound if op == "$lt" else value > bound):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def page_through(documents, page_size, direction):
+    """Read every page the way the list endpoints do and return the ids in order"""
+    ordered = sorted(documents, key=lambda d: (d["created_at"], d["_id"]), reverse=direction < 0)
+    seen, cursor = [], None
+    while True:
+        query = keyset_filter(cursor, direction=direction) if cursor else {}
+        page = [d for d in ordered if matches(d, query)][:page_size]
+        if not page:
+            return seen
+        seen.extend(d["_id"] for d in page)
+        cursor = encode_cursor(page[-1]["created_at"], page[-1]["_id"])
+
+
+def test_cursor_round_trips():
+    created_at = datetime(2024, 5, 17, 9, 30, 15, 123000)
+    document_id = ObjectId()
+
+    cursor = encode_cursor(created_at, document_id)
+
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (created_at, document_id)
+
+
+@pytest.mark.parametrize("cursor", ["", "not-a-cursor", "%%%", encode_cursor(datetime.now(), ObjectId())[:-4]])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
+
+
+def test_invalid_cursor_is_a_value_error():
+    # Routers turn it into a 400, callers that only know ValueError still catch it
+    assert issubclass(InvalidCursor, ValueError)
+
+
+def test_keyset_range_breaks_ties_on_id():
+    created_at, document_id = datetime(2024, 1, 1), ObjectId()
+
+    assert keyset_range(created_at, document_id) == {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "_id": {"$lt": document_id}}
+    ]}
+    assert keyset_range(created_at, document_id, field="last_message_at", direction=1) == {"$or": [
+        {"last_message_at": {"$gt": created_at}},
+        {"last_message_at": created_at, "_id": {"$gt": document_id}}
+    ]}
+
+
+@pytest.mark.parametrize("direction", [-1, 1])
+def test_paging_visits_every_document_once_despite_tied_timestamps(direction):
+    start = datetime(2024, 1, 1)
+    # Groups of documents share a timestamp, and pages end in the middle of groups
+    documents = [
+        {"_id": ObjectId(), "created_at": start + timedelta(seconds=i // 4)}
+        for i in range(23)
+    ]
+
+    seen = page_through(documents, page_size=5, direction=direction)
+
+    expected = sorted(documents, key=lambda d: (d["created_at"], d["_id"]), reverse=direction < 0)
+    assert seen == [d["_id"] for d in expected]
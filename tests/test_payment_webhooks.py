@@ -0,0 +1,221 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+import zlib
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+
+from utils import payment_webhooks
+from utils.payment_webhooks import (
+    PaymentWebhookWorker,
+    WebhookVerificationError,
+    apply_refund,
+    enqueue_webhook_event,
+    verify_paypal_webhook,
+    verify_stripe_webhook
+)
+
+STRIPE_SECRET = "whsec_test"
+PAYPAL_CERT_URL = "https://api.paypal.com/v1/notifications/certs/CERT-test"
+
+
+def stripe_payload(**charge) -> bytes:
+    return json.dumps({
+        "id": "evt_1",
+        "type": "charge.refunded",
+        "data": {"object": {"id": "ch_1", "amount_refunded": 500, **charge}}
+    }).encode()
+
+
+def stripe_headers(payload: bytes, secret: str = STRIPE_SECRET, timestamp: int = None) -> dict:
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload.decode()}".encode(), hashlib.sha256).hexdigest()
+    return {"stripe-signature": f"t={timestamp},v1={signature}"}
+
+
+def test_stripe_event_is_verified_and_normalized():
+    payload = stripe_payload()
+
+    event = verify_stripe_webhook(payload, stripe_headers(payload), STRIPE_SECRET)
+
+    assert event["id"] == "evt_1"
+    assert event["type"] == "charge.refunded"
+    assert event["transaction_id"] == "ch_1"
+    assert event["amount_refunded"] == 500
+
+
+@pytest.mark.parametrize("headers", [
+    lambda payload: stripe_headers(payload, secret="whsec_other"),
+    lambda payload: stripe_headers(stripe_payload(amount_refunded=1)),
+    lambda payload: stripe_headers(payload, timestamp=int(time.time()) - 3600),
+    lambda payload: {},
+])
+def test_stripe_event_with_a_bad_signature_is_rejected(headers):
+    payload = stripe_payload()
+
+    with pytest.raises(WebhookVerificationError):
+        verify_stripe_webhook(payload, headers(payload), STRIPE_SECRET)
+
+
+@pytest.fixture
+def paypal_key(monkeypatch):
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    # Primed as if already fetched, so verification never touches the network
+    monkeypatch.setitem(payment_webhooks._paypal_cert_cache, PAYPAL_CERT_URL, private_key.public_key())
+    return private_key
+
+
+def paypal_headers(private_key, payload: bytes, webhook_id: str) -> dict:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    transmission_id, transmission_time = "tx-1", "2024-05-17T09:30:15Z"
+    message = f"{transmission_id}|{transmission_time}|{webhook_id}|{zlib.crc32(payload)}"
+    signature = private_key.sign(message.encode(), padding.PKCS1v15(), hashes.SHA256())
+    return {
+        "paypal-transmission-id": transmission_id,
+        "paypal-transmission-time": transmission_time,
+        "paypal-transmission-sig": base64.b64encode(signature).decode(),
+        "paypal-cert-url": PAYPAL_CERT_URL
+    }
+
+
+@pytest.mark.anyio
+async def test_paypal_refund_is_verified_and_carries_the_cumulative_total(paypal_key):
+    payload = json.dumps({
+        "id": "WH-1",
+        "event_type": "PAYMENT.CAPTURE.REFUNDED",
+        "resource": {
+            "id": "REFUND-1",
+            "supplementary_data": {"related_ids": {"order_id": "ORDER-1"}},
+            "seller_payable_breakdown": {"total_refunded_amount": {"value": "12.50", "currency_code": "USD"}}
+        }
+    }).encode()
+
+    event = await verify_paypal_webhook(payload, paypal_headers(paypal_key, payload, "WH-ID"), "WH-ID")
+
+    assert event["transaction_id"] == "ORDER-1"
+    assert event["amount_refunded"] == 1250
+
+
+@pytest.mark.anyio
+async def test_paypal_event_signed_for_another_webhook_is_rejected(paypal_key):
+    payload = json.dumps({"id": "WH-1", "event_type": "PAYMENT.CAPTURE.COMPLETED", "resource": {}}).encode()
+
+    with pytest.raises(WebhookVerificationError):
+        await verify_paypal_webhook(payload, paypal_headers(paypal_key, payload, "WH-OTHER"), "WH-ID")
+
+
+@pytest.mark.anyio
+async def test_paypal_certificate_outside_paypal_is_refused():
+    headers = {
+        "paypal-transmission-id": "tx-1",
+        "paypal-transmission-time": "2024-05-17T09:30:15Z",
+        "paypal-transmission-sig": "c2ln",
+        "paypal-cert-url": "https://paypal.com.example.org/cert.pem"
+    }
+
+    with pytest.raises(WebhookVerificationError):
+        await verify_paypal_webhook(b"{}", headers, "WH-ID")
+
+
+async def insert_payment(db, **fields) -> dict:
+    payment = {
+        "_id": ObjectId(),
+        "booking_id": ObjectId(),
+        "artisan_id": ObjectId(),
+        "amount": 20.0,
+        "currency": "USD",
+        "status": "completed",
+        "transaction_id": "ch_1",
+        **fields
+    }
+    await db["payments"].insert_one(payment)
+    return payment
+
+
+async def artisan_balance(db, artisan_id) -> int:
+    balance = await db["artisan_balances"].find_one({"artisan_id": artisan_id, "currency": "USD"})
+    return balance["balance_minor"] if balance else 0
+
+
+@pytest.mark.anyio
+async def test_partial_refunds_accumulate_and_replays_debit_nothing(db):
+    payment = await insert_payment(db)
+    now = datetime.now()
+
+    await apply_refund(db, dict(payment), 500, now)
+    partially_refunded = await db["payments"].find_one({"_id": payment["_id"]})
+    # A redelivered or out-of-order event for a smaller total changes nothing
+    await apply_refund(db, partially_refunded, 500, now)
+    await apply_refund(db, await db["payments"].find_one({"_id": payment["_id"]}), 300, now)
+
+    assert partially_refunded["status"] == "partially_refunded"
+    assert await artisan_balance(db, payment["artisan_id"]) == -500
+
+    await apply_refund(db, await db["payments"].find_one({"_id": payment["_id"]}), 2000, now)
+
+    refunded = await db["payments"].find_one({"_id": payment["_id"]})
+    assert refunded["status"] == "refunded"
+    assert refunded["refunded_minor"] == 2000
+    assert await artisan_balance(db, payment["artisan_id"]) == -2000
+
+
+@pytest.mark.anyio
+async def test_refund_without_an_amount_refunds_everything(db):
+    payment = await insert_payment(db, amount=12.34)
+
+    await apply_refund(db, dict(payment), None, datetime.now())
+
+    assert (await db["payments"].find_one({"_id": payment["_id"]}))["status"] == "refunded"
+    assert await artisan_balance(db, payment["artisan_id"]) == -1234
+
+
+@pytest.mark.anyio
+async def test_event_for_a_payment_not_stored_yet_waits_and_is_applied_later(db):
+    worker = PaymentWebhookWorker(SimpleNamespace(mongodb=db), max_attempts=3)
+    await enqueue_webhook_event(db, "stripe", {
+        "id": "evt_1", "type": "charge.succeeded", "transaction_id": "ch_1", "payload": {}
+    })
+
+    await worker.drain_once()
+
+    event = await db["payment_webhook_events"].find_one({"_id": "stripe:evt_1"})
+    assert event["status"] == "pending"
+    assert event["locked_until"] > datetime.now()
+    assert await worker.drain_once() == 0
+
+    payment = await insert_payment(db, status="pending")
+    await db["bookings"].insert_one({"_id": payment["booking_id"], "payment_status": "pending"})
+    await db["payment_webhook_events"].update_one(
+        {"_id": "stripe:evt_1"}, {"$set": {"locked_until": datetime.now() - timedelta(seconds=1)}}
+    )
+    await worker.drain_once()
+
+    assert (await db["payment_webhook_events"].find_one({"_id": "stripe:evt_1"}))["status"] == "processed"
+    assert (await db["payments"].find_one({"_id": payment["_id"]}))["status"] == "completed"
+    assert (await db["bookings"].find_one({"_id": payment["booking_id"]}))["payment_status"] == "paid"
+
+
+@pytest.mark.anyio
+async def test_event_that_never_matches_is_dead_lettered_after_max_attempts(db):
+    worker = PaymentWebhookWorker(SimpleNamespace(mongodb=db), max_attempts=2)
+    await enqueue_webhook_event(db, "stripe", {
+        "id": "evt_1", "type": "charge.succeeded", "transaction_id": "ch_missing", "payload": {}
+    })
+
+    for _ in range(2):
+        await db["payment_webhook_events"].update_one({"_id": "stripe:evt_1"}, {"$set": {"locked_until": None}})
+        await worker.drain_once()
+
+    event = await db["payment_webhook_events"].find_one({"_id": "stripe:evt_1"})
+    assert event["status"] == "dead"
+    assert event["attempts"] == 2
+    assert "ch_missing" in event["last_error"]
@@ -0,0 +1,206 @@
+import asyncio
+import zlib
+
+import orjson
+import pytest
+from bson import ObjectId
+
+from utils.websocket import ConnectionManager, ConnectionWriter, Frame
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeWebSocket:
+    """Records what was sent; sends block while the socket is paused"""
+
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+        self.flowing = asyncio.Event()
+        self.flowing.set()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        await self.flowing.wait()
+        self.sent.append(data)
+
+    async def send_bytes(self, data: bytes):
+        await self.flowing.wait()
+        self.sent.append(data)
+
+    async def close(self, code: int):
+        self.closed_with = code
+
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+async def make_writer():
+    """Build writers that are stopped when the test ends, whether or not it passed"""
+    writers = []
+
+    def make(websocket, evicted=None, connection_id="conn-1", **options) -> ConnectionWriter:
+        writer = ConnectionWriter(
+            websocket,
+            connection_id,
+            lambda connection_id, reason: evicted.append(reason) if evicted is not None else None,
+            **options
+        )
+        writers.append(writer)
+        return writer
+
+    yield make
+    for writer in writers:
+        writer.stop()
+
+
+@pytest.fixture
+def paused_writer(make_writer):
+    """A writer whose socket is stuck mid-send, so later frames stay queued"""
+    async def make(websocket, **options) -> ConnectionWriter:
+        writer = make_writer(websocket, **options)
+        websocket.flowing.clear()
+        writer.enqueue(Frame({"type": "first"}))
+        await settle()
+        return writer
+
+    return make
+
+
+@pytest.fixture
+async def make_manager():
+    """Build managers whose connections are dropped when the test ends"""
+    managers = []
+
+    def make(**options) -> ConnectionManager:
+        manager = ConnectionManager(**options)
+        managers.append(manager)
+        return manager
+
+    yield make
+    for manager in managers:
+        for connection_id in list(manager.active_connections):
+            manager.disconnect(connection_id)
+
+
+def messages(websocket):
+    return [orjson.loads(data)["type"] for data in websocket.sent]
+
+
+async def test_newer_frame_replaces_a_queued_one_with_the_same_key(paused_writer):
+    websocket = FakeWebSocket()
+    writer = await paused_writer(websocket)
+
+    writer.enqueue(Frame({"type": "typing", "n": 1}, coalesce_key="typing"))
+    writer.enqueue(Frame({"type": "message"}))
+    writer.enqueue(Frame({"type": "typing", "n": 2}, coalesce_key="typing"))
+
+    assert writer.depth == 2
+    assert writer.coalesced == 1
+
+    websocket.flowing.set()
+    await settle()
+
+    assert messages(websocket) == ["first", "typing", "message"]
+    # The replacement keeps the original frame's place in the queue
+    assert orjson.loads(websocket.sent[1])["n"] == 2
+
+
+async def test_key_is_free_again_once_its_frame_is_sent(make_writer):
+    websocket = FakeWebSocket()
+    writer = make_writer(websocket)
+
+    writer.enqueue(Frame({"type": "ping"}, coalesce_key="ping"))
+    await settle()
+    writer.enqueue(Frame({"type": "ping"}, coalesce_key="ping"))
+    await settle()
+
+    assert messages(websocket) == ["ping", "ping"]
+    assert writer.coalesced == 0
+
+
+async def test_full_queue_refuses_frames(paused_writer):
+    writer = await paused_writer(FakeWebSocket(), max_queue=2)
+
+    assert writer.enqueue(Frame({"type": "a"}))
+    assert writer.enqueue(Frame({"type": "b"}))
+    assert not writer.enqueue(Frame({"type": "c"}))
+
+
+async def test_coalesced_frame_is_accepted_even_when_the_queue_is_full(paused_writer):
+    writer = await paused_writer(FakeWebSocket(), max_queue=1)
+
+    assert writer.enqueue(Frame({"type": "typing"}, coalesce_key="typing"))
+    assert writer.enqueue(Frame({"type": "typing"}, coalesce_key="typing"))
+    assert not writer.enqueue(Frame({"type": "message"}))
+
+
+async def test_queue_that_stopped_draining_refuses_frames(paused_writer):
+    writer = await paused_writer(FakeWebSocket(), max_queue_delay=0.01)
+    assert writer.enqueue(Frame({"type": "a"}))
+
+    await asyncio.sleep(0.02)
+
+    assert not writer.enqueue(Frame({"type": "b"}))
+
+
+async def test_send_that_times_out_evicts_the_connection(paused_writer):
+    evicted = []
+    writer = await paused_writer(FakeWebSocket(), evicted=evicted, send_timeout=0.01)
+
+    await asyncio.sleep(0.05)
+
+    assert evicted == ["send failed"]
+    assert writer.sent == 0
+
+
+async def test_frame_is_encoded_once_for_every_encoding(make_writer):
+    frame = Frame({"type": "message", "id": ObjectId("65a000000000000000000001")})
+    sockets = {encoding: FakeWebSocket() for encoding in ("text", "binary", "deflate")}
+    writers = [
+        make_writer(websocket, connection_id=f"conn-{encoding}", encoding=encoding)
+        for encoding, websocket in sockets.items()
+    ]
+
+    for writer in writers:
+        writer.enqueue(frame)
+    await settle()
+
+    expected = b'{"type":"message","id":"65a000000000000000000001"}'
+    assert sockets["text"].sent == [expected.decode()]
+    assert sockets["binary"].sent == [expected]
+    assert zlib.decompress(sockets["deflate"].sent[0]) == expected
+    assert sockets["binary"].sent[0] is frame.encoded
+
+
+async def test_manager_evicts_a_consumer_whose_queue_is_full(make_manager):
+    manager = make_manager(max_queue=1)
+    slow, fast = FakeWebSocket(), FakeWebSocket()
+    await manager.connect(slow, "user-1", "slow")
+    await manager.connect(fast, "user-1", "fast")
+    slow.flowing.clear()
+
+    for n in range(3):
+        await manager.send_personal_message({"type": "message", "n": n}, "user-1")
+        await settle()
+
+    assert "slow" not in manager.writers
+    assert slow.closed_with == 1013
+    assert [orjson.loads(data)["n"] for data in fast.sent] == [0, 1, 2]
+    assert manager.metrics()["evicted_connections"] == 1
+
+
+async def test_coalesce_key_never_reaches_the_client(make_manager):
+    manager = make_manager()
+    websocket = FakeWebSocket()
+    await manager.connect(websocket, "user-1", "conn-1")
+
+    await manager.send_personal_message({"type": "typing"}, "user-1", coalesce_key="typing:user-2")
+    await settle()
+
+    assert [orjson.loads(data) for data in websocket.sent] == [{"type": "typing"}]